@@ -22,7 +22,7 @@ import base64
 import string
 from urllib.parse import urlparse
 
-from traitlets import Any, Dict, Unicode, default
+from traitlets import Any, Dict, Integer, Unicode, default
 
 from .kv_proxy import TKvProxy
 from .traefik_utils import deep_merge
@@ -41,6 +41,20 @@ class TraefikConsulProxy(TKvProxy):
         help="Extra consul client constructor arguments",
     )
 
+    consul_max_txn_ops = Integer(
+        64,
+        config=True,
+        help="""The maximum number of operations in a single consul transaction
+
+        Consul allows at most 64 operations per transaction.
+        Larger updates (e.g. batches of routes) are split
+        into several transactions, each route's keys in the same one,
+        so they are atomic per route.
+
+        .. versionadded:: 2.2
+        """,
+    )
+
     consul_url = Unicode(
         "http://127.0.0.1:8500",
         config=True,
@@ -121,44 +135,62 @@ class TraefikConsulProxy(TKvProxy):
         super()._start_traefik()
 
     async def _kv_atomic_set(self, to_set):
-        payload = []
+        payload = {}
 
         def append_payload(key, val):
-            payload.append(
-                {
-                    "KV": {
-                        "Verb": "set",
-                        "Key": key,
-                        "Value": base64.b64encode(val.encode()).decode(),
-                    }
+            payload[key] = {
+                "KV": {
+                    "Verb": "set",
+                    "Key": key,
+                    "Value": base64.b64encode(val.encode()).decode(),
                 }
-            )
+            }
 
         for k, v in to_set.items():
             append_payload(k, v)
 
         try:
-            await self.consul.txn.put(payload=payload)
+            await self._txn(payload)
         except Exception:
             self.log.exception("Error uploading payload to KV store!")
+            raise
         else:
             self.log.debug("Successfully uploaded payload to KV store")
 
+    async def _txn(self, payload):
+        """Run a transaction payload (a dict by key), in chunks consul accepts
+
+        Each route's keys are kept in the same chunk.
+        """
+        for keys in self._transaction_chunks(payload, self.consul_max_txn_ops):
+            await self.consul.txn.put(payload=[payload[key] for key in keys])
+
     async def _kv_atomic_delete(self, *to_delete):
-        payload = []
+        payload = {}
 
         for key in to_delete:
             if key.endswith(self.kv_separator):
                 verb = "delete-tree"
             else:
                 verb = "delete"
-            payload.append(
-                {
-                    "KV": {"Verb": verb, "Key": key},
+            payload[key] = {
+                "KV": {"Verb": verb, "Key": key},
+            }
+        await self._txn(payload)
+
+    async def _kv_atomic_replace(self, to_set, to_delete):
+        payload = {}
+        for key, value in to_set.items():
+            payload[key] = {
+                "KV": {
+                    "Verb": "set",
+                    "Key": key,
+                    "Value": base64.b64encode(value.encode()).decode(),
                 }
-            )
-        status, response = await self.consul.txn.put(payload=payload)
-        # check response?
+            }
+        for key in to_delete:
+            payload[key] = {"KV": {"Verb": "delete", "Key": key}}
+        await self._txn(payload)
 
     async def _kv_get_tree(self, prefix):
         response = await self.consul.txn.put(
@@ -179,3 +211,41 @@ class TraefikConsulProxy(TKvProxy):
             for item in response["Results"]
         ]
         return self.unflatten_dict_from_kv(kv_list, root_key=prefix)
+
+    async def _kv_get(self, key):
+        index, item = await self.consul.kv.get(key)
+        if item is None or item["Value"] is None:
+            return None
+        return item["Value"].decode("utf8")
+
+    async def _kv_watch_tree(self, prefix):
+        """Watch all keys under prefix with consul blocking queries
+
+        Each query returns every key under prefix once any of them changes,
+        so the changes are found by comparing each key's ModifyIndex with the last result.
+        """
+        index, items = await self.consul.kv.get(prefix, recurse=True)
+        modify_index = {item["Key"]: item["ModifyIndex"] for item in items or []}
+        yield []
+        while True:
+            new_index, items = await self.consul.kv.get(
+                prefix, recurse=True, index=index
+            )
+            # the index may go backwards (e.g. consul was restarted)
+            # in which case it must be reset
+            # https://developer.hashicorp.com/consul/api-docs/features/blocking
+            # indexes are returned as strings (the X-Consul-Index header)
+            index = 0 if int(new_index) < int(index) else int(new_index)
+            changes = []
+            last_modify_index = modify_index
+            modify_index = {}
+            for item in items or []:
+                key = item["Key"]
+                modify_index[key] = item["ModifyIndex"]
+                if last_modify_index.get(key) != item["ModifyIndex"]:
+                    value = (item["Value"] or b"").decode("utf8")
+                    changes.append((key, value))
+            for key in last_modify_index.keys() - modify_index.keys():
+                changes.append((key, None))
+            if changes:
+                yield changes
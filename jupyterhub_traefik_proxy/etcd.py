@@ -18,11 +18,12 @@ Route Specification:
 # Copyright (c) Jupyter Development Team.
 # Distributed under the terms of the Modified BSD License.
 
+import asyncio
 from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
 from tornado.concurrent import run_on_executor
-from traitlets import Any, Dict, Unicode, default
+from traitlets import Any, Dict, Integer, Unicode, default
 
 from .kv_proxy import TKvProxy
 from .traefik_utils import deep_merge
@@ -40,6 +41,20 @@ class TraefikEtcdProxy(TKvProxy):
         help="""Extra keyword arguments to pass to the etcd Python client constructor""",
     )
 
+    etcd_max_txn_ops = Integer(
+        128,
+        config=True,
+        help="""The maximum number of operations in a single etcd transaction
+
+        Should match etcd's `--max-txn-ops` (default: 128).
+        Larger updates (e.g. batches of routes) are split
+        into several transactions, each route's keys in the same one,
+        so they are atomic per route.
+
+        .. versionadded:: 2.2
+        """,
+    )
+
     @default("executor")
     def _default_executor(self):
         return ThreadPoolExecutor(1)
@@ -114,6 +129,20 @@ class TraefikEtcdProxy(TKvProxy):
             raise RuntimeError(f"etcd transaction failed: {status}: {response}")
         return response
 
+    async def _etcd_transactions(self, actions):
+        """Run actions (a dict by key) in transactions of at most etcd_max_txn_ops
+
+        etcd limits the number of operations per transaction,
+        so large updates are split into several transactions,
+        keeping each route's keys in the same one.
+        """
+        responses = []
+        for keys in self._transaction_chunks(actions, self.etcd_max_txn_ops):
+            responses.extend(
+                await self._etcd_transaction([actions[key] for key in keys])
+            )
+        return responses
+
     @run_on_executor
     def _etcd_get(self, key):
         value, _ = self.etcd.get(key)
@@ -126,6 +155,14 @@ class TraefikEtcdProxy(TKvProxy):
         data = list(self.etcd.get_prefix(prefix))
         return data
 
+    @run_on_executor
+    def _etcd_add_watch_prefix_callback(self, prefix, callback):
+        return self.etcd.add_watch_prefix_callback(prefix, callback)
+
+    @run_on_executor
+    def _etcd_cancel_watch(self, watch_id):
+        self.etcd.cancel_watch(watch_id)
+
     # key-value generic methods
 
     async def _kv_get_tree(self, prefix):
@@ -135,26 +172,78 @@ class TraefikEtcdProxy(TKvProxy):
         ]
         return self.unflatten_dict_from_kv(keys_values, root_key=prefix)
 
+    async def _kv_get(self, key):
+        value = await self._etcd_get(key)
+        if value is None:
+            return None
+        return value.decode("utf8")
+
+    async def _kv_watch_tree(self, prefix):
+        """Watch all keys under prefix with an etcd watch
+
+        etcd calls the watch callback from its own thread,
+        so responses are passed to the event loop through a queue.
+        """
+        from etcd3.events import DeleteEvent
+
+        loop = asyncio.get_running_loop()
+        responses = asyncio.Queue()
+
+        def callback(response):
+            loop.call_soon_threadsafe(responses.put_nowait, response)
+
+        watch_id = await self._etcd_add_watch_prefix_callback(prefix, callback)
+        try:
+            yield []
+            while True:
+                response = await responses.get()
+                if isinstance(response, Exception):
+                    raise response
+                changes = []
+                for event in response.events:
+                    key = event.key.decode("utf8")
+                    if isinstance(event, DeleteEvent):
+                        changes.append((key, None))
+                    else:
+                        changes.append((key, event.value.decode("utf8")))
+                if changes:
+                    yield changes
+        finally:
+            try:
+                await self._etcd_cancel_watch(watch_id)
+            except Exception as e:
+                self.log.debug("Error cancelling etcd watch on %s: %s", prefix, e)
+
     async def _kv_atomic_set(self, to_set):
-        transactions = []
+        transactions = {}
+        for k, v in to_set.items():
+            transactions[k] = self.etcd.transactions.put(k, v)
+        await self._etcd_transactions(transactions)
+
+    async def _kv_atomic_replace(self, to_set, to_delete):
+        transactions = {}
         for k, v in to_set.items():
-            transactions.append(self.etcd.transactions.put(k, v))
-        await self._etcd_transaction(transactions)
+            transactions[k] = self.etcd.transactions.put(k, v)
+        for key in to_delete:
+            transactions[key] = self.etcd.transactions.delete(key)
+        await self._etcd_transactions(transactions)
 
     async def _kv_atomic_delete(self, *keys):
         """Delete one or more keys from the kv store"""
+        from etcd3.utils import prefix_range_end
 
-        transactions = []
+        transactions = {}
         delete = self.etcd.transactions.delete
 
         for key in keys:
             if key.endswith(self.kv_separator):
-                # it's a tree, we have to list sub-keys to delete them atomically
-                for _, meta in await self._etcd_get_prefix(key):
-                    transactions.append(delete(meta.key))
+                # it's a tree, delete the whole range of keys under the prefix
+                # in the same transaction, without listing them first
+                range_end = prefix_range_end(key.encode("utf8"))
+                transactions[key] = delete(key, range_end=range_end)
             else:
-                transactions.append(delete(key))
-        await self._etcd_transaction(transactions)
+                transactions[key] = delete(key)
+        await self._etcd_transactions(transactions)
 
     # traefik + etcd methods
     def _setup_traefik_static_config(self):
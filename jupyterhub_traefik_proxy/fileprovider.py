@@ -19,14 +19,42 @@ Route Specification:
 # Distributed under the terms of the Modified BSD License.
 
 import asyncio
+import json
 import os
+import sys
+import zlib
+from collections import defaultdict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 from itertools import chain
+from types import MappingProxyType
 
-from traitlets import Any, Unicode, default, observe
+from tornado.concurrent import run_on_executor
+from traitlets import (
+    Any,
+    Bool,
+    Dict,
+    Enum,
+    Float,
+    Integer,
+    List,
+    Unicode,
+    default,
+    observe,
+)
 
 from . import traefik_utils
 from .proxy import TraefikProxy
 
+# sections of the dynamic config with one entry per route,
+# which are split across shards in directory mode
+_route_sections = {
+    ("http", "routers"),
+    ("http", "services"),
+    ("jupyterhub", "routes"),
+}
+
 
 class TraefikFileProviderProxy(TraefikProxy):
     """JupyterHub Proxy implementation using traefik and toml or yaml config file"""
@@ -38,30 +66,502 @@ class TraefikFileProviderProxy(TraefikProxy):
     def _default_mutex(self):
         return asyncio.Lock()
 
+    # serializing and writing the dynamic config happens in a background thread.
+    # A single thread ensures writes complete in order.
+    executor = Any()
+
+    @default("executor")
+    def _default_executor(self):
+        return ThreadPoolExecutor(1)
+
+    dynamic_config_flush_interval = Float(
+        0,
+        config=True,
+        help="""Minimum interval (in seconds) between writes of the dynamic config file(s).
+
+        By default (0), every change to the routing table is written to disk on its own.
+        If set, changes are applied in memory right away,
+        and a single writer flushes all pending changes to disk
+        at most once per interval.
+        Every change included in a flush completes when that flush does.
+
+        This reduces the number of file writes (and traefik reloads)
+        when many routes are added or removed at once,
+        at the cost of up to `dynamic_config_flush_interval` of extra latency
+        for each change.
+
+        .. versionadded:: 2.2
+        """,
+    )
+
+    # futures for callers waiting for the next flush
+    _flush_waiters = List()
+    # shards to write in the next flush (None for all)
+    _flush_dirty = Any()
+
+    @default("_flush_dirty")
+    def _default_flush_dirty(self):
+        return set()
+
+    _flush_task = Any()
+    _last_flush = Float(0)
+
+    dynamic_config_fsync = Bool(
+        False,
+        config=True,
+        help="""Flush the dynamic config file(s) to disk on every write.
+
+        By default, files are replaced atomically, but not synced to disk,
+        so after a crash of the machine they may be empty or out of date,
+        and all routes have to be restored by JupyterHub's `check_routes`.
+        If set, each file and its directory are synced before a write completes.
+
+        Writes are then group-committed:
+        all changes made while a write is in progress are written (and synced) together
+        by the next one, so concurrent changes share the cost of syncing.
+        See also `dynamic_config_flush_interval`.
+
+        .. versionadded:: 2.2
+        """,
+    )
+
     dynamic_config_file = Unicode(
         "rules.toml", config=True, help="""traefik's dynamic configuration file"""
     )
 
+    dynamic_config_replicas = List(
+        Unicode(),
+        config=True,
+        help="""Additional copies of the dynamic config to write, for traefik replicas.
+
+        When several traefik instances serve the same routes,
+        each needs its own copy of the dynamic config,
+        e.g. on a volume local to each of them.
+        Every write of the dynamic config is serialized once
+        and written to all copies in parallel,
+        and only completes when all of them have been written.
+
+        Paths of copies of `dynamic_config_file`,
+        or of directories if `dynamic_config_directory` is set.
+        See also `traefik_api_urls`, to wait for routes to be ready in every replica.
+
+        .. versionadded:: 2.2
+        """,
+    )
+
+    _replica_executor = Any()
+
+    @default("_replica_executor")
+    def _default_replica_executor(self):
+        return ThreadPoolExecutor(len(self.dynamic_config_replicas) + 1)
+
+    dynamic_config_directory = Unicode(
+        "",
+        config=True,
+        help="""Directory for traefik's dynamic configuration, split across several files.
+
+        If set, traefik's file provider is configured with `providers.file.directory`
+        instead of `providers.file.filename`.
+        Routes are spread over `dynamic_config_shards` files
+        by a hash of their routing alias,
+        and all other dynamic configuration (the api router, TLS, etc.)
+        is stored in its own file.
+        Adding or removing a route then rewrites only one small file,
+        which traefik re-parses on its own,
+        instead of the whole routing table.
+
+        The file format (toml or yaml) is taken from the extension of `dynamic_config_file`,
+        whose path is otherwise ignored.
+        Only files managed by the proxy should be stored in this directory.
+
+        .. versionadded:: 2.2
+        """,
+    )
+
+    dynamic_config_shards = Integer(
+        16,
+        config=True,
+        help="""Number of route files to use when `dynamic_config_directory` is set.
+
+        More shards means smaller files to rewrite on each change.
+
+        .. versionadded:: 2.2
+        """,
+    )
+
+    # shard index -> set of route ids (escaped routespecs) stored in that shard
+    _shard_routes = Dict()
+
+    @default("_shard_routes")
+    def _default_shard_routes(self):
+        return defaultdict(set)
+
+    dynamic_config_encoder = Enum(
+        ["auto"] + list(traefik_utils.encoders),
+        default_value=None,
+        allow_none=True,
+        config=True,
+        help="""Serializer used for writing the dynamic config file(s).
+
+        By default, toml files are written with the `toml` package
+        and yaml files with `ruamel.yaml`, which are both slow with many routes.
+
+        - toml files: `toml`, `rtoml`, `pytomlpp` or `tomli_w`
+          (`rtoml` and `pytomlpp` are compiled, and much faster).
+        - yaml files: `ruamel`, or `json`, which writes the file as JSON,
+          which is valid YAML, using only the standard library.
+        - `auto` picks the fastest installed encoder for the file format.
+
+        .. versionadded:: 2.2
+        """,
+    )
+
     dynamic_config_handler = Any()
 
     @default("dynamic_config_handler")
     def _default_handler(self):
-        return traefik_utils.TraefikConfigFileHandler(self.dynamic_config_file)
+        return traefik_utils.TraefikConfigFileHandler(
+            self.dynamic_config_file, encoder=self.dynamic_config_encoder
+        )
 
     # If dynamic_config_file is changed, then update the dynamic config file handler
-    @observe("dynamic_config_file")
+    @observe("dynamic_config_file", "dynamic_config_encoder")
     def _set_dynamic_config_file(self, change):
         self.dynamic_config_handler = traefik_utils.TraefikConfigFileHandler(
-            self.dynamic_config_file
+            self.dynamic_config_file, encoder=self.dynamic_config_encoder
         )
+        self._fragment_cache = self._default_fragment_cache()
 
-    @default("dynamic_config")
-    def _load_dynamic_config(self):
+    cache_route_fragments = Bool(
+        False,
+        config=True,
+        help="""Cache the serialized toml or yaml of each route.
+
+        When writing the dynamic config file(s),
+        only new or changed routes are serialized,
+        and the file is assembled from the cached text of the others,
+        which is much faster than serializing the whole config when there are many routes.
+        Route entries in `dynamic_config` must not be modified in place,
+        or the cached text will be out of date.
+
+        .. versionadded:: 2.2
+        """,
+    )
+
+    compact_route_table = Bool(
+        False,
+        config=True,
+        help="""Store routes in memory as compact records.
+
+        Each route's router, service and jupyterhub entries are kept
+        as small read-only records instead of trees of dicts and lists,
+        which uses much less memory with many routes.
+        They are converted back to dicts when serialized.
+        Code that modifies route entries in `dynamic_config`
+        or expects them to be dicts must not enable this.
+
+        .. versionadded:: 2.2
+        """,
+    )
+
+    _fragment_cache = Any()
+
+    @default("_fragment_cache")
+    def _default_fragment_cache(self):
+        return traefik_utils.ConfigFragmentCache(
+            self.dynamic_config_handler, _route_sections
+        )
+
+    @observe("dynamic_config")
+    def _dynamic_config_changed(self, change):
+        # cached fragments are only valid for the config they were rendered from
+        self._fragment_cache.clear()
+
+    @property
+    def _dynamic_config_ext(self):
+        return self.dynamic_config_file.rsplit(".", 1)[-1]
+
+    @property
+    def _base_config_file(self):
+        return os.path.join(
+            self.dynamic_config_directory, f"base.{self._dynamic_config_ext}"
+        )
+
+    def _shard_file(self, shard):
+        return os.path.join(
+            self.dynamic_config_directory,
+            f"routes-{shard:03d}.{self._dynamic_config_ext}",
+        )
+
+    def _route_shard(self, route_id):
+        return zlib.crc32(route_id.encode("utf8")) % self.dynamic_config_shards
+
+    @staticmethod
+    def _route_id(key_path):
+        """Return the route id for a key path in the dynamic config
+
+        Route keys are `http.routers.router_{id}`, `http.services.service_{id}`
+        and `jupyterhub.routes.router_{id}`, where id is the escaped routespec,
+        so a route's router, service and metadata always share a shard.
+
+        Returns None for keys that aren't specific to one route.
+        """
+        if len(key_path) < 3 or tuple(key_path[:2]) not in _route_sections:
+            return None
+        kind, sep, route_id = key_path[2].partition("_")
+        if sep and kind in {"router", "service"}:
+            return route_id
+        return None
+
+    @staticmethod
+    def _config_key_paths(config):
+        """Yield the key paths in a (partial) dynamic config that select shards
+
+        Route entries are yielded individually,
+        everything else at the top level of its section.
+        """
+        for key, value in config.items():
+            if key in {"http", "jupyterhub"} and isinstance(value, dict):
+                for section, entries in value.items():
+                    if (key, section) in _route_sections:
+                        for alias in entries:
+                            yield [key, section, alias]
+                    else:
+                        yield [key, section]
+            else:
+                yield [key]
+
+    def _dirty_shards(self, key_paths):
+        """Return the set of files to rewrite after changing `key_paths`
+
+        Shards are identified by index, the base config file by None.
+        Also records new routes in their shard.
+        """
+        dirty = set()
+        for key_path in key_paths:
+            route_id = self._route_id(key_path)
+            if route_id is None:
+                dirty.add(None)
+            else:
+                shard = self._route_shard(route_id)
+                self._shard_routes[shard].add(route_id)
+                dirty.add(shard)
+        return dirty
+
+    def _load_dynamic_config_directory(self):
+        """Load and merge all dynamic config files in dynamic_config_directory"""
+        dynamic_config = {}
+        for path in self._dynamic_config_paths():
+            handler = traefik_utils.TraefikConfigFileHandler(path)
+            dynamic_config = traefik_utils.deep_merge(
+                dynamic_config, handler.load() or {}
+            )
+        return dynamic_config
+
+    dynamic_config_cache_file = Unicode(
+        "",
+        config=True,
+        help="""Path to a cache of the parsed dynamic config, to speed up startup.
+
+        Loading a dynamic config file with many routes left over from a previous run
+        can take a long time.
+        If set, the parsed config is also saved in this (JSON) file after each write,
+        along with the size and modification time of the dynamic config file(s).
+        When the proxy starts and the dynamic config files haven't changed,
+        the cache is loaded instead of parsing them.
+
+        .. versionadded:: 2.2
+        """,
+    )
+
+    route_metadata_file = Unicode(
+        "",
+        config=True,
+        help="""File for storing JupyterHub's route metadata, separately from traefik's config.
+
+        By default, JupyterHub's information about each route
+        (routespec, target and data)
+        is stored in the dynamic config file(s) traefik reads,
+        so traefik must parse (and ignore) it every time it reloads.
+        If set, it is stored in this file instead,
+        written along with each update of the dynamic config.
+
+        Either a JSON file (`.json`) or a sqlite database (`.sqlite`),
+        where only changed routes are written.
+
+        .. versionadded:: 2.2
+        """,
+    )
+
+    _route_metadata_store = Any()
+
+    @default("_route_metadata_store")
+    def _default_route_metadata_store(self):
+        if not self.route_metadata_file:
+            return None
+        return traefik_utils.route_metadata_store(self.route_metadata_file)
+
+    def _snapshot_route_metadata(self):
+        """Snapshot the jupyterhub config for the route metadata store"""
+        return {
+            section: dict(entries)
+            for section, entries in self.dynamic_config["jupyterhub"].items()
+        }
+
+    # Read-only snapshot of the routes as of the last completed write,
+    # published by _persist_dynamic_config.
+    # Reads use this without taking the mutex,
+    # so they never wait for writers and never see uncommitted changes.
+    # Route entries are never modified in-place (see _copy_route_entries).
+    _committed_routes = Any()
+
+    @default("_committed_routes")
+    def _default_committed_routes(self):
+        return MappingProxyType(dict(self.dynamic_config["jupyterhub"]["routes"]))
+
+    _snapshot_seq = Integer(0)
+    _committed_seq = Integer(0)
+
+    dynamic_config_watch_interval = Float(
+        0,
+        config=True,
+        help="""Interval (in seconds) for checking the dynamic config file(s) for external changes.
+
+        By default (0), the dynamic config is only read from disk on startup,
+        so changes made by another process
+        (e.g. another JupyterHub or a manual edit, when `should_start` is False)
+        are not seen, and are overwritten by the next change made by this proxy.
+        If set, the size and modification time of the file(s) are checked every interval.
+        Only files that were changed by someone else are loaded,
+        and the routes and other entries that changed
+        since they were last written by this proxy
+        are merged into the in-memory routing table.
+        Where both have changed the same entry, this proxy's version is kept.
+
+        .. versionadded:: 2.2
+        """,
+    )
+
+    _watch_task = Any()
+    # path -> the config last written to (or read from) each dynamic config file,
+    # and its [size, mtime] afterwards, for detecting external changes.
+    # Only used in self.executor
+    _watched_configs = Dict()
+    _watched_stat = Dict()
+
+    _load_cache_fragments = Any()
+
+    @default("_load_cache_fragments")
+    def _default_load_cache_fragments(self):
+        return traefik_utils.ConfigFragmentCache(
+            traefik_utils.TraefikConfigFileHandler(self.dynamic_config_cache_file),
+            _route_sections,
+        )
+
+    def _dynamic_config_paths(self):
+        """Return the paths of the dynamic config files on disk"""
+        if not self.dynamic_config_directory:
+            return [self.dynamic_config_file]
         try:
-            # Load initial dynamic config from disk
-            dynamic_config = self.dynamic_config_handler.load()
+            fnames = sorted(os.listdir(self.dynamic_config_directory))
         except FileNotFoundError:
-            dynamic_config = {}
+            return []
+        return [
+            os.path.join(self.dynamic_config_directory, fname)
+            for fname in fnames
+            if fname.endswith("." + self._dynamic_config_ext)
+        ]
+
+    def _dynamic_config_stat(self):
+        """Return {path: [size, mtime]} for the dynamic config files, to validate the cache"""
+        stat = {}
+        for path in self._dynamic_config_paths():
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            stat[path] = [st.st_size, st.st_mtime_ns]
+        return stat
+
+    def _read_load_cache(self, stat):
+        """Read the cached dynamic config, if it matches the files on disk
+
+        Returns None if there is no valid cache.
+        """
+        try:
+            with open(self.dynamic_config_cache_file, encoding="utf8") as f:
+                header = json.loads(f.readline())
+                if header.get("files") != stat:
+                    self.log.debug("Dynamic config has changed, not using cache")
+                    return None
+                return json.loads(f.read())
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            self.log.warning(
+                f"Ignoring invalid dynamic config cache {self.dynamic_config_cache_file}: {e}"
+            )
+            return None
+
+    def _write_load_cache(self, stat, dynamic_config):
+        """Save the parsed dynamic config, with the stat of the files it matches"""
+        try:
+            with traefik_utils.atomic_writing(self.dynamic_config_cache_file) as f:
+                f.write(json.dumps({"files": stat}) + "\n")
+                f.write(self._load_cache_fragments.render(dynamic_config))
+        except Exception as e:
+            self.log.warning(
+                f"Failed to write dynamic config cache {self.dynamic_config_cache_file}: {e}"
+            )
+
+    def _read_dynamic_config(self):
+        """Read the dynamic config from disk
+
+        Uses dynamic_config_cache_file, if possible.
+        Only does I/O, so it may be called in a background thread.
+        """
+        stat = None
+        if self.dynamic_config_cache_file:
+            stat = self._dynamic_config_stat()
+            if stat:
+                dynamic_config = self._read_load_cache(stat)
+                if dynamic_config is not None:
+                    self.log.info(
+                        f"Loaded dynamic config from cache {self.dynamic_config_cache_file}"
+                    )
+                    return self._read_route_metadata(dynamic_config)
+
+        if self.dynamic_config_directory:
+            dynamic_config = self._load_dynamic_config_directory()
+        else:
+            try:
+                # Load initial dynamic config from disk
+                dynamic_config = self.dynamic_config_handler.load() or {}
+            except FileNotFoundError:
+                dynamic_config = {}
+
+        if stat:
+            self._write_load_cache(stat, dynamic_config)
+        return self._read_route_metadata(dynamic_config)
+
+    def _read_route_metadata(self, dynamic_config):
+        """Load the jupyterhub config from route_metadata_file, if set
+
+        If it hasn't been saved yet, any jupyterhub config
+        in the dynamic config files is kept
+        (and moved to the store on the next write).
+        """
+        if self._route_metadata_store is not None:
+            jupyterhub_config = self._route_metadata_store.load()
+            if jupyterhub_config is not None:
+                dynamic_config["jupyterhub"] = jupyterhub_config
+        return dynamic_config
+
+    def _init_dynamic_config(self, dynamic_config):
+        """Prepare dynamic config loaded from disk for use"""
+        if self.dynamic_config_directory:
+            # assign loaded routes to shards
+            self._dirty_shards(self._config_key_paths(dynamic_config))
 
         # fill in default keys
         # use setdefault to ensure these are always fully defined
@@ -71,54 +571,671 @@ class TraefikFileProviderProxy(TraefikProxy):
         http.setdefault("routers", {})
         jupyterhub = dynamic_config.setdefault("jupyterhub", {})
         jupyterhub.setdefault("routes", {})
+        if self.compact_route_table:
+            for top, section in _route_sections:
+                # interned aliases are shared between keys and records
+                dynamic_config[top][section] = {
+                    sys.intern(alias): traefik_utils.compact_route_entry(
+                        (top, section), entry
+                    )
+                    for alias, entry in dynamic_config[top][section].items()
+                }
+        # what's on disk is committed
+        self._committed_routes = MappingProxyType(dict(jupyterhub["routes"]))
         return dynamic_config
 
-    def _persist_dynamic_config(self):
-        """Save the dynamic config file with the current dynamic_config"""
-        # avoid writing empty dicts, which traefik doesn't handle for some reason
-        dynamic_config = self.dynamic_config
-        if (
-            not dynamic_config["http"]["routers"]
-            or not dynamic_config["http"]["services"]
-        ):
-            # traefik can't handle empty dicts, so don't persist them.
-            # But don't _remove_ them from our own config
-            # I think this is a bug in traefik - empty dicts satisfy the spec
-            # use shallow copy, which is cheap but most be done at every level where we modify keys
-            dynamic_config = dynamic_config.copy()
-            dynamic_config["http"] = http = dynamic_config["http"].copy()
-            for key in ("routers", "services"):
-                if not http[key]:
-                    http.pop(key)
-            if not http:
-                dynamic_config.pop("http")
-        self.log.debug("Writing dynamic config %s", dynamic_config)
-        self.dynamic_config_handler.atomic_dump(dynamic_config)
+    @default("dynamic_config")
+    def _load_dynamic_config(self):
+        return self._init_dynamic_config(self._read_dynamic_config())
+
+    async def _load_dynamic_config_async(self):
+        """Load the dynamic config in a background thread, if it isn't loaded yet
 
-    async def _setup_traefik_dynamic_config(self):
-        self.log.info(
-            f"Creating the dynamic configuration file: {self.dynamic_config_file}"
+        Avoids blocking the event loop while parsing a large config on startup.
+        """
+        if self.trait_has_value("dynamic_config"):
+            return
+        dynamic_config = await asyncio.wrap_future(
+            self.executor.submit(self._read_dynamic_config)
         )
+        if not self.trait_has_value("dynamic_config"):
+            self.dynamic_config = self._init_dynamic_config(dynamic_config)
+
+    def _compact_route_entries(self, key_paths):
+        """Replace standard route entries at key_paths with compact records"""
+        if not self.compact_route_table:
+            return
+        for key_path in key_paths:
+            if len(key_path) < 3 or tuple(key_path[:2]) not in _route_sections:
+                continue
+            top, section, alias = key_path[:3]
+            entries = self.dynamic_config.get(top, {}).get(section, {})
+            if alias in entries:
+                entries[alias] = traefik_utils.compact_route_entry(
+                    (top, section), entries[alias]
+                )
+
+    def _copy_route_entries(self, key_paths):
+        """Replace route entries that are about to be modified in-place with copies
+
+        Snapshots being written in the background share route entries
+        with self.dynamic_config, so entries must never be modified in-place.
+        Must be called with self.mutex held.
+        """
+        for key_path in key_paths:
+            if len(key_path) < 3 or tuple(key_path[:2]) not in _route_sections:
+                continue
+            top, section, alias = key_path[:3]
+            entries = self.dynamic_config.get(top, {}).get(section, {})
+            if alias in entries:
+                entry = entries[alias]
+                if isinstance(entry, traefik_utils.RouteRecord):
+                    # records are read-only, modify a dict instead
+                    entries[alias] = entry.to_dict()
+                else:
+                    entries[alias] = deepcopy(entry)
+
+    def _snapshot_config(self, config):
+        """Copy config, so it can be serialized in the background
+
+        Only containers are copied for route sections,
+        whose entries are never modified in-place (see :meth:`_copy_route_entries`).
+        """
+        snapshot = {}
+        for key, value in config.items():
+            if key not in {"http", "jupyterhub"} or not isinstance(value, dict):
+                snapshot[key] = deepcopy(value)
+                continue
+            snapshot[key] = {}
+            for section, entries in value.items():
+                if (key, section) in _route_sections:
+                    snapshot[key][section] = dict(entries)
+                else:
+                    snapshot[key][section] = deepcopy(entries)
+        return snapshot
+
+    def _persist_dynamic_config(self, dirty=None):
+        """Save the dynamic config file with the current dynamic_config
+
+        In directory mode, only the files in `dirty` are rewritten
+        (see :meth:`_dirty_shards`), or all of them if dirty is None.
+
+        Must be called with self.mutex held.
+        A snapshot of the config is taken immediately,
+        and serialized and written to disk in a background thread.
+        Returns a Future that resolves when the write is complete,
+        which need not be awaited with the mutex held.
+        Writes are completed in the order they were requested.
+
+        When the write completes, the routes in the snapshot are published
+        for reads (see :meth:`get_route`).
+        """
+        self._snapshot_seq += 1
+        seq = self._snapshot_seq
+        routes = MappingProxyType(dict(self.dynamic_config["jupyterhub"]["routes"]))
+        write = self._write_dynamic_config(dirty)
+
+        def publish(write):
+            if write.cancelled() or write.exception() is not None:
+                return
+            if seq > self._committed_seq:
+                self._committed_seq = seq
+                self._committed_routes = routes
+
+        # added before returning, so it runs before anyone awaiting the write resumes
+        write.add_done_callback(publish)
+        return write
+
+    def _config_file_snapshots(self, dirty=None):
+        """Snapshot the config to write to each dynamic config file
+
+        Returns a list of (path, config).
+        In directory mode, only the files in `dirty` are included,
+        or all of them if dirty is None.
+        """
+        if self.dynamic_config_directory:
+            if dirty is None:
+                dirty = {None, *range(self.dynamic_config_shards)}
+            files = []
+            for shard in sorted(
+                dirty, key=lambda shard: -1 if shard is None else shard
+            ):
+                if shard is None:
+                    files.append((self._base_config_file, self._base_config()))
+                else:
+                    files.append((self._shard_file(shard), self._shard_config(shard)))
+            return files
+
+        dynamic_config = self._snapshot_config(self.dynamic_config)
+        # traefik can't handle empty dicts, so don't persist them.
+        # But don't _remove_ them from our own config
+        # I think this is a bug in traefik - empty dicts satisfy the spec
+        http = dynamic_config["http"]
+        for key in ("routers", "services"):
+            if not http[key]:
+                http.pop(key)
+        if not http:
+            dynamic_config.pop("http")
+        if self._route_metadata_store is not None:
+            dynamic_config.pop("jupyterhub")
+        return [(self.dynamic_config_file, dynamic_config)]
+
+    def _write_dynamic_config(self, dirty=None):
+        """Snapshot the config to write, and start writing it in the background
+
+        See :meth:`_persist_dynamic_config`.
+        """
+        files = self._config_file_snapshots(dirty)
+        metadata = None
+        if self._route_metadata_store is not None:
+            metadata = self._snapshot_route_metadata()
+        if self.dynamic_config_directory:
+            cache_config = None
+            if self.dynamic_config_cache_file:
+                cache_config = self._snapshot_config(self.dynamic_config)
+            return self._write_config_files(
+                files, cache_config=cache_config, metadata=metadata
+            )
+
+        return self._write_config_files(
+            files,
+            remove_empty=False,
+            cache_config=files[0][1] if self.dynamic_config_cache_file else None,
+            metadata=metadata,
+        )
+
+    def _commit_dynamic_config(self, dirty=None):
+        """Persist changes to the dynamic config
+
+        Must be called with self.mutex held, after changing self.dynamic_config.
+        Returns an awaitable that resolves when the changes are on disk,
+        which need not be awaited with the mutex held.
+
+        With dynamic_config_flush_interval or dynamic_config_fsync,
+        changes are written by the next group flush.
+        """
+        if self.dynamic_config_flush_interval <= 0 and not self.dynamic_config_fsync:
+            return self._persist_dynamic_config(dirty)
+        if dirty is None:
+            self._flush_dirty = None
+        elif self._flush_dirty is not None:
+            self._flush_dirty.update(dirty)
+        f = asyncio.get_running_loop().create_future()
+        self._flush_waiters.append(f)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_dynamic_config())
+        return f
+
+    async def _flush_dynamic_config(self):
+        """Write pending changes, at most once per dynamic_config_flush_interval
+
+        Runs while there are changes waiting to be written.
+        """
+        loop = asyncio.get_running_loop()
+        waiters = []
+        try:
+            while self._flush_waiters:
+                delay = (
+                    self._last_flush + self.dynamic_config_flush_interval - loop.time()
+                )
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                waiters = []
+                try:
+                    async with self.mutex:
+                        waiters, self._flush_waiters = self._flush_waiters, []
+                        dirty, self._flush_dirty = self._flush_dirty, set()
+                        write = self._persist_dynamic_config(dirty)
+                    self._last_flush = loop.time()
+                    self.log.debug(f"Flushing {len(waiters)} dynamic config changes")
+                    await write
+                except Exception as e:
+                    self.log.error(f"Failed to write dynamic config: {e}")
+                    result = e
+                else:
+                    result = None
+                for f in waiters:
+                    if f.done():
+                        # caller gave up waiting
+                        continue
+                    if result is None:
+                        f.set_result(None)
+                    else:
+                        f.set_exception(result)
+        finally:
+            # if the flush was interrupted (e.g. cancelled by _cleanup),
+            # don't leave its callers waiting forever
+            for f in waiters + self._flush_waiters:
+                if not f.done():
+                    f.cancel()
+            self._flush_waiters = []
+
+    @run_on_executor
+    def _write_config_files(
+        self, files, remove_empty=True, cache_config=None, metadata=None
+    ):
+        """Serialize and write dynamic config files
+
+        files is a list of (path, config) snapshots.
+        cache_config, if given, is a snapshot of the whole config
+        to save in dynamic_config_cache_file.
+        metadata, if given, is a snapshot of the jupyterhub config
+        to save in the route metadata store,
+        before the traefik config that refers to it.
+        With dynamic_config_fsync, the directories of all files
+        are synced once, after they have all been written.
+        Runs in self.executor.
+        """
+        fsync = self.dynamic_config_fsync
+        if metadata is not None:
+            self._route_metadata_store.save(metadata, fsync=fsync)
+            if fsync:
+                traefik_utils.fsync_directory(
+                    os.path.dirname(self._route_metadata_store.path)
+                )
+        if self.dynamic_config_directory:
+            for directory in [self.dynamic_config_directory] + list(
+                self.dynamic_config_replicas
+            ):
+                os.makedirs(directory, exist_ok=True)
+        for path, config in files:
+            self._write_config_file(
+                path, config, remove_empty=remove_empty, fsync=fsync
+            )
+        if fsync:
+            for directory in {
+                os.path.dirname(p)
+                for path, config in files
+                for p in [path] + self._replica_paths(path)
+            }:
+                traefik_utils.fsync_directory(directory)
+        if cache_config is not None:
+            self._write_load_cache(self._dynamic_config_stat(), cache_config)
+
+    def _write_config_file(self, path, config, remove_empty=True, fsync=False):
+        """Write one dynamic config file
+
+        With remove_empty, empty sections are dropped,
+        because traefik doesn't handle empty dicts,
+        and files with nothing left in them are removed.
+        With fsync, the file is synced to disk before it replaces `path`.
+        """
+        paths = [path] + self._replica_paths(path)
+        if remove_empty:
+            self._remove_empty_sections(config)
+            if not config:
+                for p in paths:
+                    try:
+                        os.remove(p)
+                    except FileNotFoundError:
+                        pass
+                self._record_written_config(path, config)
+                return
+        self.log.debug("Writing dynamic config file %s", path)
+        if self.cache_route_fragments:
+            text = self._fragment_cache.render(config)
+        else:
+            text = traefik_utils.TraefikConfigFileHandler(
+                path, encoder=self.dynamic_config_encoder
+            ).dumps(self._plain_config(config))
+
+        def write(path):
+            with traefik_utils.atomic_writing(path, fsync=fsync) as f:
+                f.write(text)
+
+        if len(paths) == 1:
+            write(path)
+        else:
+            # serialize once, write all copies in parallel
+            for f in [self._replica_executor.submit(write, p) for p in paths]:
+                f.result()
+        self._record_written_config(path, config)
+
+    def _replica_paths(self, path):
+        """Return the paths of the copies of a dynamic config file in dynamic_config_replicas"""
+        if not self.dynamic_config_replicas:
+            return []
+        if self.dynamic_config_directory:
+            fname = os.path.basename(path)
+            return [
+                os.path.join(directory, fname)
+                for directory in self.dynamic_config_replicas
+            ]
+        if path == self.dynamic_config_file:
+            return list(self.dynamic_config_replicas)
+        return []
+
+    @staticmethod
+    def _remove_empty_sections(config):
+        """Remove empty sections from a config snapshot, in-place"""
+        for key in list(config):
+            if isinstance(config[key], dict):
+                config[key] = {k: v for k, v in config[key].items() if v != {}}
+            if config[key] == {}:
+                config.pop(key)
+
+    @staticmethod
+    def _plain_config(config):
+        """Return a copy of a config snapshot with route records replaced by dicts"""
+        config = dict(config)
+        for top, value in config.items():
+            if not isinstance(value, dict):
+                continue
+            config[top] = value = dict(value)
+            for section, entries in value.items():
+                if (top, section) in _route_sections:
+                    value[section] = {
+                        alias: traefik_utils.plain_route_entry(entry)
+                        for alias, entry in entries.items()
+                    }
+        return config
+
+    def _record_written_config(self, path, config):
+        """Record the config in a dynamic config file, to detect external changes
+
+        Runs in self.executor, right after the file is written.
+        """
+        if self.dynamic_config_watch_interval <= 0:
+            return
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self._watched_configs.pop(path, None)
+            self._watched_stat.pop(path, None)
+        else:
+            self._watched_configs[path] = config
+            self._watched_stat[path] = [st.st_size, st.st_mtime_ns]
+
+    def _read_external_changes(self):
+        """Load the dynamic config files changed since we last wrote them
+
+        Only files whose size or modification time changed are loaded.
+        Returns a list of (path, config last written, config now on disk).
+        Runs in self.executor, so it never sees a partial write of our own.
+        """
+        stat = self._dynamic_config_stat()
+        changes = []
+        for path in sorted(stat.keys() | self._watched_stat.keys()):
+            if stat.get(path) == self._watched_stat.get(path):
+                continue
+            if path in stat:
+                try:
+                    config = traefik_utils.TraefikConfigFileHandler(path).load() or {}
+                except FileNotFoundError:
+                    config = {}
+                except Exception as e:
+                    # may be in the middle of being written, try again next time
+                    self.log.warning(f"Failed to load dynamic config file {path}: {e}")
+                    continue
+                self._watched_stat[path] = stat[path]
+            else:
+                config = {}
+                self._watched_stat.pop(path)
+            changes.append((path, self._watched_configs.get(path, {}), config))
+            self._watched_configs[path] = config
+        return changes
+
+    def _config_entries(self, config):
+        """Return {key_path: value} for the entries in a (partial) dynamic config"""
+        entries = {}
+        for key_path in self._config_key_paths(config):
+            value = config
+            for key in key_path:
+                value = value[key]
+            entries[tuple(key_path)] = value
+        return entries
+
+    def _merge_external_changes(self, changes):
+        """Merge changes made by someone else into self.dynamic_config
+
+        changes is a list of (path, config last written, config now on disk),
+        from :meth:`_read_external_changes`.
+        Entries changed on disk are applied,
+        unless they have also been changed in memory since they were last written,
+        in which case ours are kept (and will be written).
+        Must be called with self.mutex held.
+
+        Returns the list of key paths that changed.
+        """
+        missing = object()
+        changed = []
+        for path, written, on_disk in changes:
+            self.log.info(f"Merging external changes to dynamic config file {path}")
+            written = self._config_entries(written)
+            on_disk = self._config_entries(on_disk)
+            for key_path in written.keys() | on_disk.keys():
+                before = written.get(key_path, missing)
+                after = on_disk.get(key_path, missing)
+                if after is before or after == before:
+                    continue
+                parent = self.dynamic_config
+                for key in key_path[:-1]:
+                    parent = parent.setdefault(key, {})
+                current = parent.get(key_path[-1], missing)
+                if not (current is before or current == before):
+                    self.log.warning(
+                        f"Dynamic config {'.'.join(key_path)} changed in {path}"
+                        " and in memory, keeping ours"
+                    )
+                    continue
+                if after is missing:
+                    parent.pop(key_path[-1], None)
+                elif len(key_path) == 3:
+                    # route entries are never modified in-place
+                    parent[key_path[-1]] = after
+                else:
+                    parent[key_path[-1]] = deepcopy(after)
+                changed.append(list(key_path))
+
+        if not changed:
+            return changed
+        self._compact_route_entries(changed)
+        self._fragment_cache.invalidate(changed)
+        if self.dynamic_config_directory:
+            # record new routes in their shards
+            self._dirty_shards(changed)
+        # external changes are already on disk, so they are committed
+        routes = self.dynamic_config["jupyterhub"]["routes"]
+        committed = dict(self._committed_routes)
+        for key_path in changed:
+            if key_path[:2] != ["jupyterhub", "routes"]:
+                continue
+            alias = key_path[2]
+            if alias in routes:
+                committed[alias] = routes[alias]
+            else:
+                committed.pop(alias, None)
+        self._committed_routes = MappingProxyType(committed)
+        return changed
+
+    def _init_watched_configs(self, files):
+        """Record the config in files we haven't written since they were loaded
+
+        Runs in self.executor.
+        """
+        stat = self._dynamic_config_stat()
+        for path, config in files:
+            if path in self._watched_stat or path not in stat:
+                continue
+            self._remove_empty_sections(config)
+            self._watched_configs[path] = config
+            self._watched_stat[path] = stat[path]
+
+    async def _watch_dynamic_config(self):
+        """Check for external changes every dynamic_config_watch_interval"""
+        await self._load_dynamic_config_async()
+        async with self.mutex:
+            files = self._config_file_snapshots()
+        await asyncio.wrap_future(
+            self.executor.submit(self._init_watched_configs, files)
+        )
+        while True:
+            await asyncio.sleep(self.dynamic_config_watch_interval)
+            try:
+                changes = await asyncio.wrap_future(
+                    self.executor.submit(self._read_external_changes)
+                )
+                if changes:
+                    async with self.mutex:
+                        self._merge_external_changes(changes)
+            except Exception as e:
+                self.log.error(f"Failed to check dynamic config for changes: {e}")
+
+    def _start_watching(self):
+        if self.dynamic_config_watch_interval > 0 and self._watch_task is None:
+            self._watch_task = asyncio.ensure_future(self._watch_dynamic_config())
+
+    def _base_config(self):
+        """Snapshot all config that's not specific to a single route"""
+        base_config = {}
+        for key, value in self.dynamic_config.items():
+            if key == "jupyterhub" and self._route_metadata_store is not None:
+                continue
+            if key not in {"http", "jupyterhub"}:
+                base_config[key] = value
+                continue
+            base_config[key] = section_config = {}
+            for section, entries in value.items():
+                if (key, section) in _route_sections:
+                    entries = {
+                        alias: entry
+                        for alias, entry in entries.items()
+                        if self._route_id([key, section, alias]) is None
+                    }
+                section_config[section] = entries
+        return self._snapshot_config(base_config)
+
+    def _shard_config(self, shard):
+        """Snapshot the routes of one shard"""
+        http = self.dynamic_config["http"]
+        jupyterhub_routes = self.dynamic_config["jupyterhub"]["routes"]
+        routers = {}
+        services = {}
+        routes = {}
+        route_ids = self._shard_routes[shard]
+        for route_id in list(route_ids):
+            router_alias = f"router_{route_id}"
+            service_alias = f"service_{route_id}"
+            found = False
+            if router_alias in http["routers"]:
+                routers[router_alias] = http["routers"][router_alias]
+                found = True
+            if service_alias in http["services"]:
+                services[service_alias] = http["services"][service_alias]
+                found = True
+            if router_alias in jupyterhub_routes:
+                routes[router_alias] = jupyterhub_routes[router_alias]
+                found = True
+            if not found:
+                # route was deleted
+                route_ids.discard(route_id)
+        shard_config = {"http": {"routers": routers, "services": services}}
+        if self._route_metadata_store is None:
+            shard_config["jupyterhub"] = {"routes": routes}
+        return shard_config
+
+    def _managed_config_files(self):
+        """All files that may be written in directory mode"""
+        return [self._base_config_file] + [
+            self._shard_file(shard) for shard in range(self.dynamic_config_shards)
+        ]
+
+    async def _setup_traefik_dynamic_config(self):
+        await self._load_dynamic_config_async()
+        if self.dynamic_config_directory:
+            self.log.info(
+                f"Creating the dynamic configuration directory: {self.dynamic_config_directory}"
+            )
+            os.makedirs(self.dynamic_config_directory, exist_ok=True)
+            # make sure existing config is loaded before removing any files
+            self.dynamic_config
+            # rewrite every file, in case the number of shards has changed,
+            # and remove any leftover files from a previous layout
+            managed = {os.path.basename(path) for path in self._managed_config_files()}
+            for directory in [self.dynamic_config_directory] + list(
+                self.dynamic_config_replicas
+            ):
+                os.makedirs(directory, exist_ok=True)
+                for fname in os.listdir(directory):
+                    path = os.path.join(directory, fname)
+                    if (
+                        fname.endswith("." + self._dynamic_config_ext)
+                        and fname not in managed
+                    ):
+                        self.log.info(f"Removing stale dynamic config file {path}")
+                        os.remove(path)
+            async with self.mutex:
+                write = self._persist_dynamic_config()
+            await write
+        else:
+            self.log.info(
+                f"Creating the dynamic configuration file: {self.dynamic_config_file}"
+            )
         await super()._setup_traefik_dynamic_config()
 
+    async def _delete_api_auth(self):
+        # only what's there, since missing keys are reported
+        key_paths = []
+        for key_path in self._api_auth_keys:
+            parent = self.dynamic_config
+            for key in key_path:
+                if not isinstance(parent, Mapping) or key not in parent:
+                    break
+                parent = parent[key]
+            else:
+                key_paths.append(key_path)
+        if key_paths:
+            await self._delete_dynamic_config(key_paths, ())
+
+    async def start(self):
+        await super().start()
+        self._start_watching()
+
+    async def _start_external(self):
+        await super()._start_external()
+        self._start_watching()
+
     async def _setup_traefik_static_config(self):
-        self.static_config["providers"] = {
-            "file": {"filename": self.dynamic_config_file, "watch": True}
-        }
+        if self.dynamic_config_directory:
+            file_provider = {"directory": self.dynamic_config_directory}
+        else:
+            file_provider = {"filename": self.dynamic_config_file}
+        file_provider["watch"] = True
+        self.static_config["providers"] = {"file": file_provider}
         await super()._setup_traefik_static_config()
 
     def _cleanup(self):
         """Cleanup dynamic config file as well"""
         super()._cleanup()
-        try:
-            os.remove(self.dynamic_config_file)
-        except Exception as e:
-            self.log.error(
-                f"Failed to remove traefik configuration file {self.dynamic_config_file}: {e}"
-            )
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+        if not self.should_start:
+            # an external traefik still reads the dynamic config
+            return
+        if self._route_metadata_store is not None:
+            self._route_metadata_store.remove()
+        if self.dynamic_config_directory:
+            paths = self._managed_config_files()
+        else:
+            paths = [self.dynamic_config_file]
+        paths = [p for path in paths for p in [path] + self._replica_paths(path)]
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                if not self.dynamic_config_directory:
+                    self.log.error(
+                        f"Failed to remove traefik configuration file {path}: not found"
+                    )
+            except Exception as e:
+                self.log.error(
+                    f"Failed to remove traefik configuration file {path}: {e}"
+                )
 
     async def _get_jupyterhub_dynamic_config(self):
-        return self.dynamic_config["jupyterhub"]
+        return {"routes": self._committed_routes}
 
     async def _apply_dynamic_config(self, traefik_config, jupyterhub_config=None):
         dynamic_config = {}
@@ -126,11 +1243,20 @@ class TraefikFileProviderProxy(TraefikProxy):
         # file provider stores jupyterhub info in "jupyterhub" key
         if jupyterhub_config is not None:
             dynamic_config["jupyterhub"] = jupyterhub_config
+        key_paths = list(self._config_key_paths(dynamic_config))
         async with self.mutex:
+            self._copy_route_entries(key_paths)
             self.dynamic_config = traefik_utils.deep_merge(
                 self.dynamic_config, dynamic_config
             )
-            self._persist_dynamic_config()
+            self._compact_route_entries(key_paths)
+            self._fragment_cache.invalidate(key_paths)
+            dirty = None
+            if self.dynamic_config_directory:
+                dirty = self._dirty_shards(key_paths)
+            write = self._commit_dynamic_config(dirty)
+        # wait for the write outside the lock
+        await write
 
     async def _delete_dynamic_config(self, traefik_keys, jupyterhub_keys):
         """Delete keys from dynamic configuration
@@ -139,8 +1265,10 @@ class TraefikFileProviderProxy(TraefikProxy):
         under the 'jupyterhub' key
         """
         jupyterhub_keys = (["jupyterhub"] + key_path for key_path in jupyterhub_keys)
+        key_paths = list(chain(traefik_keys, jupyterhub_keys))
         async with self.mutex:
-            for key_path in chain(traefik_keys, jupyterhub_keys):
+            self._copy_route_entries(key_paths)
+            for key_path in key_paths:
                 parent = self.dynamic_config
                 for key in key_path[:-1]:
                     if key in parent:
@@ -158,7 +1286,12 @@ class TraefikFileProviderProxy(TraefikProxy):
                         f"Missing dynamic config, nothing to delete: {'.'.join(key_path)}"
                     )
 
-            self._persist_dynamic_config()
+            self._fragment_cache.invalidate(key_paths)
+            dirty = None
+            if self.dynamic_config_directory:
+                dirty = self._dirty_shards(key_paths)
+            write = self._commit_dynamic_config(dirty)
+        await write
 
     async def get_route(self, routespec):
         """Return the route info for a given routespec.
@@ -182,12 +1315,12 @@ class TraefikFileProviderProxy(TraefikProxy):
         """
         routespec = self.validate_routespec(routespec)
         router_alias = traefik_utils.generate_alias(routespec, "router")
-        async with self.mutex:
-            route = self.dynamic_config["jupyterhub"]["routes"].get(router_alias)
-            if not route:
-                return None
-            return {
-                "routespec": route["routespec"],
-                "data": route["data"],
-                "target": route["target"],
-            }
+        # no lock needed, see _committed_routes
+        route = self._committed_routes.get(router_alias)
+        if not route:
+            return None
+        return {
+            "routespec": route["routespec"],
+            "data": route["data"],
+            "target": route["target"],
+        }
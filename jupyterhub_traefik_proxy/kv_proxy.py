@@ -19,41 +19,26 @@ Route Specification:
 # Distributed under the terms of the Modified BSD License.
 
 import asyncio
+import json
+import time
+from collections import Counter
 from collections.abc import Mapping
-from functools import wraps
+from functools import partial
 from numbers import Number
 
-from traitlets import Unicode
+from traitlets import Any, Bool, Enum, Float, Integer, Unicode, default
 
 from . import traefik_utils
 from .proxy import TraefikProxy
 
 
-def _one_at_a_time(method):
-    """decorator to limit an async method to be called only once
+class _FlatKV(dict):
+    """Config already flattened to full key-value store keys
 
-    If multiple concurrent calls to this method are made,
-    piggy-back on the outstanding call instead of queuing
-    or letting requests pile up.
+    Returned by :meth:`TKvProxy._dynamic_config_for_route`,
+    so route config doesn't need to be flattened again.
     """
 
-    @wraps(method)
-    async def locked_method(*args, **kwargs):
-        if getattr(method, "_shared_future", None) is not None:
-            f = method._shared_future
-            if f.done():
-                method._shared_future = None
-            else:
-                return await f
-
-        method._shared_future = f = asyncio.ensure_future(method(*args, **kwargs))
-        try:
-            return await f
-        finally:
-            method._shared_future = None
-
-    return locked_method
-
 
 class TKvProxy(TraefikProxy):
     """
@@ -81,6 +66,110 @@ class TKvProxy(TraefikProxy):
         help="""The separator used for the path in the KV store""",
     )
 
+    kv_route_format = Enum(
+        ["keys", "json"],
+        default_value="keys",
+        config=True,
+        help="""How JupyterHub's information about each route is stored in the KV store
+
+        - keys (default): one key per field of the route
+          (routespec, target, router, service and each field of its data),
+          under `<kv_jupyterhub_prefix>/routes/<alias>/`.
+        - json: one key per route, `<kv_jupyterhub_prefix>/routes/<alias>`,
+          with the whole route as a JSON value.
+          Many fewer keys to write, read and delete for each route,
+          and data keeps its types (with keys, all values become strings).
+
+        Routes stored in either format can always be read,
+        and existing routes are converted to this format
+        when the proxy starts after it was changed.
+
+        .. versionadded:: 2.2
+        """,
+    )
+
+    kv_route_cache = Bool(
+        False,
+        config=True,
+        help="""Keep a copy of JupyterHub's route table in memory
+
+        When enabled, the routes are read from the KV store when the proxy starts,
+        and the copy is updated by each successful change made by this proxy,
+        so `get_route` and `get_all_routes` don't need to read the KV store.
+
+        Changes made by anything else writing to the same `kv_jupyterhub_prefix`
+        (another hub, admin tools) are only seen when the copy is reloaded,
+        after `kv_route_cache_ttl`.
+
+        .. versionadded:: 2.2
+        """,
+    )
+
+    kv_route_cache_ttl = Float(
+        60,
+        config=True,
+        help="""Seconds after which the in-memory route table is reloaded from the KV store
+
+        Only used with `kv_route_cache = True`.
+        The next read after this long reloads the whole route table.
+        0 means never reload,
+        which is only safe if nothing else writes routes to the same KV store.
+
+        .. versionadded:: 2.2
+        """,
+    )
+
+    kv_route_watch = Bool(
+        False,
+        config=True,
+        help="""Keep the in-memory route table up to date by watching the KV store
+
+        Only used with `kv_route_cache = True`.
+        Instead of reloading the whole route table after `kv_route_cache_ttl`,
+        changes made by anything writing to the same `kv_jupyterhub_prefix`
+        (e.g. another hub, or admin tools) are applied to it as they happen,
+        using etcd watches, redis keyspace notifications or consul blocking queries.
+
+        If the watch fails, the whole route table is reloaded once it's running again,
+        and `kv_route_cache_ttl` applies in the meantime.
+
+        .. versionadded:: 2.2
+        """,
+    )
+
+    # the in-memory route table, by router alias (None if not loaded)
+    _route_cache = Any(None)
+    # when _route_cache was loaded, for kv_route_cache_ttl
+    _route_cache_loaded_at = Float(0)
+    # changes made while the route table is being loaded, to apply after loading
+    _route_cache_changes = Any(None)
+    # counts of reads answered from the route table (hits)
+    # and the reads that needed to load it (misses)
+    _route_cache_stats = Any()
+    # the task applying changes from kv_route_watch
+    _route_watch_task = Any(None)
+    # whether _route_cache is being kept up to date by kv_route_watch
+    _route_watching = Bool(False)
+    # seconds to wait before restarting a failed watch (doubles up to 30)
+    _route_watch_retry_delay = Float(1)
+    # router aliases of routes changed by others, to read again
+    _routes_to_read = Any()
+    # the task reading _routes_to_read
+    _route_read_task = Any(None)
+    # seconds to wait for more changes to the same routes before reading them
+    _route_watch_read_delay = Float(0.01)
+    # incremented when a write to the kv store finishes,
+    # so reads never share a read started before the caller's last write
+    _kv_write_generation = Integer(0)
+
+    @default("_route_cache_stats")
+    def _default_route_cache_stats(self):
+        return Counter()
+
+    @default("_routes_to_read")
+    def _default_routes_to_read(self):
+        return set()
+
     # these should be the only three methods a KV provider needs to define
 
     async def _kv_atomic_set(self, to_set: dict):
@@ -88,6 +177,8 @@ class TKvProxy(TraefikProxy):
 
         Should be done atomically (i.e. in a transaction),
         setting nothing on failure.
+        Stores limiting the size of a transaction may split large updates
+        with `_transaction_chunks`, so they are atomic per route.
 
         Args:
 
@@ -112,19 +203,431 @@ class TKvProxy(TraefikProxy):
         """
         raise NotImplementedError()
 
+    async def _kv_get(self, key):
+        """Return the value of a single key, or None if it isn't set
+
+        Needed for reading routes stored with `kv_route_format = "json"`.
+        """
+        raise NotImplementedError()
+
+    def _kv_watch_tree(self, prefix):
+        """Watch for changes to all keys under prefix
+
+        Should be an async generator, yielding an empty list once the watch is established,
+        then a list of `(key, value)` changes as they happen,
+        with value None for deleted keys.
+
+        Needed for `kv_route_watch`.
+        """
+        raise NotImplementedError()
+
+    def _transaction_group(self, key):
+        """The group of keys that must be changed in the same transaction as key
+
+        All keys of a route (its router, service and jupyterhub record)
+        are in the group of the route.
+        Other keys are grouped by config entry (e.g. one middleware).
+        """
+        sep = self.kv_separator
+        # longest first, in case one prefix contains the other
+        prefixes = sorted(
+            [self.kv_traefik_prefix, self.kv_jupyterhub_prefix], key=len, reverse=True
+        )
+        for prefix in prefixes:
+            if key.startswith(prefix + sep):
+                path = key[len(prefix) + len(sep) :].split(sep)
+                break
+        else:
+            return key
+        if path[0] in {"http", "tcp", "udp"}:
+            # e.g. http/routers/router_<alias>
+            entry = path[:3]
+        else:
+            # e.g. routes/router_<alias>
+            entry = path[:2]
+        name = entry[-1]
+        for kind in ("router_", "service_"):
+            if name.startswith(kind):
+                return name[len(kind) :]
+        return tuple(entry)
+
+    def _transaction_chunks(self, keys, max_ops):
+        """Split keys into chunks of at most max_ops keys, one transaction each
+
+        For stores limiting the number of operations in a transaction.
+        Keys of the same route stay in the same chunk (see `_transaction_group`),
+        so each route is changed atomically, even if the whole update isn't.
+        A route with more than max_ops keys gets a chunk of its own.
+        """
+        groups = {}
+        for key in keys:
+            groups.setdefault(self._transaction_group(key), []).append(key)
+        chunk = []
+        for group in groups.values():
+            if chunk and len(chunk) + len(group) > max_ops:
+                yield chunk
+                chunk = []
+            chunk.extend(group)
+        if chunk:
+            yield chunk
+
     # now: implement methods required by TraefikProxy base class
 
+    def _dynamic_config_for_route(self, routespec, target, data):
+        """Return the flat key-value pairs for a route
+
+        Emits the same keys and values as flattening the nested config
+        from :meth:`TraefikProxy._dynamic_config_for_route`,
+        without building it first.
+        Returns (traefik_config, jupyterhub_config) as `_FlatKV` dicts,
+        which :meth:`_apply_dynamic_config` stores as-is.
+        """
+        sep = self.kv_separator
+        service_alias = traefik_utils.generate_alias(routespec, "service")
+        router_alias = traefik_utils.generate_alias(routespec, "router")
+        router_prefix = sep.join(
+            [self.kv_traefik_prefix, "http", "routers", router_alias]
+        )
+        service_prefix = sep.join(
+            [self.kv_traefik_prefix, "http", "services", service_alias, "loadBalancer"]
+        )
+        traefik_config = _FlatKV(
+            {
+                f"{router_prefix}{sep}service": service_alias,
+                f"{router_prefix}{sep}rule": traefik_utils.generate_rule(routespec),
+                f"{router_prefix}{sep}entryPoints{sep}0": self.traefik_entrypoint,
+                f"{service_prefix}{sep}servers{sep}0{sep}url": target,
+                f"{service_prefix}{sep}passHostHeader": "true",
+            }
+        )
+        route = {
+            "data": data,
+            "routespec": routespec,
+            "target": target,
+            "router": router_alias,
+            "service": service_alias,
+        }
+        return traefik_config, _FlatKV(self._route_kv(router_alias, route))
+
+    def _route_kv(self, router_alias, route):
+        """Return the key-value pairs storing a route's jupyterhub info
+
+        In `kv_route_format`.
+        """
+        sep = self.kv_separator
+        route_key = sep.join([self.kv_jupyterhub_prefix, "routes", router_alias])
+        if self.kv_route_format == "json":
+            return {route_key: json.dumps(route)}
+        return self.flatten_dict_for_kv(route, prefix=route_key)
+
+    @staticmethod
+    def _decode_route(route):
+        """Decode a route read from the KV store, in either format"""
+        if isinstance(route, str):
+            return json.loads(route)
+        return route
+
+    async def _migrate_route_format(self):
+        """Convert routes stored in the other format to kv_route_format
+
+        Called on startup, before any reads.
+        Only needed when kv_route_format has changed since the last start,
+        which is recorded in `<kv_jupyterhub_prefix>/route_format`
+        (routes stored without it are in the "keys" format).
+        Each route's new keys are written and its old keys deleted
+        in the same transaction where the store supports it
+        (see `_kv_atomic_replace`).
+        """
+        sep = self.kv_separator
+        format_key = sep.join([self.kv_jupyterhub_prefix, "route_format"])
+        try:
+            stored_format = await self._kv_get(format_key)
+        except NotImplementedError:
+            # without _kv_get, only the "keys" format can be used
+            return
+        if (stored_format or "keys") == self.kv_route_format:
+            return
+
+        jupyterhub_config = await self._kv_get_tree(self.kv_jupyterhub_prefix)
+        routes = jupyterhub_config.get("routes", {})
+        is_json = self.kv_route_format == "json"
+        to_migrate = {
+            alias: route
+            for alias, route in routes.items()
+            if isinstance(route, str) != is_json
+        }
+        self.log.info(
+            "Converting %i routes to kv_route_format=%r",
+            len(to_migrate),
+            self.kv_route_format,
+        )
+        to_set = {}
+        to_delete = []
+        for alias, route in to_migrate.items():
+            route_key = sep.join([self.kv_jupyterhub_prefix, "routes", alias])
+            if is_json:
+                # the exact keys, so stores that can't delete a prefix
+                # in a transaction can delete them in the same one
+                to_delete.extend(self.flatten_dict_for_kv(route, prefix=route_key))
+            else:
+                to_delete.append(route_key)
+            to_set.update(self._route_kv(alias, self._decode_route(route)))
+        if to_migrate:
+            await self._kv_atomic_replace(to_set, to_delete)
+        await self._kv_atomic_set({format_key: self.kv_route_format})
+
+    async def _kv_atomic_replace(self, to_set, to_delete):
+        """Set some keys and delete others in one transaction
+
+        `to_delete` are full keys, without recursive deletes.
+        Like `_kv_atomic_set`, may be split into transactions per route.
+        By default, keys are set first, then deleted, in two transactions.
+        """
+        await self._kv_atomic_set(to_set)
+        await self._kv_atomic_delete(*to_delete)
+
+    async def start(self):
+        await self._migrate_route_format()
+        await super().start()
+        await self._start_route_cache()
+
+    async def _start_external(self):
+        await self._migrate_route_format()
+        await super()._start_external()
+        await self._start_route_cache()
+
+    def _cleanup(self):
+        self._stop_route_watch()
+        return super()._cleanup()
+
+    # in-memory route table
+
+    async def _start_route_cache(self):
+        if not self.kv_route_cache:
+            return
+        if self.kv_route_watch:
+            await self._start_route_watch()
+        else:
+            await self._load_route_cache()
+
+    async def _load_route_cache(self):
+        """(Re)load the in-memory route table from the KV store
+
+        Changes made while loading may or may not be in what's read,
+        so they are applied again once it's loaded.
+        """
+        self._route_cache_changes = changes = []
+        try:
+            jupyterhub_config = await self._read_jupyterhub_dynamic_config()
+        finally:
+            self._route_cache_changes = None
+        route_cache = dict(jupyterhub_config["routes"])
+        for to_set, to_delete in changes:
+            self._apply_route_cache_change(route_cache, to_set, to_delete)
+        self._route_cache = route_cache
+        self._route_cache_loaded_at = time.monotonic()
+
+    async def _get_route_cache(self):
+        """Return the in-memory route table, loading it if needed"""
+        if self._route_cache is not None and (
+            self._route_watching
+            or not self.kv_route_cache_ttl
+            or time.monotonic() - self._route_cache_loaded_at < self.kv_route_cache_ttl
+        ):
+            self._route_cache_stats["hits"] += 1
+            return self._route_cache
+        self._route_cache_stats["misses"] += 1
+        await self._single_flight.run("load_route_cache", self._load_route_cache)
+        return self._route_cache
+
+    @staticmethod
+    def _apply_route_cache_change(route_cache, to_set, to_delete):
+        route_cache.update(to_set)
+        for alias in to_delete:
+            route_cache.pop(alias, None)
+
+    def _update_route_cache(self, to_set=None, to_delete=()):
+        """Record a successful change to the routes in the KV store
+
+        to_set: dict of routes by alias, to add or replace
+        to_delete: router aliases of deleted routes
+        """
+        to_set = to_set or {}
+        if self._route_cache is not None:
+            self._apply_route_cache_change(self._route_cache, to_set, to_delete)
+        if self._route_cache_changes is not None:
+            self._route_cache_changes.append((to_set, to_delete))
+
+    async def _start_route_watch(self):
+        """Start watching for changes to routes
+
+        The route table is loaded once the watch is established,
+        so no changes are missed.
+        """
+        routes_prefix = self.kv_separator.join(
+            [self.kv_jupyterhub_prefix, "routes", ""]
+        )
+        watch = self._kv_watch_tree(routes_prefix)
+        try:
+            await watch.__anext__()
+            await self._single_flight.run("load_route_cache", self._load_route_cache)
+        except BaseException:
+            await watch.aclose()
+            raise
+        self._route_watching = True
+        self._route_watch_task = asyncio.ensure_future(self._watch_routes(watch))
+
+    def _stop_route_watch(self):
+        """Stop watching for changes to routes"""
+        for task in (self._route_watch_task, self._route_read_task):
+            if task is not None:
+                task.cancel()
+        self._route_watching = False
+
+    async def _watch_routes(self, watch):
+        """Apply changes from a watch to the route table until it fails, then restart it"""
+        try:
+            async for changes in watch:
+                self._apply_route_changes(changes)
+            self.log.error("Watching routes in the KV store stopped")
+        except Exception as e:
+            self.log.error("Watching routes in the KV store failed: %s", e)
+        finally:
+            self._route_watching = False
+            await watch.aclose()
+
+        delay = self._route_watch_retry_delay
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self._start_route_watch()
+            except Exception as e:
+                self.log.error("Failed to restart watching routes: %s", e)
+                delay = min(2 * delay, 30)
+            else:
+                self.log.info("Watching routes in the KV store again")
+                return
+
+    def _apply_route_changes(self, changes):
+        """Apply changes to keys from the watch to the route table
+
+        A route stored as a single key (`kv_route_format = "json"`) has its value in the change.
+        A route stored as one key per field is read again if any field changes,
+        once its changes have settled (see `_read_changed_routes`).
+        """
+        routes_prefix = self.kv_separator.join(
+            [self.kv_jupyterhub_prefix, "routes", ""]
+        )
+        values = {}
+        to_read = set()
+        for key, value in changes:
+            if not key.startswith(routes_prefix):
+                continue
+            alias, sep, _ = key[len(routes_prefix) :].partition(self.kv_separator)
+            if sep:
+                to_read.add(alias)
+            else:
+                values[alias] = value
+        to_set = {}
+        to_delete = []
+        for alias, value in values.items():
+            if alias in to_read:
+                continue
+            self._routes_to_read.discard(alias)
+            if value is None:
+                to_delete.append(alias)
+            else:
+                to_set[alias] = self._decode_route(value)
+        self._update_route_cache(to_set, to_delete)
+        if to_read:
+            self._routes_to_read.update(to_read)
+            if self._route_read_task is None:
+                self._route_read_task = asyncio.ensure_future(
+                    self._read_changed_routes()
+                )
+
+    async def _read_changed_routes(self):
+        """Read routes changed by others again, once per route
+
+        Writing a route stored as one key per field changes many keys,
+        which may arrive as one change each (e.g. redis keyspace notifications).
+        Changes arriving within `_route_watch_read_delay` of each other are merged,
+        so each changed route is read once.
+        """
+        try:
+            while self._routes_to_read:
+                await asyncio.sleep(self._route_watch_read_delay)
+                to_read = list(self._routes_to_read)
+                self._routes_to_read.clear()
+                try:
+                    routes = await asyncio.gather(
+                        *(self._read_route(alias) for alias in to_read)
+                    )
+                except Exception as e:
+                    self.log.error("Failed to read changed routes: %s", e)
+                    self._routes_to_read.update(to_read)
+                    await asyncio.sleep(self._route_watch_retry_delay)
+                    continue
+                to_set = {}
+                to_delete = []
+                for alias, route in zip(to_read, routes):
+                    if route and "routespec" in route and "target" in route:
+                        to_set[alias] = route
+                    else:
+                        # deleted, or not completely written yet
+                        to_delete.append(alias)
+                self._update_route_cache(to_set, to_delete)
+        finally:
+            self._route_read_task = None
+
+    def _routes_in_kv(self, flat_jupyterhub_config):
+        """The routes in a flat jupyterhub config, as they would be read back"""
+        routes_key = self.kv_separator.join([self.kv_jupyterhub_prefix, "routes"])
+        routes = self.unflatten_dict_from_kv(
+            [
+                (key, value)
+                for key, value in flat_jupyterhub_config.items()
+                if key.startswith(routes_key + self.kv_separator)
+            ],
+            root_key=routes_key,
+        )
+        return {alias: self._decode_route(route) for alias, route in routes.items()}
+
+    def _flatten_config(self, config, prefix):
+        """Flatten config for the kv store, unless it already is"""
+        if isinstance(config, _FlatKV):
+            return config
+        return self.flatten_dict_for_kv(config, prefix=prefix)
+
     async def _apply_dynamic_config(self, dynamic_config, jupyterhub_config=None):
         """Apply dynamic config (and optional jupyterhub info) atomically"""
-        to_set = self.flatten_dict_for_kv(dynamic_config, prefix=self.kv_traefik_prefix)
+        to_set = dict(self._flatten_config(dynamic_config, self.kv_traefik_prefix))
         if jupyterhub_config:
-            to_set.update(
-                self.flatten_dict_for_kv(
-                    jupyterhub_config, prefix=self.kv_jupyterhub_prefix
-                )
+            jupyterhub_config = self._flatten_config(
+                jupyterhub_config, self.kv_jupyterhub_prefix
             )
+            to_set.update(jupyterhub_config)
         self.log.debug("Setting key-value config %s", to_set)
-        await self._kv_atomic_set(to_set)
+        try:
+            await self._kv_atomic_set(to_set)
+        finally:
+            self._kv_write_generation += 1
+        if jupyterhub_config and self.kv_route_cache:
+            self._update_route_cache(self._routes_in_kv(jupyterhub_config))
+
+    async def _apply_dynamic_config_batch(self, configs):
+        """Apply a batch of route configs from `_dynamic_config_for_route` at once
+
+        They are already flat, so they are merged without flattening again.
+        """
+        traefik_config = _FlatKV()
+        jupyterhub_config = _FlatKV()
+        for route_traefik_config, route_jupyterhub_config in configs:
+            traefik_config.update(route_traefik_config)
+            jupyterhub_config.update(route_jupyterhub_config)
+        self.log.debug("Applying dynamic config for %i routes", len(configs))
+        async with self.semaphore:
+            await self._apply_dynamic_config(traefik_config, jupyterhub_config)
 
     async def _delete_dynamic_config(self, traefik_keys, jupyterhub_keys):
         """Delete keys from dynamic configuration
@@ -135,21 +638,67 @@ class TKvProxy(TraefikProxy):
             self.kv_separator.join([self.kv_traefik_prefix] + key_path + [""])
             for key_path in traefik_keys
         ]
-        to_delete.extend(
-            self.kv_separator.join([self.kv_jupyterhub_prefix] + key_path + [""])
-            for key_path in jupyterhub_keys
-        )
+        for key_path in jupyterhub_keys:
+            key = self.kv_separator.join([self.kv_jupyterhub_prefix] + key_path)
+            # delete routes stored in either kv_route_format
+            to_delete.extend([key + self.kv_separator, key])
         async with self.semaphore:
             try:
                 await self._kv_atomic_delete(*to_delete)
             except Exception as e:
                 self.log.error("Couldn't delete config %s: %s", to_delete, e)
                 raise
+            finally:
+                self._kv_write_generation += 1
+        if self.kv_route_cache:
+            if all(len(key_path) == 2 for key_path in jupyterhub_keys):
+                self._update_route_cache(
+                    to_delete=[alias for _, alias in jupyterhub_keys]
+                )
+            else:
+                # not just single routes, reload on the next read
+                self._route_cache = None
+
+    async def _get_tree(self, prefix, name="kv_get_tree"):
+        """Read the tree under prefix
+
+        Concurrent reads of the same prefix share a single `_kv_get_tree` call,
+        if no write has finished since it started.
+        `name` labels the reads in `_single_flight`'s counters.
+        """
+        return await self._single_flight.run(
+            name,
+            self._kv_get_tree,
+            prefix,
+            key=(name, self._kv_get_tree, prefix, self._kv_write_generation),
+        )
+
+    async def _get_value(self, key, name="kv_get"):
+        """Read a single key, sharing concurrent reads like :meth:`_get_tree`"""
+        return await self._single_flight.run(
+            name,
+            self._kv_get,
+            key,
+            key=(name, self._kv_get, key, self._kv_write_generation),
+        )
 
-    @_one_at_a_time
     async def _get_jupyterhub_dynamic_config(self):
         """jupyterhub data is in our kv store"""
-        return await self._kv_get_tree(self.kv_jupyterhub_prefix)
+        if self.kv_route_cache:
+            return {"routes": await self._get_route_cache()}
+        return await self._read_jupyterhub_dynamic_config()
+
+    async def _read_jupyterhub_dynamic_config(self):
+        """Read the jupyterhub data from the kv store"""
+        jupyterhub_config = await self._get_tree(
+            self.kv_jupyterhub_prefix, name="get_all_routes"
+        )
+        routes = jupyterhub_config.get("routes", {})
+        return {
+            "routes": {
+                alias: self._decode_route(route) for alias, route in routes.items()
+            }
+        }
 
     async def get_route(self, routespec):
         """Return the route info for a given routespec.
@@ -173,13 +722,34 @@ class TKvProxy(TraefikProxy):
         """
         routespec = self.validate_routespec(routespec)
         router_alias = traefik_utils.generate_alias(routespec, "router")
+        if self.kv_route_cache:
+            route = (await self._get_route_cache()).get(router_alias)
+        else:
+            route = await self._read_route(router_alias)
+        if route is None:
+            return None
+        return {key: route[key] for key in ("routespec", "data", "target")}
+
+    async def _read_route(self, router_alias):
+        """Read one route from the kv store, in either kv_route_format"""
         route_key = self.kv_separator.join(
             [self.kv_jupyterhub_prefix, "routes", router_alias]
         )
-        route = await self._kv_get_tree(route_key)
-        if not route:
+        # look in the other format if it's not found,
+        # in case it hasn't been converted to kv_route_format yet
+        reads = [
+            partial(self._get_tree, route_key, name="get_route"),
+            partial(self._get_value, route_key, name="get_route"),
+        ]
+        if self.kv_route_format == "json":
+            reads.reverse()
+        for read in reads:
+            route = await read()
+            if route:
+                break
+        else:
             return None
-        return {key: route[key] for key in ("routespec", "data", "target")}
+        return self._decode_route(route)
 
     # deep/flat dict translation
 
@@ -238,47 +808,47 @@ class TKvProxy(TraefikProxy):
         Inspired by `this answer on StackOverflow <https://stackoverflow.com/a/6027615>`_
         """
         sep = self.kv_separator
-        # if it's a list, cast to dict of str keys, i.e. ["x"] -> {"0": "x"}
-        # if isinstance(data, list):
-        #     data = {str(i): item for i, item in enumerate(data)}
-
         items = {}
-        for k, v in data.items():
-            if prefix:
-                new_key = f"{prefix}{sep}{k}"
-            else:
-                new_key = k
-
-            if isinstance(v, list):
-                # if it's a list, cast to dict of str keys, i.e. ["x"] -> {"0": "x"}
-                v = {str(i): item for i, item in enumerate(v)}
-
-            # two cases:
-            # 1. Mapping (dict)
-            # 2. scalar (cast to str)
-            if isinstance(v, Mapping):
-                if not v:
-                    self.log.warning(
-                        f"Not setting anything for empty dict at {new_key}"
-                    )
-                items.update(self.flatten_dict_for_kv(v, prefix=new_key))
-            else:
-                # cast _known_ types to str
-                v = self._kv_to_str(v)
-                # if cast didn't coerce, we can't handle it
-                if not isinstance(v, str):
-                    raise ValueError(
-                        f"Cannot upload {new_key}: {v} of type {type(v)} to kv store"
+        # iterate instead of recursing, with one (key prefix, items) pair per container
+        # lists use the same keys as dicts of str(index), i.e. ["x"] -> {"0": "x"}
+        stack = [(prefix + sep if prefix else "", data.items())]
+        while stack:
+            key_prefix, container_items = stack.pop()
+            for k, v in container_items:
+                new_key = f"{key_prefix}{k}"
+                if isinstance(v, str):
+                    items[new_key] = v
+                elif isinstance(v, (list, Mapping)):
+                    if not v:
+                        self.log.warning(
+                            f"Not setting anything for empty dict at {new_key}"
+                        )
+                    stack.append(
+                        (
+                            new_key + sep,
+                            enumerate(v) if isinstance(v, list) else v.items(),
+                        )
                     )
-                items[new_key] = v
+                else:
+                    # cast _known_ types to str
+                    v = self._kv_to_str(v)
+                    # if cast didn't coerce, we can't handle it
+                    if not isinstance(v, str):
+                        raise ValueError(
+                            f"Cannot upload {new_key}: {v} of type {type(v)} to kv store"
+                        )
+                    items[new_key] = v
         return items
 
-    def unflatten_dict_from_kv(self, kv_list, root_key=""):
+    def unflatten_dict_from_kv(self, kv_list, root_key="", max_depth=None):
         """Reconstruct tree dict from list of key/value pairs
 
         This is the inverse of flatten_dict_for_kv,
         not including str coercion.
 
+        Builds the tree in a single pass over the pairs, in any order,
+        then turns containers whose keys are all list indices into lists.
+
         Args:
 
         kv_list (list):
@@ -287,6 +857,11 @@ class TKvProxy(TraefikProxy):
         root_key (str, optional):
             The key representing the root of the tree,
             if not the root of the key-value store.
+            Pairs outside root_key are ignored.
+        max_depth (int, optional):
+            The maximum depth of the tree (below root_key).
+            Keys are not split beyond it,
+            e.g. with max_depth=2, `a/b/c` is `{"a": {"b/c": value}}`.
 
         Returns:
 
@@ -295,67 +870,73 @@ class TKvProxy(TraefikProxy):
             All values will still be strings,
             even those that originated as numbers or booleans.
         """
-
         sep = self.kv_separator
-
-        def by_depth(item):
-            """sort-key function to get shallow items first
-
-            Ensures
-
-            So that we know that we always see an item
-            before its children
-            """
-            key, value = item
-            key_path = key.split(sep)
-            for i, label in enumerate(key_path):
-                # ensure
-                if label.isdigit():
-                    key_path[i] = int(label)
-            return len(key.split(sep))
+        prefix = ""
+        if root_key:
+            prefix = root_key.strip(sep) + sep
+        maxsplit = -1 if max_depth is None else max_depth - 1
 
         tree = {}
-        for key, value in sorted(kv_list, key=by_depth):
-            key_path = key.split(sep)
-            d = tree
-            for parent_key, key in zip(key_path[:-1], key_path[1:]):
-                if parent_key.isdigit():
-                    parent_key = int(parent_key)
-                if isinstance(d, dict) and parent_key not in d:
-                    # create container
-                    if key.isdigit():
-                        # integer keys mean it's a list
-                        d[parent_key] = []
-                    else:
-                        d[parent_key] = {}
-                elif isinstance(d, list):
-                    if key.isdigit():
-                        # integer keys mean it's a list
-                        next_d = []
-                    else:
-                        next_d = {}
-                    d.append(next_d)
-                # walk down to the next level
-                d = d[parent_key]
-            if isinstance(d, list):
-                # validate list keys
-                if len(d) != int(key):
-                    raise IndexError(
-                        f"Got invalid list key {key_path}, missing previous items in {d}"
-                    )
-                d.append(value)
+        # index of containers by their key, so each pair is placed with one lookup
+        containers = {"": tree}
+
+        def container(path):
+            node = containers.get(path)
+            if node is None:
+                parent, _, label = path.rpartition(sep)
+                parent_node = container(parent)
+                if label in parent_node:
+                    raise TypeError(f"Cannot store {path!r}: it already has a value")
+                node = parent_node[label] = containers[path] = {}
+            return node
+
+        found = not prefix
+        for key, value in kv_list:
+            if prefix:
+                if not key.startswith(prefix):
+                    continue
+                key = key[len(prefix) :]
+                found = True
+            if maxsplit >= 0:
+                *parents, last = key.split(sep, maxsplit)
+                parent = sep.join(parents)
             else:
-                d[key] = value
-
-        if root_key:
-            original_tree = tree
-            # get the root of the tree,
-            # rather than starting from root
-            for key in root_key.strip(self.kv_separator).split(self.kv_separator):
-                if key not in tree:
-                    self.log.warning(
-                        f"Root key {root_key!r} not found in {original_tree}"
-                    )
-                    return {}
-                tree = tree[key]
+                parent, _, last = key.rpartition(sep)
+                if key in containers:
+                    raise TypeError(f"Cannot store {key!r}: it has child keys")
+            container(parent)[last] = value
+
+        if not found:
+            self.log.warning(f"Root key {root_key!r} not found")
+            return {}
+        if prefix:
+            # the root itself may be a list
+            return self._lists_from_index_keys(tree)
+        for key, child in tree.items():
+            if isinstance(child, dict):
+                tree[key] = self._lists_from_index_keys(child)
         return tree
+
+    def _lists_from_index_keys(self, node):
+        """Turn dicts in an unflattened tree whose keys are all digits into lists
+
+        Raises IndexError if any items are missing.
+        """
+        for key, child in node.items():
+            if isinstance(child, dict):
+                node[key] = self._lists_from_index_keys(child)
+        # check the first key before all of them, most containers are dicts
+        if not node or not next(iter(node)).isdigit():
+            return node
+        if not all(key.isdigit() for key in node):
+            return node
+        missing = object()
+        items = [missing] * len(node)
+        for key, child in node.items():
+            index = int(key)
+            if index >= len(items) or items[index] is not missing:
+                raise IndexError(
+                    f"Got invalid list keys {sorted(node, key=int)}, missing items"
+                )
+            items[index] = child
+        return items
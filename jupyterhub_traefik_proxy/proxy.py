@@ -19,22 +19,52 @@ Route Specification:
 # Distributed under the terms of the Modified BSD License.
 
 import asyncio
+import base64
+import hashlib
+import ipaddress
 import json
 import os
 import ssl
+from contextvars import ContextVar
 from os.path import abspath
 from subprocess import Popen, TimeoutExpired
-from urllib.parse import urlparse, urlunparse
+from urllib.parse import quote, urlparse, urlunparse
 
 import bcrypt
 from jupyterhub.proxy import Proxy
 from jupyterhub.utils import exponential_backoff, new_token, url_path_join
 from tornado.httpclient import AsyncHTTPClient, HTTPClientError
-from traitlets import Any, Bool, Dict, Integer, Unicode, default, observe, validate
+from traitlets import (
+    Any,
+    Bool,
+    Dict,
+    Enum,
+    Float,
+    Integer,
+    List,
+    Unicode,
+    default,
+    observe,
+    validate,
+)
 
 from . import traefik_utils
 from .traefik_utils import deep_merge
 
+# (routes to add, routespecs to delete) collected during check_routes,
+# to be applied in bulk once the check is done
+_pending_route_changes = ContextVar("pending_route_changes", default=None)
+
+
+def _is_loopback(hostname):
+    """Is hostname a loopback address (e.g. localhost, 127.0.0.1, ::1)?"""
+    if hostname == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(hostname).is_loopback
+    except ValueError:
+        return False
+
 
 class TraefikProxy(Proxy):
     """JupyterHub Proxy implementation using traefik"""
@@ -63,6 +93,69 @@ class TraefikProxy(Proxy):
     def _concurrency_changed(self, change):
         self.semaphore = asyncio.BoundedSemaphore(change.new)
 
+    route_batch_window = Float(
+        0,
+        config=True,
+        help="""
+        Time window (in seconds) for coalescing concurrent route updates
+
+        When greater than zero, `add_route` calls arriving within this window
+        are merged into a single update of the dynamic configuration
+        (one transaction or file write and one traefik reload),
+        instead of one per route.
+        Each call still returns only once its own route is ready.
+        `delete_route` calls are batched the same way.
+
+        Up to `route_batch_size` routes are written together.
+        Zero (default) disables batching.
+
+        .. versionadded:: 2.2
+        """,
+    )
+
+    route_batch_size = Integer(
+        100,
+        config=True,
+        help="""
+        Maximum number of routes to write in a single batch
+
+        A batch is written as soon as it has this many routes,
+        even if `route_batch_window` has not elapsed.
+
+        .. versionadded:: 2.2
+        """,
+    )
+
+    _add_route_batcher = Any()
+
+    @default("_add_route_batcher")
+    def _default_add_route_batcher(self):
+        return traefik_utils.WriteBatcher(
+            self._apply_dynamic_config_batch,
+            window=self.route_batch_window,
+            max_size=self.route_batch_size,
+        )
+
+    _delete_route_batcher = Any()
+
+    @default("_delete_route_batcher")
+    def _default_delete_route_batcher(self):
+        return traefik_utils.WriteBatcher(
+            self._delete_dynamic_config_batch,
+            window=self.route_batch_window,
+            max_size=self.route_batch_size,
+        )
+
+    @observe("route_batch_window", "route_batch_size")
+    def _route_batch_changed(self, change):
+        # keep batchers that have been created in sync,
+        # without dropping the routes they are holding
+        for name in ("_add_route_batcher", "_delete_route_batcher"):
+            if self.trait_has_value(name):
+                batcher = getattr(self, name)
+                batcher.window = self.route_batch_window
+                batcher.max_size = self.route_batch_size
+
     static_config_file = Unicode(
         "traefik.toml", config=True, help="""traefik's static configuration file"""
     )
@@ -182,12 +275,118 @@ class TraefikProxy(Proxy):
         help="""traefik authenticated api endpoint url""",
     )
 
+    traefik_api_urls = List(
+        Unicode(),
+        config=True,
+        help="""traefik api endpoint urls of all traefik replicas serving this proxy's routes
+
+        When several traefik instances serve the same routes
+        (e.g. behind a load balancer),
+        new routes are checked in all of their apis concurrently,
+        and a route is considered ready once `traefik_api_quorum` of them
+        have registered it.
+        All replicas must accept the same api credentials.
+
+        Defaults to `traefik_api_url` alone.
+
+        .. versionadded:: 2.2
+        """,
+    )
+
+    traefik_api_quorum = Integer(
+        0,
+        config=True,
+        help="""Number of `traefik_api_urls` that must register a route before it is ready
+
+        By default (0), all of them.
+
+        .. versionadded:: 2.2
+        """,
+    )
+
+    @property
+    def _traefik_api_urls(self):
+        return self.traefik_api_urls or [self.traefik_api_url]
+
+    @property
+    def _traefik_api_quorum(self):
+        n = len(self._traefik_api_urls)
+        if self.traefik_api_quorum <= 0:
+            return n
+        return min(self.traefik_api_quorum, n)
+
     traefik_api_validate_cert = Bool(
         True,
         config=True,
         help="""validate SSL certificate of traefik api endpoint""",
     )
 
+    traefik_api_max_clients = Integer(
+        10,
+        config=True,
+        help="""Maximum number of simultaneous requests to the traefik api""",
+    )
+
+    traefik_api_keep_alive = Bool(
+        False,
+        config=True,
+        help="""Reuse connections (and TLS sessions) to the traefik api
+
+        Requires `pycurl`, e.g. `pip install jupyterhub-traefik-proxy[keepalive]`.
+        Otherwise, each request to the traefik api makes a new connection.
+        """,
+    )
+
+    traefik_api_connect_timeout = Float(
+        20,
+        config=True,
+        help="""Timeout (in seconds) for connecting to the traefik api""",
+    )
+
+    traefik_api_request_timeout = Float(
+        20,
+        config=True,
+        help="""Timeout (in seconds) for a single request to the traefik api""",
+    )
+
+    traefik_api_client = Any(
+        help="""The tornado AsyncHTTPClient used to talk to the traefik api
+
+        Created on first use and closed when the proxy is stopped.
+        """
+    )
+
+    @default("traefik_api_client")
+    def _default_traefik_api_client(self):
+        if self.traefik_api_keep_alive:
+            try:
+                from tornado.curl_httpclient import CurlAsyncHTTPClient
+            except ImportError:
+                self.log.warning(
+                    "traefik_api_keep_alive requires pycurl, not reusing connections to the traefik api"
+                )
+            else:
+                return CurlAsyncHTTPClient(
+                    force_instance=True, max_clients=self.traefik_api_max_clients
+                )
+        return AsyncHTTPClient(
+            force_instance=True, max_clients=self.traefik_api_max_clients
+        )
+
+    _traefik_api_request_kwargs = Dict()
+
+    @default("_traefik_api_request_kwargs")
+    def _default_traefik_api_request_kwargs(self):
+        # compute the auth header once, rather than on every request
+        credentials = f"{self.traefik_api_username}:{self.traefik_api_password}"
+        auth = base64.b64encode(credentials.encode("utf8")).decode("ascii")
+        return dict(
+            headers={"Authorization": f"Basic {auth}"},
+            validate_cert=self.traefik_api_validate_cert,
+            connect_timeout=self.traefik_api_connect_timeout,
+            request_timeout=self.traefik_api_request_timeout,
+        )
+
     traefik_log_level = Unicode(config=True, help="""traefik's log level""")
 
     traefik_api_password = Unicode(
@@ -299,15 +498,57 @@ class TraefikProxy(Proxy):
         help="""
         Set the hashed password to use for the API
 
-        If unspecified, `traefik_api_password` will be hashed with bcrypt.
+        If unspecified, `traefik_api_password` will be hashed
+        according to `traefik_api_auth`.
         ref: https://doc.traefik.io/traefik/middlewares/http/basicauth/
         """,
     )
 
+    traefik_api_auth = Enum(
+        ["bcrypt", "sha1", "none"],
+        default_value="bcrypt",
+        config=True,
+        help="""How to authenticate requests to the traefik api
+
+        traefik checks the password on every request to the api,
+        including every check while waiting for a route to be registered.
+
+        - bcrypt (default): basic auth with a bcrypt-hashed password.
+          The cost of each check is set by `traefik_api_bcrypt_rounds`.
+        - sha1: basic auth with a `{SHA}` hashed password.
+          Much cheaper to verify, but unsalted.
+          Only use with a strong, random `traefik_api_password`.
+        - none: no authentication on the api router.
+          Only allowed when JupyterHub starts traefik (`should_start`)
+          with the api entrypoint listening on a loopback address,
+          so the api is only reachable from this machine.
+
+        .. versionadded:: 2.2
+        """,
+    )
+
+    traefik_api_bcrypt_rounds = Integer(
+        12,
+        config=True,
+        help="""The bcrypt cost factor for hashing `traefik_api_password`
+
+        Each increment doubles the time traefik spends checking
+        the password on every api request.
+        Only used when `traefik_api_auth` is 'bcrypt'
+        and `traefik_api_hashed_password` is unspecified.
+
+        .. versionadded:: 2.2
+        """,
+    )
+
     @default("traefik_api_hashed_password")
     def _generate_htpassword(self):
+        password = self.traefik_api_password.encode("utf8")
+        if self.traefik_api_auth == "sha1":
+            digest = hashlib.sha1(password).digest()
+            return "{SHA}" + base64.b64encode(digest).decode("ascii")
         return bcrypt.hashpw(
-            self.traefik_api_password.encode("utf8"), bcrypt.gensalt()
+            password, bcrypt.gensalt(rounds=self.traefik_api_bcrypt_rounds)
         ).decode("ascii")
 
     check_route_timeout = Integer(
@@ -316,65 +557,205 @@ class TraefikProxy(Proxy):
         help="""Timeout (in seconds) when waiting for traefik to register an updated route.""",
     )
 
-    async def _check_for_traefik_service(self, routespec, kind):
-        """Check for an expected router or service in the Traefik API.
+    traefik_api_page_size = Integer(
+        500,
+        config=True,
+        help="""Number of routers or services to request per page
+        when listing them in the traefik API.
+
+        Used when checking whether traefik has registered new routes.
+        """,
+    )
+
+    _route_waiters = Dict()
+    # routespec -> api urls that have registered it, while waiting
+    _route_confirmations = Dict()
+    _route_poller = Any()
+    _route_poller_wakeup = Any()
+    # (kind, api url) -> number of pages in the last listing of all routers or services
+    _traefik_api_pages = Dict()
+
+    @default("_route_poller_wakeup")
+    def _default_route_poller_wakeup(self):
+        return asyncio.Event()
 
-        This is used to wait for traefik to load configuration
-        from a provider
+    async def _list_traefik_names(self, kind, api_url=None):
+        """List the names of all routers or services from our provider in the Traefik API
+
+        Follows traefik's pagination, so each call costs
+        one request per `traefik_api_page_size` items,
+        no matter how many routes we are waiting for.
         """
-        # expected e.g. 'service' + '_' + routespec @ file
-        routespec = self.validate_routespec(routespec)
-        expected = (
-            traefik_utils.generate_alias(routespec, kind) + "@" + self.provider_name
-        )
-        path = f"/api/http/{kind}s/{expected}"
+        names = set()
+        page = 1
+        while True:
+            path = (
+                f"/api/http/{kind}s?search=@{self.provider_name}"
+                f"&per_page={self.traefik_api_page_size}&page={page}"
+            )
+            resp = await self._traefik_api_request(path, api_url=api_url)
+            names.update(item["name"] for item in json.loads(resp.body))
+            next_page = int(resp.headers.get("X-Next-Page") or 1)
+            if next_page <= page:
+                # traefik sets X-Next-Page=1 on the last page
+                break
+            page = next_page
+        self._traefik_api_pages[(kind, api_url)] = page
+        return names
+
+    async def _search_traefik_name(self, kind, name, api_url=None):
+        """Is a router or service registered in the Traefik API?
+
+        One request, no matter how many routes there are.
+        """
+        path = f"/api/http/{kind}s?search={quote(name)}"
+        resp = await self._traefik_api_request(path, api_url=api_url)
+        return any(item["name"] == name for item in json.loads(resp.body))
+
+    async def _registered_traefik_names(self, kind, names, api_url=None):
+        """Return which of names are registered as routers or services in the Traefik API
+
+        Searches for each name if that takes fewer requests
+        than listing all of them did the last time,
+        and lists all of them otherwise.
+        """
+        pages = self._traefik_api_pages.get((kind, api_url))
+        if pages is not None and len(names) < pages:
+            found = await asyncio.gather(
+                *(self._search_traefik_name(kind, name, api_url) for name in names)
+            )
+            return {name for name, is_found in zip(names, found) if is_found}
+        return set(names) & await self._list_traefik_names(kind, api_url=api_url)
+
+    async def _poll_for_routes(self):
+        """Resolve pending route waiters until there are none left
+
+        A single poller is shared by all concurrent `_wait_for_route` calls,
+        so the load on the traefik API does not grow with
+        how many routes are waiting to be registered:
+        each poll searches for the waiting routes,
+        or lists all routes if that takes fewer requests.
+        """
+        start_wait = wait = 0.1
+        max_wait = 5
         try:
-            resp = await self._traefik_api_request(path)
-            json.loads(resp.body)
-        except HTTPClientError as e:
-            if e.code == 404:
-                self.log.debug(
-                    "Traefik route for %s: %s not yet in %s", routespec, expected, kind
+            while self._route_waiters:
+                self._route_poller_wakeup.clear()
+                api_urls = self._traefik_api_urls
+                quorum = self._traefik_api_quorum
+                # check all replicas concurrently
+                routespecs = list(self._route_waiters)
+                registered = await asyncio.gather(
+                    *(
+                        self._list_traefik_routes(api_url, routespecs)
+                        for api_url in api_urls
+                    )
                 )
-                return False
-            self.log.exception(f"Error checking traefik api for {kind} {routespec}")
-            return False
-        except Exception:
-            self.log.exception(f"Error checking traefik api for {kind} {routespec}")
-            return False
 
-        # found the expected endpoint
-        return True
+                found = False
+                suffix = "@" + self.provider_name
+                for routespec, waiters in list(self._route_waiters.items()):
+                    service = traefik_utils.generate_alias(routespec, "service")
+                    router = traefik_utils.generate_alias(routespec, "router")
+                    confirmed = self._route_confirmations.setdefault(routespec, set())
+                    for api_url, (services, routers) in zip(api_urls, registered):
+                        if service + suffix in services and router + suffix in routers:
+                            confirmed.add(api_url)
+                    if len(confirmed) >= quorum:
+                        found = True
+                        self._route_waiters.pop(routespec)
+                        self._route_confirmations.pop(routespec)
+                        for f in waiters:
+                            if not f.done():
+                                f.set_result(None)
+                    else:
+                        self.log.debug(
+                            "Traefik route for %s: registered in %i/%i apis",
+                            routespec,
+                            len(confirmed),
+                            quorum,
+                        )
 
-    async def _wait_for_route(self, routespec):
-        self.log.debug("Traefik route for %s: waiting to register", routespec)
+                if not self._route_waiters:
+                    break
 
-        async def _check_traefik_dynamic_conf_ready():
-            """Check if traefik loaded its dynamic configuration yet"""
-            if not await self._check_for_traefik_service(routespec, "service"):
-                return False
-            if not await self._check_for_traefik_service(routespec, "router"):
-                return False
+                if found:
+                    wait = start_wait
+                else:
+                    wait = min(wait * 1.2, max_wait)
+                # wait for the next poll,
+                # waking early if a new route is added
+                try:
+                    await asyncio.wait_for(self._route_poller_wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                else:
+                    wait = start_wait
+                    await asyncio.sleep(start_wait)
+        finally:
+            self._route_poller = None
 
-            return True
+    async def _list_traefik_routes(self, api_url, routespecs):
+        """Return the sets of (services, routers) for routespecs registered in one traefik api
 
-        await exponential_backoff(
-            _check_traefik_dynamic_conf_ready,
-            f"Traefik route for {routespec}: not ready",
-            scale_factor=1.2,
-            timeout=self.check_route_timeout,
-        )
+        Both are empty if the api can't be reached.
+        """
+        suffix = "@" + self.provider_name
+        try:
+            services = await self._registered_traefik_names(
+                "service",
+                [
+                    traefik_utils.generate_alias(routespec, "service") + suffix
+                    for routespec in routespecs
+                ],
+                api_url=api_url,
+            )
+            routers = await self._registered_traefik_names(
+                "router",
+                [
+                    traefik_utils.generate_alias(routespec, "router") + suffix
+                    for routespec in routespecs
+                ],
+                api_url=api_url,
+            )
+        except Exception as e:
+            self.log.error("Error checking traefik api %s for routes: %s", api_url, e)
+            return set(), set()
+        return services, routers
+
+    async def _wait_for_route(self, routespec):
+        self.log.debug("Traefik route for %s: waiting to register", routespec)
+        routespec = self.validate_routespec(routespec)
+        f = asyncio.get_running_loop().create_future()
+        self._route_waiters.setdefault(routespec, set()).add(f)
+        self._route_poller_wakeup.set()
+        if self._route_poller is None:
+            self._route_poller = asyncio.ensure_future(self._poll_for_routes())
+
+        try:
+            await asyncio.wait_for(f, self.check_route_timeout)
+        except asyncio.TimeoutError:
+            raise asyncio.TimeoutError(
+                f"Traefik route for {routespec}: not ready"
+            ) from None
+        finally:
+            waiters = self._route_waiters.get(routespec)
+            if waiters is not None:
+                waiters.discard(f)
+                if not waiters:
+                    self._route_waiters.pop(routespec)
+                    self._route_confirmations.pop(routespec, None)
         self.log.debug("Treafik route for %s: registered", routespec)
 
-    async def _traefik_api_request(self, path):
-        """Make an API request to traefik"""
-        url = url_path_join(self.traefik_api_url, path)
+    async def _traefik_api_request(self, path, api_url=None):
+        """Make an API request to traefik
+
+        api_url defaults to traefik_api_url.
+        """
+        url = url_path_join(api_url or self.traefik_api_url, path)
         self.log.debug("Fetching traefik api %s", url)
-        resp = await AsyncHTTPClient().fetch(
-            url,
-            auth_username=self.traefik_api_username,
-            auth_password=self.traefik_api_password,
-            validate_cert=self.traefik_api_validate_cert,
+        resp = await self.traefik_api_client.fetch(
+            url, **self._traefik_api_request_kwargs
         )
         if resp.code >= 300:
             self.log.warning("%s GET %s", resp.code, url)
@@ -520,24 +901,61 @@ class TraefikProxy(Proxy):
         self.log.debug("Setting up traefik's dynamic config...")
         api_url = urlparse(self.traefik_api_url)
         api_path = api_url.path if api_url.path.strip("/") else '/api'
-        api_credentials = (
-            f"{self.traefik_api_username}:{self.traefik_api_hashed_password}"
-        )
         dynamic_config = {
             "http": {
                 "routers": {},
-                "middlewares": {},
             }
         }
         routers = dynamic_config["http"]["routers"]
-        middlewares = dynamic_config["http"]["middlewares"]
+        # the same dynamic config is loaded by all replicas,
+        # so the api router must match each of their hostnames
+        api_hosts = " || ".join(
+            f"Host(`{hostname}`)"
+            for hostname in dict.fromkeys(
+                urlparse(url).hostname
+                for url in [self.traefik_api_url, *self.traefik_api_urls]
+            )
+        )
+        if "||" in api_hosts:
+            api_hosts = f"({api_hosts})"
         routers["route_api"] = {
-            "rule": f"Host(`{api_url.hostname}`) && PathPrefix(`{api_path}`)",
+            "rule": f"{api_hosts} && PathPrefix(`{api_path}`)",
             "entryPoints": [self.traefik_api_entrypoint],
             "service": "api@internal",
-            "middlewares": ["auth_api"],
         }
-        middlewares["auth_api"] = {"basicAuth": {"users": [api_credentials]}}
+        if self.traefik_api_auth == "none":
+            # the Host rule doesn't limit who can connect,
+            # only the address traefik listens on does
+            if not self.should_start:
+                raise ValueError(
+                    f"{self.__class__.__name__}.traefik_api_auth='none' requires should_start=True"
+                )
+            api_address = (
+                self.static_config.get("entryPoints", {})
+                .get(self.traefik_api_entrypoint, {})
+                .get("address", "")
+            )
+            if not _is_loopback(urlparse(f"//{api_address}").hostname):
+                raise ValueError(
+                    f"{self.__class__.__name__}.traefik_api_auth='none' requires the api entrypoint on a loopback address, not {api_address!r}"
+                )
+            if not _is_loopback(api_url.hostname):
+                raise ValueError(
+                    f"{self.__class__.__name__}.traefik_api_auth='none' requires traefik_api_url on a loopback address, not {self.traefik_api_url}"
+                )
+            self.log.warning(
+                "Traefik api at %s is not authenticated", self.traefik_api_url
+            )
+            # remove auth from any previous configuration
+            await self._delete_api_auth()
+        else:
+            api_credentials = (
+                f"{self.traefik_api_username}:{self.traefik_api_hashed_password}"
+            )
+            routers["route_api"]["middlewares"] = ["auth_api"]
+            dynamic_config["http"]["middlewares"] = {
+                "auth_api": {"basicAuth": {"users": [api_credentials]}}
+            }
 
         # add default ssl cert/keys
         if self.ssl_cert and self.ssl_key:
@@ -560,6 +978,19 @@ class TraefikProxy(Proxy):
 
         await self._apply_dynamic_config(self.dynamic_config, None)
 
+    # keys of the api authentication in the dynamic config
+    _api_auth_keys = (
+        ["http", "routers", "route_api", "middlewares"],
+        ["http", "middlewares", "auth_api"],
+    )
+
+    async def _delete_api_auth(self):
+        """Delete api authentication left by a previous configuration
+
+        with `traefik_api_auth = "none"`
+        """
+        await self._delete_dynamic_config(self._api_auth_keys, ())
+
     def validate_routespec(self, routespec):
         """Override jupyterhub's default Proxy.validate_routespec method, as traefik
         can set router rule's on both Host and PathPrefix rules combined.
@@ -600,11 +1031,14 @@ class TraefikProxy(Proxy):
         """Stop the proxy.
 
         Will be called during teardown if should_start is True.
+        With an externally managed traefik (should_start=False),
+        stops the proxy's background tasks without stopping traefik.
 
         **Subclasses must define this method**
         if the proxy is to be started by the Hub
         """
-        self._stop_traefik()
+        if self.traefik_process is not None:
+            self._stop_traefik()
         _cleanup_result = self._cleanup()
         if _cleanup_result is not None:
             await _cleanup_result
@@ -614,6 +1048,10 @@ class TraefikProxy(Proxy):
 
         Extend if there's more to cleanup than the static config file
         """
+        if self._route_poller is not None:
+            self._route_poller.cancel()
+        if self.trait_has_value("traefik_api_client"):
+            self.traefik_api_client.close()
         if self.should_start:
             try:
                 os.remove(self.static_config_file)
@@ -683,6 +1121,11 @@ class TraefikProxy(Proxy):
         The proxy implementation should also have a way to associate the fact that a
         route came from JupyterHub.
         """
+        pending_changes = _pending_route_changes.get()
+        if pending_changes is not None:
+            # called by check_routes, applied when the check is done
+            pending_changes[0].append((routespec, target, data))
+            return
         if self._start_future and not self._start_future.done():
             await self._start_future
         routespec = self.validate_routespec(routespec)
@@ -692,13 +1135,70 @@ class TraefikProxy(Proxy):
         )
 
         try:
-            async with self.semaphore:
-                await self._apply_dynamic_config(traefik_config, jupyterhub_config)
+            if self.route_batch_window > 0:
+                await self._add_route_batcher.submit(
+                    (traefik_config, jupyterhub_config)
+                )
                 await self._wait_for_route(routespec)
+            else:
+                async with self.semaphore:
+                    await self._apply_dynamic_config(traefik_config, jupyterhub_config)
+                    await self._wait_for_route(routespec)
         except TimeoutError:
             self.log.error(f"Traefik route for {routespec} never appeared.")
             raise
 
+    async def add_routes(self, routes):
+        """Add many routes to the proxy at once.
+
+        Much faster than calling `add_route` for each route,
+        because all routes are stored with a single update
+        of the dynamic configuration, and traefik is polled once
+        for all of them to be ready.
+
+        Args:
+            routes (list): list of `(routespec, target, data)` tuples,
+                as would be passed to `add_route`.
+
+        .. versionadded:: 2.2
+        """
+        if self._start_future and not self._start_future.done():
+            await self._start_future
+
+        routespecs = []
+        configs = []
+        for routespec, target, data in routes:
+            routespec = self.validate_routespec(routespec)
+            routespecs.append(routespec)
+            configs.append(self._dynamic_config_for_route(routespec, target, data))
+        if not configs:
+            return
+
+        await self._apply_dynamic_config_batch(configs)
+        try:
+            await asyncio.gather(
+                *(self._wait_for_route(routespec) for routespec in routespecs)
+            )
+        except TimeoutError:
+            self.log.error("Traefik routes for %i routes never appeared.", len(routes))
+            raise
+        self.log.debug("Added %i routes", len(routespecs))
+
+    async def _apply_dynamic_config_batch(self, configs):
+        """Apply a batch of (traefik_config, jupyterhub_config) pairs at once
+
+        Merges all the configs into a single call to `_apply_dynamic_config`.
+        Later items win if the same route appears more than once.
+        """
+        traefik_config = {}
+        jupyterhub_config = {}
+        for route_traefik_config, route_jupyterhub_config in configs:
+            deep_merge(traefik_config, route_traefik_config)
+            deep_merge(jupyterhub_config, route_jupyterhub_config)
+        self.log.debug("Applying dynamic config for %i routes", len(configs))
+        async with self.semaphore:
+            await self._apply_dynamic_config(traefik_config, jupyterhub_config)
+
     def _keys_for_route(self, routespec):
         """Return (traefik_keys, jupyterhub_keys)
 
@@ -729,11 +1229,86 @@ class TraefikProxy(Proxy):
 
     async def delete_route(self, routespec):
         """Delete a route with a given routespec if it exists."""
+        pending_changes = _pending_route_changes.get()
+        if pending_changes is not None:
+            # called by check_routes, applied when the check is done
+            pending_changes[1].append(routespec)
+            return
         routespec = self.validate_routespec(routespec)
         traefik_keys, jupyterhub_keys = self._keys_for_route(routespec)
-        await self._delete_dynamic_config(traefik_keys, jupyterhub_keys)
+        if self.route_batch_window > 0:
+            await self._delete_route_batcher.submit((traefik_keys, jupyterhub_keys))
+        else:
+            await self._delete_dynamic_config(traefik_keys, jupyterhub_keys)
         self.log.debug("Route %s was deleted.", routespec)
 
+    async def delete_routes(self, routespecs):
+        """Delete many routes from the proxy at once.
+
+        All routes are removed with a single update of the dynamic configuration.
+        If some routes could not be deleted, the rest are still deleted
+        before the first error is raised.
+
+        Args:
+            routespecs (list): the routespecs to delete, as would be passed to `delete_route`.
+
+        .. versionadded:: 2.2
+        """
+        if self._start_future and not self._start_future.done():
+            await self._start_future
+
+        routespecs = [self.validate_routespec(routespec) for routespec in routespecs]
+        if not routespecs:
+            return
+        keys = [self._keys_for_route(routespec) for routespec in routespecs]
+        results = await self._delete_dynamic_config_batch(keys)
+        errors = []
+        for routespec, result in zip(routespecs, results or []):
+            if isinstance(result, Exception):
+                self.log.error("Failed to delete route %s: %s", routespec, result)
+                errors.append(result)
+        if errors:
+            raise errors[0]
+        self.log.debug("Deleted %i routes", len(routespecs))
+
+    async def _delete_dynamic_config_batch(self, keys):
+        """Delete a batch of (traefik_keys, jupyterhub_keys) pairs at once
+
+        Merges all the keys into a single call to `_delete_dynamic_config`.
+        If that fails, each route is deleted on its own,
+        so errors are only reported to the callers they belong to.
+        """
+        traefik_keys = []
+        jupyterhub_keys = []
+        for route_traefik_keys, route_jupyterhub_keys in keys:
+            traefik_keys.extend(route_traefik_keys)
+            jupyterhub_keys.extend(route_jupyterhub_keys)
+        self.log.debug("Deleting dynamic config for %i routes", len(keys))
+        try:
+            await self._delete_dynamic_config(traefik_keys, jupyterhub_keys)
+        except Exception as e:
+            if len(keys) == 1:
+                raise
+            self.log.warning(
+                "Failed to delete %i routes at once, deleting one at a time: %s",
+                len(keys),
+                e,
+            )
+        else:
+            return
+
+        results = []
+        for route_traefik_keys, route_jupyterhub_keys in keys:
+            try:
+                await self._delete_dynamic_config(
+                    route_traefik_keys, route_jupyterhub_keys
+                )
+            except Exception as e:
+                results.append(e)
+            else:
+                results.append(None)
+        return results
+
     async def _get_jupyterhub_dynamic_config(self):
         """Get the jupyterhub part of our dynamic config
 
@@ -741,10 +1316,58 @@ class TraefikProxy(Proxy):
         """
         raise NotImplementedError()
 
-    async def check_routes(self, *args, **kwargs):
+    # concurrent identical calls (check_routes, reads from a key-value store)
+    # share a single call
+    _single_flight = Any()
+
+    @default("_single_flight")
+    def _default_single_flight(self):
+        return traefik_utils.SingleFlight()
+
+    async def check_routes(self, user_dict, service_dict, routes=None):
+        """Check that all users are properly routed on the proxy.
+
+        The difference between the expected routes and the routes in the proxy
+        is computed by JupyterHub's `Proxy.check_routes`,
+        but all missing routes, changed targets and stale routes are applied
+        with one bulk update each (`add_routes` and `delete_routes`),
+        instead of one `add_route` or `delete_route` at a time.
+
+        Concurrent calls share the check already in progress.
+        """
         if self._start_future and not self._start_future.done():
             await self._start_future
-        return await super().check_routes(*args, **kwargs)
+        # the arguments don't keep calls apart: a check already in progress
+        # checks the same users and services
+        return await self._single_flight.run(
+            "check_routes",
+            self._check_routes,
+            user_dict,
+            service_dict,
+            routes,
+            key="check_routes",
+        )
+
+    async def _check_routes(self, user_dict, service_dict, routes=None):
+        """Run JupyterHub's `Proxy.check_routes`, applying its changes in bulk
+
+        The check itself is inherited unchanged.
+        The `add_route` and `delete_route` calls it makes are collected
+        instead of applied, then applied with one `add_routes`
+        and one `delete_routes` call.
+        """
+        to_add = []
+        to_delete = []
+        token = _pending_route_changes.set((to_add, to_delete))
+        try:
+            await super().check_routes(user_dict, service_dict, routes)
+        finally:
+            _pending_route_changes.reset(token)
+
+        await asyncio.gather(
+            self.delete_routes(to_delete),
+            self.add_routes(to_add),
+        )
 
     async def get_all_routes(self):
         """Fetch and return all the routes associated by JupyterHub from the
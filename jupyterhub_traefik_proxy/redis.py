@@ -1,7 +1,6 @@
 """Redis backend"""
 
-import asyncio
-from functools import partial
+import os
 from urllib.parse import urlparse
 
 from traitlets import Any, Dict, Unicode, default
@@ -110,29 +109,53 @@ class TraefikRedisProxy(TKvProxy):
         self.log.debug("Setting redis keys %s", to_set.keys())
         await self.redis.mset(to_set)
 
+    async def _kv_atomic_replace(self, to_set, to_delete):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            if to_set:
+                pipe.mset(to_set)
+            if to_delete:
+                pipe.delete(*to_delete)
+            await pipe.execute()
+
     _delete_script = Any()
 
     @default("_delete_script")
     def _register_delete_script(self):
-        """Register LUA script for deleting all keys matching in a prefix
+        """Register LUA script for deleting keys and all keys in prefixes
+
+        KEYS are deleted as-is.
+        ARGV is the SCAN match pattern and count, followed by the prefixes.
+        The keyspace is scanned once for all prefixes,
+        and the whole delete is atomic.
 
         Doing the scan & delete from Python is _extremely_ slow
         for some reason
         """
         _delete_lua = """
         local all_keys = {};
-        local cursor = "0";
-        repeat
-            local result = redis.call("SCAN", cursor, "match", ARGV[1], "count", ARGV[2])
-            cursor = result[1];
-            for i, key in ipairs(result[2]) do
-                table.insert(all_keys, key);
-            end
-        until cursor == "0"
+        for i, key in ipairs(KEYS) do
+            table.insert(all_keys, key);
+        end
+        if #ARGV > 2 then
+            local cursor = "0";
+            repeat
+                local result = redis.call("SCAN", cursor, "match", ARGV[1], "count", ARGV[2])
+                cursor = result[1];
+                for i, key in ipairs(result[2]) do
+                    for j = 3, #ARGV do
+                        if string.sub(key, 1, #ARGV[j]) == ARGV[j] then
+                            table.insert(all_keys, key);
+                            break
+                        end
+                    end
+                end
+            until cursor == "0"
+        end
+        local deleted = 0;
         for i, key in ipairs(all_keys) do
-            redis.call("DEL", key);
+            deleted = deleted + redis.call("DEL", key);
         end
-        return #all_keys;
+        return deleted;
         """
         return self.redis.register_script(_delete_lua)
 
@@ -140,30 +163,77 @@ class TraefikRedisProxy(TKvProxy):
         """Delete one or more keys
 
         If a key ends with `self.kv_separator`, it should be a recursive delete
-        """
 
-        to_delete = []
+        All keys are deleted in a single script,
+        scanning the keyspace at most once.
+        """
+        prefixes = [key for key in keys if key.endswith(self.kv_separator)]
+        to_delete = [key for key in keys if not key.endswith(self.kv_separator)]
+        if not prefixes:
+            if to_delete:
+                self.log.debug("Deleting redis keys %s", to_delete)
+                await self.redis.delete(*to_delete)
+            return
+
+        # only scan keys that could be in one of the prefixes
+        match = os.path.commonprefix(prefixes) + "*"
+        self.log.debug("Deleting redis keys %s and trees %s", to_delete, prefixes)
+        deleted = await self._delete_script(
+            keys=to_delete, args=[match, 100] + prefixes
+        )
+        self.log.debug("Deleted %i redis keys", deleted)
 
-        futures = []
-        for key in keys:
-            if key.endswith(self.kv_separator):
-                prefix = key + "*"
-                self.log.debug("Deleting redis tree %s", prefix)
-                f = asyncio.ensure_future(self._delete_script(args=[prefix, 100]))
+    async def _kv_get(self, key):
+        return await self.redis.get(key)
 
-                def _log_delete(_prefix, f):
-                    self.log.debug("Deleted %i keys in %s", f.result(), _prefix)
+    async def _check_keyspace_events(self):
+        """Check that keyspace notifications are enabled for the commands we use
 
-                f.add_done_callback(partial(_log_delete, prefix))
-                futures.append(f)
-            else:
-                to_delete.append(key)
+        Needs `notify-keyspace-events` to include `K`, `g` and `$` (or `KA`).
+        This is a server-wide setting, so it is up to the operator of the redis server,
+        e.g. `--notify-keyspace-events KEA`.
+        """
+        try:
+            config = await self.redis.config_get("notify-keyspace-events")
+        except Exception as e:
+            # e.g. managed redis services, where CONFIG is disabled
+            self.log.warning(
+                "Couldn't check redis notify-keyspace-events, assuming keyspace notifications are enabled: %s",
+                e,
+            )
+            return
+        flags = config.get("notify-keyspace-events", "")
+        if "K" in flags and ("A" in flags or ("g" in flags and "$" in flags)):
+            return
+        raise RuntimeError(
+            f"kv_route_watch needs redis keyspace notifications, but notify-keyspace-events={flags!r}."
+            " Enable them on the redis server, e.g. with `--notify-keyspace-events KEA`."
+        )
 
-        if to_delete:
-            self.log.debug("Deleting redis keys %s", to_delete)
-            futures.append(self.redis.delete(*to_delete))
+    async def _kv_watch_tree(self, prefix):
+        """Watch all keys under prefix with redis keyspace notifications
 
-        await asyncio.gather(*futures)
+        Notifications only have the key and the command,
+        so each changed key is read again to get its current value (None if deleted).
+        """
+        await self._check_keyspace_events()
+        db = self.redis.connection_pool.connection_kwargs.get("db", 0)
+        channel_prefix = f"__keyspace@{db}__:"
+        pubsub = self.redis.pubsub()
+        try:
+            await pubsub.psubscribe(channel_prefix + prefix + "*")
+            yield []
+            async for message in pubsub.listen():
+                if message["type"] != "pmessage":
+                    continue
+                key = message["channel"][len(channel_prefix) :]
+                yield [(key, await self.redis.get(key))]
+        finally:
+            if hasattr(pubsub, "aclose"):
+                await pubsub.aclose()
+            else:
+                # redis < 5.0.1
+                await pubsub.close()
 
     async def _kv_get_tree(self, prefix):
         """Return all data under prefix as a dict"""
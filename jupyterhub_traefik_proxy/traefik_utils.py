@@ -1,6 +1,14 @@
+import asyncio
+import io
+import json
 import os
 import string
+import sys
+import textwrap
+from collections import Counter
+from collections.abc import Mapping
 from contextlib import contextmanager
+from copy import deepcopy
 from tempfile import NamedTemporaryFile
 from urllib.parse import unquote
 
@@ -87,11 +95,17 @@ def generate_alias(routespec, kind=""):
 
 
 @contextmanager
-def atomic_writing(path):
+def atomic_writing(path, fsync=False):
     """Write temp file before copying it into place
 
     Avoids a partial file ever being present in `path`,
     which could cause traefik to load a partial routing table.
+
+    With fsync=True, the file's contents are flushed to disk
+    before it is moved into place, so `path` can never be empty after a crash.
+    The rename itself is only durable once the directory is synced
+    with :func:`fsync_directory`, which callers writing several files
+    can do once for all of them.
     """
     fileobj = NamedTemporaryFile(
         prefix=os.path.abspath(path) + "-tmp-", mode="w", delete=False
@@ -99,6 +113,9 @@ def atomic_writing(path):
     try:
         with fileobj as f:
             yield f
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
         os.replace(fileobj.name, path)
     finally:
         try:
@@ -108,47 +125,662 @@ def atomic_writing(path):
             pass
 
 
+def fsync_directory(path):
+    """Flush a directory entry to disk, making renames and removals in it durable"""
+    fd = os.open(path or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _toml_dumps():
+    import toml
+
+    return toml.dumps
+
+
+def _rtoml_dumps():
+    import rtoml
+
+    return rtoml.dumps
+
+
+def _pytomlpp_dumps():
+    import pytomlpp
+
+    return pytomlpp.dumps
+
+
+def _tomli_w_dumps():
+    import tomli_w
+
+    return tomli_w.dumps
+
+
+def _ruamel_dumps():
+    from ruamel.yaml import YAML
+
+    yaml = YAML(typ="rt")
+
+    def dumps(data):
+        f = io.StringIO()
+        yaml.dump(data, f)
+        return f.getvalue()
+
+    return dumps
+
+
+def _json_dumps():
+    # JSON is valid YAML, and much faster to produce
+    def dumps(data):
+        return json.dumps(data) + "\n"
+
+    return dumps
+
+
+def _toml_loads():
+    """Return the fastest available function to parse toml text"""
+    try:
+        import rtoml
+
+        return rtoml.loads
+    except ImportError:
+        pass
+    try:
+        import pytomlpp
+
+        return pytomlpp.loads
+    except ImportError:
+        pass
+    try:
+        import tomllib
+    except ImportError:
+        try:
+            import tomli as tomllib
+        except ImportError:
+            import toml
+
+            return toml.loads
+    return tomllib.loads
+
+
+def _yaml_loads():
+    """Return a function to parse yaml text
+
+    JSON documents (e.g. written by the json encoder) are parsed with the json module,
+    anything else with ruamel.yaml's safe loader,
+    which uses libyaml if ruamel.yaml.clib is installed.
+    """
+    from ruamel.yaml import YAML
+
+    yaml = YAML(typ="safe")
+
+    def loads(text):
+        if text.lstrip().startswith("{"):
+            try:
+                return json.loads(text)
+            except ValueError:
+                pass
+        return yaml.load(text)
+
+    return loads
+
+
+# encoder name: (file format, package, function returning a `dumps` function)
+encoders = {
+    "toml": ("toml", "toml", _toml_dumps),
+    "rtoml": ("toml", "rtoml", _rtoml_dumps),
+    "pytomlpp": ("toml", "pytomlpp", _pytomlpp_dumps),
+    "tomli_w": ("toml", "tomli-w", _tomli_w_dumps),
+    "ruamel": ("yaml", "ruamel.yaml", _ruamel_dumps),
+    "json": ("yaml", "json", _json_dumps),
+}
+
+# default encoder for each file format
+default_encoders = {"toml": "toml", "yaml": "ruamel", "json": "json"}
+
+# encoders to try for encoder="auto", fastest first
+auto_encoders = {
+    "toml": ["rtoml", "pytomlpp", "tomli_w", "toml"],
+    "yaml": ["json"],
+    "json": ["json"],
+}
+
+
 class TraefikConfigFileHandler:
     """Handles reading and writing Traefik config files. Can operate
-    on both toml and yaml files"""
+    on both toml and yaml files
+
+    `encoder` selects the serializer used for writing (see `encoders`),
+    or "auto" to pick the fastest one installed.
+    By default, toml files are written with `toml` and yaml files with ruamel.yaml.
+    """
 
-    def __init__(self, file_path):
+    def __init__(self, file_path, encoder=None):
         file_ext = file_path.rsplit('.', 1)[-1]
         if file_ext == 'yaml':
             try:
-                from ruamel.yaml import YAML
+                self._loads = _yaml_loads()
             except ImportError:
                 raise ImportError(
                     "jupyterhub-traefik-proxy requires ruamel.yaml to use YAML config files"
                 )
-            config_handler = YAML(typ="rt")
         elif file_ext == 'toml':
-            import toml as config_handler
+            self._loads = _toml_loads()
+        elif file_ext == 'json':
+            # not read by traefik, but used for caches
+            self._loads = json.loads
         else:
             raise TypeError("type should be either 'toml' or 'yaml'")
 
         self.file_path = file_path
-        # Redefined to either yaml.dump or toml.dump
-        self._dump = config_handler.dump
-        # self._dumps = config_handler.dumps
-        # Redefined by __init__, to either yaml.load or toml.load
-        self._load = config_handler.load
+        self.format = file_ext
+
+        if encoder == "auto":
+            for encoder in auto_encoders[file_ext]:
+                try:
+                    self._dumps = encoders[encoder][2]()
+                except ImportError:
+                    continue
+                else:
+                    break
+        else:
+            if encoder is None:
+                encoder = default_encoders[file_ext]
+            if encoder not in encoders:
+                raise ValueError(
+                    f"Unknown encoder {encoder!r}, expected one of {', '.join(encoders)}"
+                )
+            encoder_format, package, get_dumps = encoders[encoder]
+            if encoder_format != file_ext and (encoder, file_ext) != ("json", "json"):
+                raise ValueError(
+                    f"Encoder {encoder!r} writes {encoder_format} files, not {file_ext}"
+                )
+            try:
+                self._dumps = get_dumps()
+            except ImportError:
+                raise ImportError(
+                    f"jupyterhub-traefik-proxy requires {package} to use the {encoder} encoder"
+                )
+        self.encoder = encoder
+
+    def _dump(self, data, f):
+        f.write(self._dumps(data))
 
     def load(self):
-        """Depending on self.file_path, call either yaml.load or toml.load"""
-        with open(self.file_path) as fd:
-            return self._load(fd)
+        """Load self.file_path, with the fastest parser available for its format"""
+        with open(self.file_path, encoding="utf8") as fd:
+            return self._loads(fd.read())
 
     def dump(self, data):
         with open(self.file_path, "w") as f:
             self._dump(data, f)
 
-    def atomic_dump(self, data):
+    def atomic_dump(self, data, fsync=False):
         """Save data to self.file_path after opening self.file_path with
         :func:`atomic_writing`"""
-        with atomic_writing(self.file_path) as f:
+        with atomic_writing(self.file_path, fsync=fsync) as f:
             self._dump(data, f)
 
+    def dumps(self, data):
+        """Serialize data to a string"""
+        return self._dumps(data)
+
+    def atomic_write_text(self, text, fsync=False):
+        """Save already-serialized text to self.file_path with :func:`atomic_writing`"""
+        with atomic_writing(self.file_path, fsync=fsync) as f:
+            f.write(text)
+
+
+class ConfigFragmentCache:
+    """Cache the serialized text of per-route config entries
+
+    Most of a large dynamic config is one entry per route
+    (e.g. `http.routers.router_x`), and only a few of them change between writes.
+    The rendered toml or yaml for each of these entries is cached,
+    so a whole file can be assembled by concatenating cached fragments,
+    only serializing new or changed entries and the (small) rest of the config.
+
+    Entries must be invalidated with :meth:`invalidate` when they are modified in-place.
+
+    Empty route sections are omitted from the output,
+    as traefik doesn't handle empty dicts.
+    """
+
+    def __init__(self, handler, sections):
+        """
+        handler: a TraefikConfigFileHandler, used for serialization
+        sections: set of (top-level key, section) pairs with one entry per route,
+            e.g. ("http", "routers")
+        """
+        self.handler = handler
+        self.sections = set(sections)
+        self._top_keys = {top for top, section in self.sections}
+        self._fragments = {}
+
+    def __len__(self):
+        return len(self._fragments)
+
+    def clear(self):
+        self._fragments.clear()
+
+    def invalidate(self, key_paths):
+        """Invalidate cached fragments for changed key paths
+
+        key_paths is an iterable of lists of keys, as passed to `_delete_dynamic_config`.
+        Keys outside the cached sections are always re-rendered,
+        so don't need to be invalidated.
+        """
+        for key_path in key_paths:
+            section = tuple(key_path[:2])
+            if section not in self.sections:
+                continue
+            if len(key_path) >= 3:
+                self._fragments.pop((*section, key_path[2]), None)
+            else:
+                # whole section changed
+                for key in [key for key in list(self._fragments) if key[:2] == section]:
+                    self._fragments.pop(key)
+
+    def _fragment(self, top, section, alias, entry):
+        key = (top, section, alias)
+        cached = self._fragments.get(key)
+        # entries replaced with a new object are re-rendered, even if not invalidated,
+        # so rendering a snapshot (e.g. in a background thread) can't leave stale text behind
+        if cached is not None and cached[0] is entry:
+            return cached[1]
+        plain = plain_route_entry(entry)
+        if self.handler.encoder == "json":
+            text = f"{json.dumps(alias)}: {json.dumps(plain)}"
+        elif self.handler.format == "toml":
+            # a self-contained [top.section.alias] table
+            text = self.handler.dumps({top: {section: {alias: plain}}})
+        else:
+            text = textwrap.indent(self.handler.dumps({alias: plain}), " " * 4)
+        if not text.endswith("\n"):
+            text += "\n"
+        self._fragments[key] = (entry, text)
+        return text
+
+    def render(self, config):
+        """Serialize config, using cached fragments for per-route entries"""
+        if self.handler.encoder == "json":
+            return self._render_json(config)
+        elif self.handler.format == "toml":
+            return self._render_toml(config)
+        else:
+            return self._render_yaml(config)
+
+    def _render_toml(self, config):
+        rest = {}
+        fragments = []
+        for top, value in config.items():
+            if top not in self._top_keys or not isinstance(value, dict):
+                rest[top] = value
+                continue
+            rest_top = {}
+            for section, entries in value.items():
+                if (top, section) in self.sections:
+                    for alias, entry in entries.items():
+                        fragments.append(self._fragment(top, section, alias, entry))
+                else:
+                    rest_top[section] = entries
+            if rest_top:
+                rest[top] = rest_top
+        # everything else goes first,
+        # so top-level values aren't taken to be part of a route's table
+        text = self.handler.dumps(rest) if rest else ""
+        if text and not text.endswith("\n"):
+            text += "\n"
+        return text + "".join(fragments)
+
+    def _render_yaml(self, config):
+        parts = []
+        for top, value in config.items():
+            if top not in self._top_keys or not isinstance(value, dict):
+                parts.append(self.handler.dumps({top: value}))
+                continue
+            top_parts = []
+            for section, entries in value.items():
+                if (top, section) in self.sections:
+                    if not entries:
+                        continue
+                    top_parts.append(f"  {section}:\n")
+                    for alias, entry in entries.items():
+                        top_parts.append(self._fragment(top, section, alias, entry))
+                else:
+                    top_parts.append(
+                        textwrap.indent(self.handler.dumps({section: entries}), "  ")
+                    )
+            if top_parts:
+                parts.append(f"{top}:\n")
+                parts.extend(top_parts)
+        return "".join(parts)
+
+    def _render_json(self, config):
+        parts = []
+        for top, value in config.items():
+            if top not in self._top_keys or not isinstance(value, dict):
+                parts.append(f"{json.dumps(top)}: {json.dumps(value)}")
+                continue
+            top_parts = []
+            for section, entries in value.items():
+                if (top, section) in self.sections:
+                    if not entries:
+                        continue
+                    fragments = ",".join(
+                        self._fragment(top, section, alias, entry)
+                        for alias, entry in entries.items()
+                    )
+                    top_parts.append(f"{json.dumps(section)}: {{\n{fragments}}}")
+                else:
+                    top_parts.append(f"{json.dumps(section)}: {json.dumps(entries)}")
+            if top_parts:
+                parts.append(f"{json.dumps(top)}: {{\n" + ",\n".join(top_parts) + "}")
+        return "{\n" + ",\n".join(parts) + "}\n"
+
+
+class RouteRecord(Mapping):
+    """Base class for compact, read-only route entries
+
+    Stores the fields of one standard route entry (router, service or jupyterhub route)
+    in slots, instead of a tree of dicts and lists.
+    Behaves as a read-only Mapping with the same keys as the dict it replaces,
+    and :meth:`to_dict` produces that dict (e.g. for serialization).
+    """
+
+    __slots__ = ()
+
+    _keys = ()
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __getitem__(self, key):
+        raise NotImplementedError()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.to_dict()!r})"
+
+    def to_dict(self):
+        raise NotImplementedError()
+
+
+class RouterRecord(RouteRecord):
+    """http.routers entry"""
+
+    __slots__ = ("service", "rule", "entrypoint")
+
+    _keys = ("service", "rule", "entryPoints")
+
+    def __init__(self, service, rule, entrypoint):
+        self.service = service
+        self.rule = rule
+        self.entrypoint = entrypoint
+
+    def __getitem__(self, key):
+        if key == "entryPoints":
+            return [self.entrypoint]
+        if key in ("service", "rule"):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def to_dict(self):
+        return {
+            "service": self.service,
+            "rule": self.rule,
+            "entryPoints": [self.entrypoint],
+        }
+
+    @classmethod
+    def from_dict(cls, entry):
+        if entry.keys() != set(cls._keys):
+            return None
+        entrypoints = entry["entryPoints"]
+        if not (isinstance(entrypoints, list) and len(entrypoints) == 1):
+            return None
+        return cls(
+            sys.intern(entry["service"]), entry["rule"], sys.intern(entrypoints[0])
+        )
+
+
+class ServiceRecord(RouteRecord):
+    """http.services entry"""
+
+    __slots__ = ("url",)
+
+    _keys = ("loadBalancer",)
+
+    def __init__(self, url):
+        self.url = url
+
+    def __getitem__(self, key):
+        if key != "loadBalancer":
+            raise KeyError(key)
+        return {"servers": [{"url": self.url}], "passHostHeader": True}
+
+    def to_dict(self):
+        return {"loadBalancer": self["loadBalancer"]}
+
+    @classmethod
+    def from_dict(cls, entry):
+        if entry.keys() != {"loadBalancer"}:
+            return None
+        lb = entry["loadBalancer"]
+        if not isinstance(lb, Mapping) or lb.keys() != {"servers", "passHostHeader"}:
+            return None
+        servers = lb["servers"]
+        if lb["passHostHeader"] is not True or not (
+            isinstance(servers, list)
+            and len(servers) == 1
+            and isinstance(servers[0], Mapping)
+            and servers[0].keys() == {"url"}
+        ):
+            return None
+        return cls(servers[0]["url"])
+
+
+class JupyterHubRouteRecord(RouteRecord):
+    """jupyterhub.routes entry"""
+
+    __slots__ = ("data", "routespec", "target", "router", "service")
+
+    _keys = ("data", "routespec", "target", "router", "service")
+
+    def __init__(self, data, routespec, target, router, service):
+        self.data = data
+        self.routespec = routespec
+        self.target = target
+        self.router = router
+        self.service = service
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def to_dict(self):
+        return {
+            "data": deepcopy(self.data),
+            "routespec": self.routespec,
+            "target": self.target,
+            "router": self.router,
+            "service": self.service,
+        }
+
+    @classmethod
+    def from_dict(cls, entry):
+        if entry.keys() != set(cls._keys):
+            return None
+        return cls(
+            entry["data"],
+            entry["routespec"],
+            entry["target"],
+            sys.intern(entry["router"]),
+            sys.intern(entry["service"]),
+        )
+
+
+_record_classes = {
+    ("http", "routers"): RouterRecord,
+    ("http", "services"): ServiceRecord,
+    ("jupyterhub", "routes"): JupyterHubRouteRecord,
+}
+
+
+def compact_route_entry(section, entry):
+    """Return a compact RouteRecord for a route entry in section, e.g. ("http", "routers")
+
+    Entries that don't have the standard shape of a route added by the proxy
+    (e.g. the api router) are returned unchanged.
+    """
+    if isinstance(entry, RouteRecord) or not isinstance(entry, dict):
+        return entry
+    try:
+        record = _record_classes[section].from_dict(entry)
+    except (TypeError, KeyError):
+        # e.g. non-string values
+        record = None
+    if record is None:
+        return entry
+    return record
+
+
+def plain_route_entry(entry):
+    """Return a route entry as plain (serializable) dicts"""
+    if isinstance(entry, RouteRecord):
+        return entry.to_dict()
+    return entry
+
+
+class JSONRouteMetadataStore:
+    """Store the jupyterhub section of the dynamic config in a JSON file
+
+    Only one thread may call `save` at a time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fragments = ConfigFragmentCache(
+            TraefikConfigFileHandler(path), {("jupyterhub", "routes")}
+        )
+
+    def load(self):
+        """Return the stored jupyterhub config, or None if there is none"""
+        try:
+            with open(self.path, encoding="utf8") as f:
+                # without routes, the empty jupyterhub section is left out
+                return json.load(f).get("jupyterhub", {})
+        except FileNotFoundError:
+            return None
+
+    def save(self, jupyterhub_config, fsync=False):
+        """Save the jupyterhub config
+
+        Route entries must not be modified in-place after being saved,
+        they are only re-serialized when replaced.
+        With fsync, the file's directory must also be synced to make it durable.
+        """
+        with atomic_writing(self.path, fsync=fsync) as f:
+            f.write(self._fragments.render({"jupyterhub": jupyterhub_config}))
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class SQLiteRouteMetadataStore:
+    """Store the jupyterhub section of the dynamic config in a sqlite database
+
+    Each entry (e.g. each route) is a row,
+    so only changed entries are written.
+
+    Only one thread may call `save` at a time.
+    """
+
+    def __init__(self, path):
+        import sqlite3
+
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jupyterhub"
+            " (section TEXT, key TEXT, value TEXT, PRIMARY KEY (section, key))"
+        )
+        self._db.commit()
+        # (section, key) -> (entry, serialized entry) last saved
+        self._saved = {}
+
+    def load(self):
+        """Return the stored jupyterhub config, or None if there is none"""
+        rows = self._db.execute("SELECT section, key, value FROM jupyterhub").fetchall()
+        if not rows:
+            return None
+        jupyterhub_config = {}
+        for section, key, value in rows:
+            entry = json.loads(value)
+            jupyterhub_config.setdefault(section, {})[key] = entry
+            self._saved[(section, key)] = (entry, value)
+        return jupyterhub_config
+
+    def save(self, jupyterhub_config, fsync=False):
+        """Save the jupyterhub config in one transaction
+
+        Route entries must not be modified in-place after being saved,
+        they are only written when replaced by a different value.
+        sqlite syncs each transaction to disk, so fsync has no effect.
+        """
+        current = {}
+        changed = []
+        for section, entries in jupyterhub_config.items():
+            for key, entry in entries.items():
+                saved = self._saved.get((section, key))
+                if saved is not None and saved[0] is entry:
+                    current[(section, key)] = saved
+                    continue
+                # replaced, e.g. by a compact record after loading,
+                # but only written if the value changed
+                value = json.dumps(plain_route_entry(entry), sort_keys=True)
+                current[(section, key)] = (entry, value)
+                if saved is None or saved[1] != value:
+                    changed.append((section, key, value))
+        deleted = [key for key in self._saved if key not in current]
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO jupyterhub (section, key, value) VALUES (?, ?, ?)",
+                changed,
+            )
+            self._db.executemany(
+                "DELETE FROM jupyterhub WHERE section = ? AND key = ?", deleted
+            )
+        self._saved = current
+
+    def remove(self):
+        self._db.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def route_metadata_store(path):
+    """Return a route metadata store for path, chosen by its extension"""
+    ext = path.rsplit(".", 1)[-1]
+    if ext == "json":
+        return JSONRouteMetadataStore(path)
+    elif ext in {"sqlite", "sqlite3", "db"}:
+        return SQLiteRouteMetadataStore(path)
+    else:
+        raise ValueError(
+            f"Route metadata file must end with .json or .sqlite, not {path!r}"
+        )
+
 
 def deep_merge(a, b):
     """Merges dict b into dict a, returning a
@@ -165,3 +797,114 @@ def deep_merge(a, b):
         else:
             a[k] = v
     return a
+
+
+class WriteBatcher:
+    """Coalesce concurrent writes into batches
+
+    Items submitted within `window` seconds of the first pending item
+    (or until `max_size` items are pending)
+    are handled together by a single call to `flush(items)`.
+
+    `flush` is an async function taking a list of items.
+    It may return a list with one result per item,
+    where an Exception instance is raised only to that item's caller.
+    If `flush` raises, every caller in the batch gets the error.
+    """
+
+    def __init__(self, flush, *, window, max_size):
+        self._flush = flush
+        self.window = window
+        self.max_size = max_size
+        self._pending = []
+        self._timer = None
+        # strong references to flushes in progress,
+        # so they aren't garbage-collected while running
+        self._flushes = set()
+
+    async def submit(self, item):
+        """Submit an item, returning when the batch it is in has been flushed"""
+        f = asyncio.get_running_loop().create_future()
+        self._pending.append((item, f))
+        if len(self._pending) >= self.max_size:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.window, self._start_flush
+            )
+        return await f
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._flush_batch(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _flush_batch(self, batch):
+        try:
+            try:
+                results = await self._flush([item for item, f in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            if results is None:
+                results = [None] * len(batch)
+            for (item, f), result in zip(batch, results):
+                if f.done():
+                    # caller gave up waiting
+                    continue
+                if isinstance(result, Exception):
+                    f.set_exception(result)
+                else:
+                    f.set_result(result)
+        finally:
+            # if the flush was interrupted (e.g. cancelled),
+            # don't leave its callers waiting forever
+            for item, f in batch:
+                if not f.done():
+                    f.cancel()
+
+
+class SingleFlight:
+    """Share one call among concurrent identical calls
+
+    `run(name, func, *args)` calls `await func(*args)`,
+    unless a call with the same name, func and args is already in progress,
+    in which case it waits for that call's result (or error) instead.
+    Pass `key` to identify calls by something else than (name, func, *args),
+    e.g. when args are unhashable or shouldn't keep calls apart.
+
+    Waiting callers are shielded from each other:
+    cancelling one caller doesn't cancel the shared call for the others.
+
+    `calls` counts the calls actually made, by name,
+    and `hits` the calls that shared a call already in progress.
+    """
+
+    def __init__(self):
+        self._in_flight = {}
+        self.calls = Counter()
+        self.hits = Counter()
+
+    async def run(self, name, func, *args, key=None):
+        if key is None:
+            key = (name, func) + args
+        f = self._in_flight.get(key)
+        if f is None:
+            self.calls[name] += 1
+            f = self._in_flight[key] = asyncio.ensure_future(func(*args))
+
+            def _done(f):
+                if self._in_flight.get(key) is f:
+                    self._in_flight.pop(key)
+                if not f.cancelled():
+                    # avoid 'exception never retrieved' if every caller gave up
+                    f.exception()
+
+            f.add_done_callback(_done)
+        else:
+            self.hits[name] += 1
+        return await asyncio.shield(f)
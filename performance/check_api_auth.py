@@ -0,0 +1,144 @@
+"""Measure the latency of traefik api requests for each api auth mode
+
+traefik verifies the api password on every request,
+including every poll while waiting for a route to be registered.
+
+Usage:
+
+    python3 -m performance.check_api_auth --requests=200 --concurrency=10
+
+or, without traefik, only measure the cost of verifying the password hash:
+
+    python3 -m performance.check_api_auth --verify-only
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import statistics
+import time
+from tempfile import TemporaryDirectory
+
+import bcrypt
+
+from jupyterhub_traefik_proxy.fileprovider import TraefikFileProviderProxy
+
+# (label, proxy config)
+modes = [
+    ("bcrypt-12", dict(traefik_api_auth="bcrypt", traefik_api_bcrypt_rounds=12)),
+    ("bcrypt-8", dict(traefik_api_auth="bcrypt", traefik_api_bcrypt_rounds=8)),
+    ("bcrypt-4", dict(traefik_api_auth="bcrypt", traefik_api_bcrypt_rounds=4)),
+    ("sha1", dict(traefik_api_auth="sha1")),
+    ("none", dict(traefik_api_auth="none")),
+]
+
+
+def summarize(label, times):
+    times = sorted(times)
+    p95 = times[int(0.95 * (len(times) - 1))]
+    print(
+        f"{label:>10}: mean={1e3 * statistics.mean(times):7.3f}ms"
+        f" median={1e3 * statistics.median(times):7.3f}ms"
+        f" p95={1e3 * p95:7.3f}ms"
+    )
+
+
+def measure_verify(n):
+    """Measure the cost of verifying the password, as traefik does on each request"""
+    password = b"secret"
+    print(f"Verifying password hash {n} times")
+    for label, config in modes:
+        if config["traefik_api_auth"] == "bcrypt":
+            hashed = bcrypt.hashpw(
+                password, bcrypt.gensalt(config["traefik_api_bcrypt_rounds"])
+            )
+
+            def verify():
+                return bcrypt.checkpw(password, hashed)
+
+        elif config["traefik_api_auth"] == "sha1":
+            hashed = base64.b64encode(hashlib.sha1(password).digest())
+
+            def verify():
+                return hmac.compare_digest(
+                    base64.b64encode(hashlib.sha1(password).digest()), hashed
+                )
+
+        else:
+
+            def verify():
+                return True
+
+        times = []
+        for i in range(n):
+            tic = time.perf_counter()
+            verify()
+            times.append(time.perf_counter() - tic)
+        summarize(label, times)
+
+
+async def measure_requests(label, config, n, concurrency):
+    """Measure the latency of api requests against a running traefik"""
+    with TemporaryDirectory() as td:
+        proxy = TraefikFileProviderProxy(
+            public_url="http://127.0.0.1:8000",
+            traefik_api_url="http://127.0.0.1:8099",
+            traefik_api_password="admin",
+            traefik_api_username="admin",
+            static_config_file=os.path.join(td, "traefik.toml"),
+            dynamic_config_file=os.path.join(td, "rules.toml"),
+            should_start=True,
+            **config,
+        )
+        await proxy.start()
+        try:
+            semaphore = asyncio.Semaphore(concurrency)
+            times = []
+
+            async def one_request():
+                async with semaphore:
+                    tic = time.perf_counter()
+                    await proxy._traefik_api_request("/api/overview")
+                    times.append(time.perf_counter() - tic)
+
+            # warmup
+            await one_request()
+            times.clear()
+            await asyncio.gather(*(one_request() for i in range(n)))
+            summarize(label, times)
+        finally:
+            await proxy.stop()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--requests", type=int, default=100, help="Number of requests per mode"
+    )
+    parser.add_argument(
+        "-j",
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Number of concurrent api requests",
+    )
+    parser.add_argument(
+        "--verify-only",
+        action="store_true",
+        help="Only measure the cost of verifying the hash, without running traefik",
+    )
+    args = parser.parse_args()
+
+    measure_verify(args.requests)
+    if args.verify_only:
+        return
+    print(f"Making {args.requests} traefik api requests, {args.concurrency} at a time")
+    for label, config in modes:
+        await measure_requests(label, config, args.requests, args.concurrency)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
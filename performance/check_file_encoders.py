@@ -0,0 +1,67 @@
+"""Compare the encoders available for writing the file provider's dynamic config
+
+Measures the time to serialize the whole config and the resulting file size
+for each installed encoder (see `TraefikFileProviderProxy.dynamic_config_encoder`).
+
+Usage:
+
+    python3 -m performance.check_file_encoders --routes 1000 10000 50000
+"""
+
+import argparse
+import os
+import time
+from tempfile import TemporaryDirectory
+
+from jupyterhub_traefik_proxy import traefik_utils
+
+from .check_file_persist import make_config
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--routes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 50000],
+        help="Numbers of routes",
+    )
+    parser.add_argument(
+        "--encoders",
+        nargs="+",
+        default=list(traefik_utils.encoders),
+        help="Encoders to test",
+    )
+    parser.add_argument(
+        "--verify", action="store_true", help="Check that each file loads correctly"
+    )
+    args = parser.parse_args()
+
+    print(f"{'encoder':>10} {'routes':>8} {'dump':>12} {'size':>10}")
+    for n in args.routes:
+        config = make_config(n)
+        for encoder in args.encoders:
+            ext = traefik_utils.encoders[encoder][0]
+            with TemporaryDirectory() as td:
+                path = os.path.join(td, f"rules.{ext}")
+                try:
+                    handler = traefik_utils.TraefikConfigFileHandler(
+                        path, encoder=encoder
+                    )
+                except ImportError as e:
+                    print(f"{encoder:>10}: skipped ({e})")
+                    continue
+                tic = time.perf_counter()
+                handler.atomic_dump(config)
+                dump_time = time.perf_counter() - tic
+                size = os.stat(path).st_size
+                print(
+                    f"{encoder:>10} {n:8} {dump_time * 1e3:10.1f}ms {size / 1024:8.0f}kB"
+                )
+                if args.verify:
+                    assert handler.load() == config
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Measure the cost of syncing the file provider's dynamic config to disk
+
+Adds routes to a proxy with and without `TraefikFileProviderProxy.dynamic_config_fsync`,
+one at a time and many at once,
+and reports the average time per route.
+With many concurrent changes, syncing is shared by all changes in a write.
+
+The cost of fsync depends heavily on the filesystem,
+so run this in the directory where the dynamic config will live, e.g.:
+
+    python3 -m performance.check_file_fsync --dir /var/run/traefik --routes 200
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from tempfile import TemporaryDirectory
+
+from jupyterhub_traefik_proxy.fileprovider import TraefikFileProviderProxy
+
+
+async def add_routes(proxy, n, concurrency):
+    sem = asyncio.Semaphore(concurrency)
+
+    async def add(i):
+        async with sem:
+            await proxy.add_route(
+                f"/user/user{i}/", f"http://10.0.{i // 256}.{i % 256}:8888", {}
+            )
+
+    await asyncio.gather(*(add(i) for i in range(n)))
+
+
+async def measure(args, fsync, concurrency):
+    with TemporaryDirectory(dir=args.dir) as td:
+        proxy = TraefikFileProviderProxy(
+            dynamic_config_file=os.path.join(td, "rules.toml"),
+            dynamic_config_fsync=fsync,
+        )
+        # skip waiting for traefik
+        proxy._wait_for_route = lambda *args, **kwargs: asyncio.sleep(0)
+        tic = time.perf_counter()
+        await add_routes(proxy, args.routes, concurrency)
+        elapsed = time.perf_counter() - tic
+        proxy.executor.shutdown()
+    label = f"fsync={fsync}, concurrency={concurrency}"
+    print(f"{label:>32}: {1e3 * elapsed / args.routes:8.3f}ms/route")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--routes", type=int, default=200, help="Number of routes")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        nargs="+",
+        default=[1, 10, 100],
+        help="Numbers of routes to add at once",
+    )
+    parser.add_argument(
+        "--dir", default=None, help="Directory to write in (default: system temp)"
+    )
+    args = parser.parse_args()
+    for concurrency in args.concurrency:
+        for fsync in (False, True):
+            await measure(args, fsync, concurrency)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+"""Measure the cost of serializing the file provider's dynamic config
+
+Compares a full dump of the config with assembling it from cached per-route fragments,
+after changing a single route, as happens on each add_route.
+
+Usage:
+
+    python3 -m performance.check_file_persist --routes=10000
+"""
+
+import argparse
+import os
+import time
+from tempfile import TemporaryDirectory
+
+from jupyterhub_traefik_proxy import traefik_utils
+from jupyterhub_traefik_proxy.fileprovider import _route_sections
+from jupyterhub_traefik_proxy.proxy import TraefikProxy
+
+
+def make_config(n):
+    proxy = TraefikProxy()
+    config = {"http": {"routers": {}, "services": {}}, "jupyterhub": {"routes": {}}}
+    for i in range(n):
+        traefik_config, jupyterhub_config = proxy._dynamic_config_for_route(
+            f"/user/user{i}/",
+            f"http://10.0.{i // 256}.{i % 256}:8888",
+            {"user": f"user{i}"},
+        )
+        traefik_utils.deep_merge(config, traefik_config)
+        traefik_utils.deep_merge(config["jupyterhub"], jupyterhub_config)
+    return config
+
+
+def measure(label, f, repeat):
+    times = []
+    for i in range(repeat):
+        tic = time.perf_counter()
+        f(i)
+        times.append(time.perf_counter() - tic)
+    print(f"{label:>24}: {1e3 * min(times):9.3f}ms (best of {repeat})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--routes", type=int, default=10000, help="Number of routes")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of repetitions")
+    parser.add_argument(
+        "--format", nargs="*", default=["toml", "yaml"], help="File formats to test"
+    )
+    args = parser.parse_args()
+    config = make_config(args.routes)
+    print(f"Serializing {args.routes} routes")
+
+    for fmt in args.format:
+        print(fmt)
+        with TemporaryDirectory() as td:
+            path = os.path.join(td, f"rules.{fmt}")
+            handler = traefik_utils.TraefikConfigFileHandler(path)
+            cache = traefik_utils.ConfigFragmentCache(handler, _route_sections)
+            proxy = TraefikProxy()
+
+            def change_route(i):
+                """Change one route, as add_route would"""
+                routespec = "/user/user0/"
+                target = f"http://10.1.0.{i % 256}:8888"
+                traefik_config, jupyterhub_config = proxy._dynamic_config_for_route(
+                    routespec, target, {"user": "user0"}
+                )
+                traefik_utils.deep_merge(config, traefik_config)
+                traefik_utils.deep_merge(config["jupyterhub"], jupyterhub_config)
+                alias = traefik_utils.generate_alias(routespec, "router")
+                service_alias = traefik_utils.generate_alias(routespec, "service")
+                cache.invalidate(
+                    [
+                        ["http", "routers", alias],
+                        ["http", "services", service_alias],
+                        ["jupyterhub", "routes", alias],
+                    ]
+                )
+
+            def full_dump(i):
+                change_route(i)
+                handler.atomic_dump(config)
+
+            def cold_fragments(i):
+                cache.clear()
+                handler.atomic_write_text(cache.render(config))
+
+            def warm_fragments(i):
+                change_route(i)
+                handler.atomic_write_text(cache.render(config))
+
+            measure("full dump", full_dump, args.repeat)
+            measure("fragments (cold cache)", cold_fragments, args.repeat)
+            measure("fragments (one change)", warm_fragments, args.repeat)
+            assert handler.load() == config
+            print(f"{'file size':>24}: {os.stat(path).st_size / 1024:9.0f}kB")
+
+
+if __name__ == "__main__":
+    main()
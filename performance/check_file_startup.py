@@ -0,0 +1,95 @@
+"""Measure how long the file provider takes to load an existing dynamic config on startup
+
+With a rules file left over from a previous run,
+the proxy can't list its routes (which JupyterHub does during startup)
+until the whole file has been loaded.
+This measures the time from creating the proxy until `get_all_routes()` returns,
+with the previous loaders (`toml.load` and ruamel's round-trip loader),
+the current fast loaders, and with `dynamic_config_cache_file`.
+
+Usage:
+
+    python3 -m performance.check_file_startup --routes 10000
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from tempfile import TemporaryDirectory
+
+from jupyterhub_traefik_proxy import traefik_utils
+from jupyterhub_traefik_proxy.fileprovider import TraefikFileProviderProxy
+
+from .check_file_persist import make_config
+
+
+def legacy_loads(fmt):
+    """The loaders used before the fast load path"""
+    if fmt == "toml":
+        import toml
+
+        return toml.loads
+    else:
+        from ruamel.yaml import YAML
+
+        return YAML(typ="rt").load
+
+
+async def measure(label, make_proxy, n, repeat):
+    times = []
+    for i in range(repeat):
+        tic = time.perf_counter()
+        proxy = make_proxy()
+        await proxy._load_dynamic_config_async()
+        routes = await proxy.get_all_routes()
+        times.append(time.perf_counter() - tic)
+        assert len(routes) == n
+    print(f"{label:>24}: {min(times):8.3f}s (best of {repeat})")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--routes", type=int, default=10000, help="Number of routes")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of repetitions")
+    parser.add_argument(
+        "--encoders",
+        nargs="+",
+        default=["toml", "ruamel", "json"],
+        help="Encoders used to write the rules file",
+    )
+    args = parser.parse_args()
+    config = make_config(args.routes)
+
+    for encoder in args.encoders:
+        fmt = traefik_utils.encoders[encoder][0]
+        print(f"{args.routes} routes in {fmt} file written by {encoder}")
+        with TemporaryDirectory() as td:
+            rules = os.path.join(td, f"rules.{fmt}")
+            cache = os.path.join(td, "rules-cache.json")
+            traefik_utils.TraefikConfigFileHandler(rules, encoder=encoder).atomic_dump(
+                config
+            )
+
+            def legacy_proxy():
+                proxy = TraefikFileProviderProxy(dynamic_config_file=rules)
+                proxy.dynamic_config_handler._loads = legacy_loads(fmt)
+                return proxy
+
+            def fast_proxy():
+                return TraefikFileProviderProxy(dynamic_config_file=rules)
+
+            def cached_proxy():
+                return TraefikFileProviderProxy(
+                    dynamic_config_file=rules, dynamic_config_cache_file=cache
+                )
+
+            await measure("before", legacy_proxy, args.routes, args.repeat)
+            await measure("fast loader", fast_proxy, args.routes, args.repeat)
+            # the first load with a cache file parses and writes the cache
+            await measure("fast loader + cache", cached_proxy, args.routes, 1)
+            await measure("cache hit", cached_proxy, args.routes, args.repeat)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,130 @@
+"""Measure the cost of flattening route config for key-value stores
+
+Compares building the nested config for each route
+and flattening it with the previous (recursive) `flatten_dict_for_kv`,
+with emitting the flat keys directly (`TKvProxy._dynamic_config_for_route`),
+for a single route and a bulk load of many routes (as in `add_routes`),
+and the previous and current `flatten_dict_for_kv` on the merged nested config.
+
+Usage:
+
+    python3 -m performance.check_kv_flatten --routes 10000
+"""
+
+import argparse
+import time
+from collections.abc import Mapping
+
+from jupyterhub_traefik_proxy.kv_proxy import TKvProxy
+from jupyterhub_traefik_proxy.proxy import TraefikProxy
+from jupyterhub_traefik_proxy.traefik_utils import deep_merge
+
+
+def legacy_flatten(proxy, data, prefix=""):
+    """The recursive flatten_dict_for_kv, before the iterative version"""
+    sep = proxy.kv_separator
+    items = {}
+    for k, v in data.items():
+        if prefix:
+            new_key = f"{prefix}{sep}{k}"
+        else:
+            new_key = k
+        if isinstance(v, list):
+            v = {str(i): item for i, item in enumerate(v)}
+        if isinstance(v, Mapping):
+            items.update(legacy_flatten(proxy, v, prefix=new_key))
+        else:
+            v = proxy._kv_to_str(v)
+            if not isinstance(v, str):
+                raise ValueError(f"Cannot upload {new_key}: {v} to kv store")
+            items[new_key] = v
+    return items
+
+
+def route_args(i):
+    return (
+        f"/user/user{i}/",
+        f"http://10.0.{i // 256}.{i % 256}:8888",
+        {"user": f"user{i}", "server_name": "", "tags": ["a", "b"]},
+    )
+
+
+def legacy_routes(proxy, n):
+    """Nested config for each route, merged, then flattened"""
+    traefik_config = {}
+    jupyterhub_config = {}
+    for i in range(n):
+        route_traefik, route_jupyterhub = TraefikProxy._dynamic_config_for_route(
+            proxy, *route_args(i)
+        )
+        deep_merge(traefik_config, route_traefik)
+        deep_merge(jupyterhub_config, route_jupyterhub)
+    to_set = legacy_flatten(proxy, traefik_config, prefix=proxy.kv_traefik_prefix)
+    to_set.update(
+        legacy_flatten(proxy, jupyterhub_config, prefix=proxy.kv_jupyterhub_prefix)
+    )
+    return to_set
+
+
+def flat_routes(proxy, n):
+    """Flat keys for each route, merged"""
+    to_set = {}
+    for i in range(n):
+        route_traefik, route_jupyterhub = proxy._dynamic_config_for_route(
+            *route_args(i)
+        )
+        to_set.update(route_traefik)
+        to_set.update(route_jupyterhub)
+    return to_set
+
+
+def measure(label, f, repeat):
+    times = []
+    for i in range(repeat):
+        tic = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - tic)
+    print(f"{label:>32}: {1e3 * min(times):10.3f}ms (best of {repeat})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--routes", type=int, default=10000, help="Number of routes")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of repetitions")
+    args = parser.parse_args()
+    proxy = TKvProxy()
+    assert legacy_routes(proxy, 10) == flat_routes(proxy, 10)
+
+    print("single route")
+    measure("nested + recursive flatten", lambda: legacy_routes(proxy, 1), 1000)
+    measure("flat keys", lambda: flat_routes(proxy, 1), 1000)
+
+    print(f"{args.routes} routes")
+    measure(
+        "nested + recursive flatten",
+        lambda: legacy_routes(proxy, args.routes),
+        args.repeat,
+    )
+    measure("flat keys", lambda: flat_routes(proxy, args.routes), args.repeat)
+
+    traefik_config = {}
+    for i in range(args.routes):
+        deep_merge(
+            traefik_config,
+            TraefikProxy._dynamic_config_for_route(proxy, *route_args(i))[0],
+        )
+    print(f"flattening nested config for {args.routes} routes")
+    measure(
+        "recursive",
+        lambda: legacy_flatten(proxy, traefik_config, "traefik"),
+        args.repeat,
+    )
+    measure(
+        "iterative",
+        lambda: proxy.flatten_dict_for_kv(traefik_config, "traefik"),
+        args.repeat,
+    )
+
+
+if __name__ == "__main__":
+    main()
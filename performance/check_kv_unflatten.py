@@ -0,0 +1,111 @@
+"""Measure the cost of rebuilding route trees read from key-value stores
+
+`get_all_routes` with a key-value store provider reads every key
+under `kv_jupyterhub_prefix` and rebuilds the tree with `unflatten_dict_from_kv`.
+This compares the previous implementation (sort by depth, then insert)
+with the current single pass, on the keys of many routes.
+
+Usage:
+
+    python3 -m performance.check_kv_unflatten --keys 100000
+"""
+
+import argparse
+import random
+import time
+
+from jupyterhub_traefik_proxy.kv_proxy import TKvProxy
+
+
+def legacy_unflatten(proxy, kv_list, root_key=""):
+    """The previous unflatten_dict_from_kv"""
+    sep = proxy.kv_separator
+
+    def by_depth(item):
+        key, value = item
+        key_path = key.split(sep)
+        for i, label in enumerate(key_path):
+            if label.isdigit():
+                key_path[i] = int(label)
+        return len(key.split(sep))
+
+    tree = {}
+    for key, value in sorted(kv_list, key=by_depth):
+        key_path = key.split(sep)
+        d = tree
+        for parent_key, key in zip(key_path[:-1], key_path[1:]):
+            if parent_key.isdigit():
+                parent_key = int(parent_key)
+            if isinstance(d, dict) and parent_key not in d:
+                d[parent_key] = [] if key.isdigit() else {}
+            elif isinstance(d, list):
+                d.append([] if key.isdigit() else {})
+            d = d[parent_key]
+        if isinstance(d, list):
+            if len(d) != int(key):
+                raise IndexError(f"Got invalid list key {key_path}")
+            d.append(value)
+        else:
+            d[key] = value
+    if root_key:
+        for key in root_key.strip(sep).split(sep):
+            if key not in tree:
+                return {}
+            tree = tree[key]
+    return tree
+
+
+def make_kv_list(proxy, n_keys):
+    """Flat jupyterhub keys for enough routes to have n_keys keys"""
+    kv = {}
+    i = 0
+    while len(kv) < n_keys:
+        kv.update(
+            proxy._dynamic_config_for_route(
+                f"/user/user{i}/",
+                f"http://10.0.{i // 256}.{i % 256}:8888",
+                {"user": f"user{i}", "server_name": ""},
+            )[1]
+        )
+        i += 1
+    kv_list = list(kv.items())
+    # key-value stores don't return keys in insertion order
+    random.Random(0).shuffle(kv_list)
+    return i, kv_list
+
+
+def measure(label, f, repeat):
+    times = []
+    for i in range(repeat):
+        tic = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - tic)
+    print(f"{label:>12}: {1e3 * min(times):10.1f}ms (best of {repeat})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--keys", type=int, default=100000, help="Number of keys")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of repetitions")
+    args = parser.parse_args()
+    proxy = TKvProxy()
+    n_routes, kv_list = make_kv_list(proxy, args.keys)
+    prefix = proxy.kv_jupyterhub_prefix
+    print(f"Rebuilding {len(kv_list)} keys for {n_routes} routes")
+    expected = legacy_unflatten(proxy, kv_list, root_key=prefix)
+    assert proxy.unflatten_dict_from_kv(kv_list, root_key=prefix) == expected
+
+    measure(
+        "before",
+        lambda: legacy_unflatten(proxy, kv_list, root_key=prefix),
+        args.repeat,
+    )
+    measure(
+        "single pass",
+        lambda: proxy.unflatten_dict_from_kv(kv_list, root_key=prefix),
+        args.repeat,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Measure the memory used by the file provider's in-memory route table
+
+Loads a dynamic config file with many routes,
+with and without `TraefikFileProviderProxy.compact_route_table`,
+and reports the memory retained per route, measured with tracemalloc.
+
+Usage:
+
+    python3 -m performance.check_route_memory --routes 50000
+"""
+
+import argparse
+import gc
+import os
+import tracemalloc
+from tempfile import TemporaryDirectory
+
+from jupyterhub_traefik_proxy import traefik_utils
+from jupyterhub_traefik_proxy.fileprovider import TraefikFileProviderProxy
+
+from .check_file_persist import make_config
+
+
+def measure(label, rules, n, **kwargs):
+    proxy = TraefikFileProviderProxy(dynamic_config_file=rules, **kwargs)
+    # load the handler outside the measurement
+    proxy.dynamic_config_handler
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    proxy.dynamic_config
+    gc.collect()
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(proxy.dynamic_config["jupyterhub"]["routes"]) == n
+    print(
+        f"{label:>12}: {(after - before) / n:8.0f} bytes/route"
+        f" ({(after - before) / 2**20:6.1f}MB total, peak {(peak - before) / 2**20:6.1f}MB)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--routes", type=int, default=50000, help="Number of routes")
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as td:
+        # json-as-yaml is the fastest to write and read
+        rules = os.path.join(td, "rules.yaml")
+        traefik_utils.TraefikConfigFileHandler(rules, encoder="json").atomic_dump(
+            make_config(args.routes)
+        )
+        print(f"Loading {args.routes} routes")
+        measure("dicts", rules, args.routes, compact_route_table=False)
+        measure("compact", rules, args.routes, compact_route_table=True)
+
+
+if __name__ == "__main__":
+    main()
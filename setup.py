@@ -21,6 +21,8 @@ setup(
         "consul": ["python-consul2"],
         "etcd": ["etcdpy"],
         "yaml": ["ruamel.yaml"],
+        # for traefik_api_keep_alive
+        "keepalive": ["pycurl"],
         "test": [
             "jupyterhub-traefik-proxy[redis,etcd,consul,yaml]",
             "certipy",
@@ -309,6 +309,21 @@ async def file_proxy_toml(dynamic_config_dir, proxy_args):
     await proxy.stop()
 
 
+@pytest.fixture
+async def file_proxy_directory(dynamic_config_dir, proxy_args):
+    """Fixture returning a TraefikFileProviderProxy with a sharded config directory"""
+    proxy = TraefikFileProviderProxy(
+        dynamic_config_file="rules.toml",
+        dynamic_config_directory=str(dynamic_config_dir / "dynamic"),
+        static_config_file="traefik.toml",
+        should_start=True,
+        **proxy_args,
+    )
+    await proxy.start()
+    yield proxy
+    await proxy.stop()
+
+
 def _check_ssl(proxy, client_ca):
     context = ssl.create_default_context(
         purpose=ssl.Purpose.SERVER_AUTH,
@@ -458,6 +473,7 @@ async def auth_external_etcd_proxy(
         "auth_etcd_proxy",
         "file_proxy_toml",
         "file_proxy_yaml",
+        "file_proxy_directory",
         "external_consul_proxy",
         "auth_external_consul_proxy",
         "external_etcd_proxy",
@@ -0,0 +1,252 @@
+"""Tests for coalescing concurrent route updates"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from jupyterhub_traefik_proxy.traefik_utils import WriteBatcher
+
+from .utils import MemoryProxy
+
+
+async def test_write_batcher():
+    batches = []
+
+    async def flush(items):
+        batches.append(items)
+        return [item * 2 for item in items]
+
+    batcher = WriteBatcher(flush, window=0.1, max_size=4)
+    results = await asyncio.gather(*(batcher.submit(i) for i in range(10)))
+    assert results == [i * 2 for i in range(10)]
+    assert batches == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+
+
+async def test_write_batcher_errors():
+    async def flush(items):
+        if "fail all" in items:
+            raise RuntimeError("fail all")
+        return [ValueError(item) if item == "fail one" else item for item in items]
+
+    batcher = WriteBatcher(flush, window=0.01, max_size=10)
+    results = await asyncio.gather(
+        batcher.submit("ok"), batcher.submit("fail one"), return_exceptions=True
+    )
+    assert results[0] == "ok"
+    assert isinstance(results[1], ValueError)
+
+    results = await asyncio.gather(
+        batcher.submit("ok"), batcher.submit("fail all"), return_exceptions=True
+    )
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+async def test_write_batcher_cancelled():
+    started = asyncio.Event()
+
+    async def flush(items):
+        started.set()
+        await asyncio.sleep(10)
+
+    batcher = WriteBatcher(flush, window=0.01, max_size=10)
+    submits = [asyncio.ensure_future(batcher.submit(i)) for i in range(3)]
+    await started.wait()
+    # flushes in progress are referenced by the batcher
+    (flush_task,) = batcher._flushes
+    flush_task.cancel()
+    results = await asyncio.gather(*submits, return_exceptions=True)
+    assert all(isinstance(r, asyncio.CancelledError) for r in results)
+    await asyncio.sleep(0)
+    assert not batcher._flushes
+
+
+@pytest.mark.parametrize(
+    "window, expected_writes",
+    [
+        (0, 50),
+        (0.1, 3),
+    ],
+)
+async def test_add_route_batching(window, expected_writes):
+    proxy = MemoryProxy(route_batch_window=window, route_batch_size=20)
+    await asyncio.gather(
+        *(
+            proxy.add_route(f"/user/{i}/", f"http://127.0.0.1:{9000 + i}", {"i": i})
+            for i in range(50)
+        )
+    )
+    assert len(proxy.writes) == expected_writes
+    routes = await proxy.get_all_routes()
+    assert sorted(routes) == sorted(f"/user/{i}/" for i in range(50))
+    assert routes["/user/7/"] == {
+        "routespec": "/user/7/",
+        "target": "http://127.0.0.1:9007",
+        "data": {"i": 7},
+    }
+    assert len(proxy.dynamic_config["http"]["routers"]) == 50
+
+
+async def test_route_batching_config_change():
+    proxy = MemoryProxy(route_batch_window=0.1, route_batch_size=20)
+    await proxy.add_route("/user/first/", "http://127.0.0.1:9000", {})
+    await proxy.delete_route("/user/first/")
+    proxy.writes.clear()
+    # batchers already created use the new settings
+    proxy.route_batch_size = 5
+    routespecs = [f"/user/{i}/" for i in range(10)]
+    await asyncio.gather(
+        *(proxy.add_route(spec, "http://127.0.0.1:9000", {}) for spec in routespecs)
+    )
+    await asyncio.gather(*(proxy.delete_route(spec) for spec in routespecs))
+    assert [write[0] for write in proxy.writes] == ["apply"] * 2 + ["delete"] * 2
+    assert proxy._add_route_batcher.window == 0.1
+    proxy.route_batch_window = 0.2
+    assert proxy._add_route_batcher.window == 0.2
+    assert proxy._delete_route_batcher.window == 0.2
+
+
+async def test_delete_route_batching():
+    proxy = MemoryProxy(route_batch_window=0.1, route_batch_size=20)
+    routespecs = [f"/user/{i}/" for i in range(30)]
+    await asyncio.gather(
+        *(proxy.add_route(spec, "http://127.0.0.1:9000", {}) for spec in routespecs)
+    )
+    proxy.writes.clear()
+    await asyncio.gather(*(proxy.delete_route(spec) for spec in routespecs[:25]))
+    assert [write[0] for write in proxy.writes] == ["delete", "delete"]
+    routes = await proxy.get_all_routes()
+    assert sorted(routes) == sorted(routespecs[25:])
+
+
+async def test_delete_route_batch_errors():
+    class FailingProxy(MemoryProxy):
+        async def _delete_dynamic_config(self, traefik_keys, jupyterhub_keys):
+            for key_path in jupyterhub_keys:
+                if key_path[-1].endswith("_2Fbad_2F"):
+                    raise KeyError(key_path[-1])
+            await super()._delete_dynamic_config(traefik_keys, jupyterhub_keys)
+
+    proxy = FailingProxy(route_batch_window=0.1)
+    routespecs = ["/good/", "/bad/", "/also-good/"]
+    await asyncio.gather(
+        *(proxy.add_route(spec, "http://127.0.0.1:9000", {}) for spec in routespecs)
+    )
+    results = await asyncio.gather(
+        *(proxy.delete_route(spec) for spec in routespecs), return_exceptions=True
+    )
+    assert results[0] is None
+    assert isinstance(results[1], KeyError)
+    assert results[2] is None
+    routes = await proxy.get_all_routes()
+    assert sorted(routes) == ["/bad/"]
+
+
+async def test_add_delete_routes():
+    proxy = MemoryProxy()
+    routes = [
+        (f"/user/{i}", f"http://127.0.0.1:{9000 + i}", {"user": f"{i}"})
+        for i in range(200)
+    ]
+    await proxy.add_routes(routes)
+    assert [write[0] for write in proxy.writes] == ["apply"]
+    all_routes = await proxy.get_all_routes()
+    assert len(all_routes) == 200
+    assert all_routes["/user/5/"] == {
+        "routespec": "/user/5/",
+        "target": "http://127.0.0.1:9005",
+        "data": {"user": "5"},
+    }
+
+    proxy.writes.clear()
+    await proxy.delete_routes([routespec for routespec, _, _ in routes[:150]])
+    assert [write[0] for write in proxy.writes] == ["delete"]
+    all_routes = await proxy.get_all_routes()
+    assert sorted(all_routes) == sorted(f"/user/{i}/" for i in range(150, 200))
+
+    # empty lists are a no-op
+    proxy.writes.clear()
+    await proxy.add_routes([])
+    await proxy.delete_routes([])
+    assert proxy.writes == []
+
+
+def _mock_user(name, host, ready=True, pending=None):
+    spawner = SimpleNamespace(
+        ready=ready,
+        pending=pending,
+        proxy_spec=f"/user/{name}/",
+        server=SimpleNamespace(host=host),
+    )
+    return SimpleNamespace(name=name, spawners={"": spawner})
+
+
+async def test_check_routes_bulk():
+    proxy = MemoryProxy()
+    proxy.app = SimpleNamespace(hub=SimpleNamespace(routespec="/"))
+    proxy.hub = SimpleNamespace(routespec="/", host="http://127.0.0.1:8081")
+    await proxy.add_routes(
+        [
+            ("/user/stale/", "http://127.0.0.1:9000", {"user": "stale"}),
+            ("/user/moved/", "http://127.0.0.1:9001", {"user": "moved"}),
+            ("/user/ok/", "http://127.0.0.1:9002", {"user": "ok"}),
+            ("/user/pending/", "http://127.0.0.1:9003", {"user": "pending"}),
+        ]
+    )
+    users = {
+        "moved": _mock_user("moved", "http://127.0.0.1:9999"),
+        "ok": _mock_user("ok", "http://127.0.0.1:9002"),
+        "pending": _mock_user("pending", None, ready=False, pending="stop"),
+    }
+    users.update(
+        {f"new{i}": _mock_user(f"new{i}", f"http://10.0.0.{i}:8888") for i in range(50)}
+    )
+    service = SimpleNamespace(
+        name="svc",
+        proxy_spec="/services/svc/",
+        server=SimpleNamespace(host="http://127.0.0.1:7000"),
+    )
+
+    proxy.writes.clear()
+    await proxy.check_routes(users, {"svc": service})
+    # one bulk write for additions and changes, one for deletions
+    assert sorted(write[0] for write in proxy.writes) == ["apply", "delete"]
+
+    routes = await proxy.get_all_routes()
+    assert "/user/stale/" not in routes
+    assert "/user/pending/" in routes
+    assert routes["/user/moved/"]["target"] == "http://127.0.0.1:9999"
+    assert routes["/"]["data"] == {"hub": True}
+    assert routes["/services/svc/"]["data"] == {"service": "svc"}
+    assert routes["/user/new7/"] == {
+        "routespec": "/user/new7/",
+        "target": "http://10.0.0.7:8888",
+        "data": {"user": "new7", "server_name": ""},
+    }
+
+    # nothing to do the second time
+    proxy.writes.clear()
+    await proxy.check_routes(users, {"svc": service})
+    assert proxy.writes == []
+
+
+async def test_check_routes_shared():
+    class SlowProxy(MemoryProxy):
+        reads = 0
+
+        async def get_all_routes(self):
+            self.reads += 1
+            await asyncio.sleep(0.1)
+            return await super().get_all_routes()
+
+    proxy = SlowProxy()
+    proxy.app = SimpleNamespace(hub=SimpleNamespace(routespec="/"))
+    proxy.hub = SimpleNamespace(routespec="/", host="http://127.0.0.1:8081")
+    users = {"ok": _mock_user("ok", "http://127.0.0.1:9002")}
+
+    await asyncio.gather(*(proxy.check_routes(users, {}) for i in range(5)))
+    assert proxy.reads == 1
+    assert proxy._single_flight.calls["check_routes"] == 1
+    assert proxy._single_flight.hits["check_routes"] == 4
+    routes = await proxy.get_all_routes()
+    assert sorted(routes) == ["/", "/user/ok/"]
@@ -0,0 +1,585 @@
+"""Tests for the file provider's dynamic config directory mode
+
+These don't need traefik to be running
+"""
+
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+from jupyterhub_traefik_proxy import traefik_utils
+from jupyterhub_traefik_proxy.fileprovider import TraefikFileProviderProxy
+
+
+@pytest.fixture(params=["toml", "yaml"])
+def make_proxy(request, tmp_path):
+    ext = request.param
+
+    def make_proxy(**kwargs):
+        kwargs.setdefault("dynamic_config_shards", 4)
+        return TraefikFileProviderProxy(
+            dynamic_config_file=f"rules.{ext}",
+            dynamic_config_directory=str(tmp_path / "dynamic"),
+            should_start=True,
+            traefik_api_username="admin",
+            traefik_api_password="admin",
+            traefik_api_url="http://127.0.0.1:8099",
+            **kwargs,
+        )
+
+    return make_proxy
+
+
+async def add_route(proxy, routespec, target="http://127.0.0.1:9000"):
+    await proxy._apply_dynamic_config(
+        *proxy._dynamic_config_for_route(routespec, target, {"user": "x"})
+    )
+
+
+@pytest.fixture
+def written(monkeypatch):
+    """Record the paths of rewritten config files"""
+    written = []
+    original = TraefikFileProviderProxy._write_config_file
+
+    def _write_config_file(self, path, config, **kwargs):
+        written.append(os.path.basename(path))
+        return original(self, path, config, **kwargs)
+
+    monkeypatch.setattr(
+        TraefikFileProviderProxy, "_write_config_file", _write_config_file
+    )
+    return written
+
+
+async def test_static_config_directory(make_proxy):
+    proxy = make_proxy()
+    proxy.static_config_file = os.path.join(
+        os.path.dirname(proxy.dynamic_config_directory), "traefik.toml"
+    )
+    await proxy._setup_traefik_static_config()
+    assert proxy.static_config["providers"]["file"] == {
+        "directory": proxy.dynamic_config_directory,
+        "watch": True,
+    }
+
+
+async def test_sharded_writes(make_proxy, written):
+    proxy = make_proxy()
+    ext = proxy._dynamic_config_ext
+    await proxy._setup_traefik_dynamic_config()
+    assert f"base.{ext}" in written
+    routespecs = [f"/user/user{i}/" for i in range(20)]
+    for routespec in routespecs:
+        await add_route(proxy, routespec)
+    files = sorted(os.listdir(proxy.dynamic_config_directory))
+    assert files == [f"base.{ext}"] + [f"routes-{i:03d}.{ext}" for i in range(4)]
+
+    # one change only rewrites one shard, never the base config
+    written.clear()
+    await add_route(proxy, "/user/new/")
+    assert len(written) == 1
+    assert written[0].startswith("routes-")
+    written.clear()
+    await proxy.delete_routes(["/user/user3/"])
+    assert len(written) == 1
+    assert written[0].startswith("routes-")
+
+    # reloading the directory yields the same config
+    reloaded = make_proxy()
+    assert reloaded.dynamic_config == proxy.dynamic_config
+    routes = await reloaded.get_all_routes()
+    assert sorted(routes) == sorted(
+        [r for r in routespecs if r != "/user/user3/"] + ["/user/new/"]
+    )
+    assert "route_api" in reloaded.dynamic_config["http"]["routers"]
+
+    # emptied shards are removed
+    await proxy.delete_routes(list(routes))
+    assert os.listdir(proxy.dynamic_config_directory) == [f"base.{ext}"]
+
+
+async def test_change_shards(make_proxy):
+    proxy = make_proxy(dynamic_config_shards=8)
+    ext = proxy._dynamic_config_ext
+    await proxy._setup_traefik_dynamic_config()
+    for i in range(20):
+        await add_route(proxy, f"/user/user{i}/")
+    assert f"routes-007.{ext}" in os.listdir(proxy.dynamic_config_directory)
+
+    proxy = make_proxy(dynamic_config_shards=2)
+    await proxy._setup_traefik_dynamic_config()
+    assert sorted(os.listdir(proxy.dynamic_config_directory)) == [
+        f"base.{ext}",
+        f"routes-000.{ext}",
+        f"routes-001.{ext}",
+    ]
+    reloaded = make_proxy(dynamic_config_shards=2)
+    assert len(await reloaded.get_all_routes()) == 20
+
+
+async def test_persist_in_background(tmp_path, monkeypatch):
+    proxy = TraefikFileProviderProxy(
+        dynamic_config_file=str(tmp_path / "rules.toml"),
+        should_start=True,
+    )
+    original = TraefikFileProviderProxy._write_config_file
+    loop_thread = threading.get_ident()
+    write_threads = set()
+
+    def slow_write(self, path, config, **kwargs):
+        write_threads.add(threading.get_ident())
+        time.sleep(0.2)
+        return original(self, path, config, **kwargs)
+
+    monkeypatch.setattr(TraefikFileProviderProxy, "_write_config_file", slow_write)
+
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    ticker = asyncio.create_task(tick())
+    try:
+        await asyncio.gather(
+            *(add_route(proxy, f"/user/user{i}/") for i in range(3)),
+        )
+    finally:
+        ticker.cancel()
+    # the event loop kept running while writing
+    assert ticks > 10
+    assert loop_thread not in write_threads
+
+    # each write is on disk when the call returns
+    await add_route(proxy, "/user/last/", target="http://127.0.0.1:9999")
+    reloaded = TraefikFileProviderProxy(dynamic_config_file=proxy.dynamic_config_file)
+    routes = await reloaded.get_all_routes()
+    assert sorted(routes) == sorted(
+        ["/user/last/"] + [f"/user/user{i}/" for i in range(3)]
+    )
+    assert routes["/user/last/"]["target"] == "http://127.0.0.1:9999"
+
+    # updating a route doesn't modify snapshots in-place
+    router_alias = "router__2Fuser_2Flast_2F"
+    before = proxy.dynamic_config["jupyterhub"]["routes"][router_alias]
+    await add_route(proxy, "/user/last/", target="http://127.0.0.1:9998")
+    after = proxy.dynamic_config["jupyterhub"]["routes"][router_alias]
+    assert before is not after
+    assert before["target"] == "http://127.0.0.1:9999"
+    assert after["target"] == "http://127.0.0.1:9998"
+
+
+@pytest.mark.parametrize("directory", [False, True])
+async def test_group_commit(tmp_path, written, directory):
+    kwargs = {}
+    if directory:
+        kwargs["dynamic_config_directory"] = str(tmp_path / "dynamic")
+    proxy = TraefikFileProviderProxy(
+        dynamic_config_file=str(tmp_path / "rules.toml"),
+        dynamic_config_flush_interval=0.2,
+        should_start=True,
+        **kwargs,
+    )
+    routespecs = [f"/user/user{i}/" for i in range(50)]
+
+    async def add_later(i, routespec):
+        await asyncio.sleep(i * 0.005)
+        await add_route(proxy, routespec)
+        return time.perf_counter()
+
+    done = await asyncio.gather(
+        *(add_later(i, routespec) for i, routespec in enumerate(routespecs))
+    )
+    # one flush for the first route, one or two for the rest
+    if directory:
+        assert len(written) <= 3 * proxy.dynamic_config_shards
+    else:
+        assert 2 <= len(written) <= 3
+    # callers in the same flush are released together
+    assert max(done) - min(done[1:]) < 0.2 + 0.1
+
+    reloaded = TraefikFileProviderProxy(
+        dynamic_config_file=proxy.dynamic_config_file, **kwargs
+    )
+    assert sorted(await reloaded.get_all_routes()) == sorted(routespecs)
+
+
+async def test_group_commit_cleanup(tmp_path):
+    proxy = TraefikFileProviderProxy(
+        dynamic_config_file=str(tmp_path / "rules.toml"),
+        dynamic_config_flush_interval=10,
+        should_start=True,
+    )
+    await add_route(proxy, "/user/first/")
+    # the next flush waits for the interval
+    pending = asyncio.ensure_future(add_route(proxy, "/user/pending/"))
+    await asyncio.sleep(0.1)
+    assert not pending.done()
+    proxy._cleanup()
+    # callers waiting on the cancelled flush are released
+    with pytest.raises(asyncio.CancelledError):
+        await asyncio.wait_for(pending, 1)
+    assert proxy._flush_waiters == []
+
+
+@pytest.mark.parametrize("directory", [False, True])
+async def test_fsync_group_commit(tmp_path, monkeypatch, directory):
+    kwargs = {}
+    if directory:
+        kwargs["dynamic_config_directory"] = str(tmp_path / "dynamic")
+    proxy = TraefikFileProviderProxy(
+        dynamic_config_file=str(tmp_path / "rules.toml"),
+        dynamic_config_fsync=True,
+        **kwargs,
+    )
+    synced = []
+    fsync = os.fsync
+
+    def record_fsync(fd):
+        synced.append(fd)
+        # make syncing slow enough for changes to pile up
+        time.sleep(0.01)
+        fsync(fd)
+
+    monkeypatch.setattr(os, "fsync", record_fsync)
+    routespecs = [f"/user/user{i}/" for i in range(50)]
+    await asyncio.gather(*(add_route(proxy, routespec) for routespec in routespecs))
+    # one write for the first route, one for the rest
+    # each write syncs its files and their directory
+    if directory:
+        assert len(synced) <= 2 * (proxy.dynamic_config_shards + 1)
+    else:
+        assert len(synced) <= 2 * 2
+
+    reloaded = TraefikFileProviderProxy(
+        dynamic_config_file=proxy.dynamic_config_file, **kwargs
+    )
+    assert sorted(await reloaded.get_all_routes()) == sorted(routespecs)
+
+
+async def test_load_cache(tmp_path, monkeypatch):
+    rules = str(tmp_path / "rules.toml")
+    cache = str(tmp_path / "rules-cache.json")
+    proxy = TraefikFileProviderProxy(
+        dynamic_config_file=rules, dynamic_config_cache_file=cache
+    )
+    for i in range(5):
+        await add_route(proxy, f"/user/user{i}/")
+    assert os.path.exists(cache)
+
+    def load_fails(self):
+        raise AssertionError("Should have loaded from cache")
+
+    # unchanged file is loaded from the cache
+    with monkeypatch.context() as m:
+        m.setattr(traefik_utils.TraefikConfigFileHandler, "load", load_fails)
+        reloaded = TraefikFileProviderProxy(
+            dynamic_config_file=rules, dynamic_config_cache_file=cache
+        )
+        assert reloaded.dynamic_config == proxy.dynamic_config
+
+    # changing the file invalidates the cache
+    other = TraefikFileProviderProxy(dynamic_config_file=rules)
+    await add_route(other, "/user/other/")
+    loaded_threads = set()
+    original_read = TraefikFileProviderProxy._read_dynamic_config
+
+    def read_dynamic_config(self):
+        loaded_threads.add(threading.get_ident())
+        return original_read(self)
+
+    monkeypatch.setattr(
+        TraefikFileProviderProxy, "_read_dynamic_config", read_dynamic_config
+    )
+    reloaded = TraefikFileProviderProxy(
+        dynamic_config_file=rules, dynamic_config_cache_file=cache
+    )
+    # loaded in the background on startup
+    await reloaded._load_dynamic_config_async()
+    assert threading.get_ident() not in loaded_threads
+    assert "/user/other/" in await reloaded.get_all_routes()
+    assert reloaded.dynamic_config == other.dynamic_config
+
+
+@pytest.mark.parametrize("store_ext", ["json", "sqlite"])
+@pytest.mark.parametrize("directory", [False, True])
+async def test_route_metadata_file(tmp_path, store_ext, directory):
+    rules = str(tmp_path / "rules.toml")
+    kwargs = {}
+    if directory:
+        kwargs["dynamic_config_directory"] = str(tmp_path / "dynamic")
+
+    # start without a metadata file
+    proxy = TraefikFileProviderProxy(dynamic_config_file=rules, **kwargs)
+    await add_route(proxy, "/user/before/")
+
+    def rules_text():
+        text = ""
+        for path in proxy._dynamic_config_paths():
+            with open(path) as f:
+                text += f.read()
+        return text
+
+    assert "[jupyterhub.routes" in rules_text()
+
+    # existing metadata is moved to the metadata file
+    metadata_file = str(tmp_path / f"routes.{store_ext}")
+    kwargs["route_metadata_file"] = metadata_file
+    proxy = TraefikFileProviderProxy(dynamic_config_file=rules, **kwargs)
+    assert "/user/before/" in await proxy.get_all_routes()
+    for i in range(5):
+        await add_route(proxy, f"/user/user{i}/")
+    if directory:
+        await proxy._setup_traefik_dynamic_config()
+    await proxy.delete_routes(["/user/user3/"])
+    assert "[jupyterhub.routes" not in rules_text()
+    assert "router__2Fuser_2Fuser0_2F" in rules_text()
+    assert os.path.exists(metadata_file)
+
+    expected = sorted(["/user/before/"] + [f"/user/user{i}/" for i in (0, 1, 2, 4)])
+    assert sorted(await proxy.get_all_routes()) == expected
+    reloaded = TraefikFileProviderProxy(dynamic_config_file=rules, **kwargs)
+    routes = await reloaded.get_all_routes()
+    assert sorted(routes) == expected
+    assert routes["/user/user0/"]["data"] == {"user": "x"}
+    assert await reloaded.get_route("/user/user3/") is None
+
+    proxy._cleanup()
+    assert not os.path.exists(metadata_file)
+
+
+@pytest.mark.parametrize("compact_route_table", [True, False])
+async def test_route_metadata_sqlite_writes_changes(tmp_path, compact_route_table):
+    kwargs = dict(
+        dynamic_config_file=str(tmp_path / "rules.toml"),
+        route_metadata_file=str(tmp_path / "routes.sqlite"),
+        compact_route_table=compact_route_table,
+    )
+    proxy = TraefikFileProviderProxy(**kwargs)
+    for i in range(5):
+        await add_route(proxy, f"/user/user{i}/")
+
+    # loaded entries may be replaced in memory, but are unchanged
+    reloaded = TraefikFileProviderProxy(**kwargs)
+    db = reloaded._route_metadata_store._db
+    before = db.total_changes
+    await add_route(reloaded, "/user/new/")
+    assert db.total_changes - before == 1
+
+
+@pytest.mark.parametrize("store_ext", ["json", "sqlite"])
+async def test_route_metadata_file_no_routes(tmp_path, store_ext):
+    kwargs = dict(
+        dynamic_config_file=str(tmp_path / "rules.toml"),
+        route_metadata_file=str(tmp_path / f"routes.{store_ext}"),
+    )
+    proxy = TraefikFileProviderProxy(**kwargs)
+    await add_route(proxy, "/user/a/")
+    await proxy.delete_route("/user/a/")
+
+    # restart after the last route was deleted
+    reloaded = TraefikFileProviderProxy(**kwargs)
+    assert await reloaded.get_all_routes() == {}
+    await add_route(reloaded, "/user/b/")
+    assert sorted(await reloaded.get_all_routes()) == ["/user/b/"]
+
+
+async def test_reads_dont_wait_for_writes(tmp_path, monkeypatch):
+    proxy = TraefikFileProviderProxy(dynamic_config_file=str(tmp_path / "rules.toml"))
+    await add_route(proxy, "/user/a/")
+
+    writing = threading.Event()
+    finish = threading.Event()
+    original = TraefikFileProviderProxy._write_config_file
+
+    def blocked_write(self, path, config, **kwargs):
+        writing.set()
+        finish.wait(5)
+        return original(self, path, config, **kwargs)
+
+    monkeypatch.setattr(TraefikFileProviderProxy, "_write_config_file", blocked_write)
+    write = asyncio.ensure_future(add_route(proxy, "/user/b/"))
+    await asyncio.get_running_loop().run_in_executor(None, writing.wait, 5)
+    try:
+        async with proxy.mutex:
+            # reads don't need the lock, and don't see uncommitted changes
+            assert (await proxy.get_route("/user/a/"))["routespec"] == "/user/a/"
+            assert await proxy.get_route("/user/b/") is None
+            assert sorted(await proxy.get_all_routes()) == ["/user/a/"]
+    finally:
+        finish.set()
+    await write
+    # committed changes are visible as soon as the write completes
+    assert (await proxy.get_route("/user/b/"))["routespec"] == "/user/b/"
+    await proxy.delete_routes(["/user/a/"])
+    assert sorted(await proxy.get_all_routes()) == ["/user/b/"]
+
+
+@pytest.mark.parametrize("cache_route_fragments", [True, False])
+async def test_compact_route_table(tmp_path, cache_route_fragments):
+    rules = str(tmp_path / "rules.toml")
+    proxy = TraefikFileProviderProxy(
+        dynamic_config_file=rules,
+        compact_route_table=True,
+        cache_route_fragments=cache_route_fragments,
+    )
+    await add_route(proxy, "/user/a/")
+    await add_route(proxy, "/user/a/", target="http://127.0.0.1:9001")
+    http = proxy.dynamic_config["http"]
+    alias = "router__2Fuser_2Fa_2F"
+    assert isinstance(http["routers"][alias], traefik_utils.RouterRecord)
+    assert isinstance(
+        http["services"]["service__2Fuser_2Fa_2F"], traefik_utils.ServiceRecord
+    )
+    route = proxy.dynamic_config["jupyterhub"]["routes"][alias]
+    assert isinstance(route, traefik_utils.JupyterHubRouteRecord)
+    assert route["target"] == "http://127.0.0.1:9001"
+
+    # the file has the usual dict structure
+    loaded = traefik_utils.TraefikConfigFileHandler(rules).load()
+    assert loaded["http"]["routers"][alias] == http["routers"][alias]
+    assert loaded["http"]["services"]["service__2Fuser_2Fa_2F"] == {
+        "loadBalancer": {
+            "servers": [{"url": "http://127.0.0.1:9001"}],
+            "passHostHeader": True,
+        }
+    }
+
+    reloaded = TraefikFileProviderProxy(
+        dynamic_config_file=rules, compact_route_table=True
+    )
+    assert isinstance(
+        reloaded.dynamic_config["jupyterhub"]["routes"][alias],
+        traefik_utils.JupyterHubRouteRecord,
+    )
+    assert reloaded.dynamic_config == proxy.dynamic_config
+
+    # plain dicts by default
+    proxy = TraefikFileProviderProxy(dynamic_config_file=rules)
+    assert type(proxy.dynamic_config["http"]["routers"][alias]) is dict
+    assert type(proxy.dynamic_config["jupyterhub"]["routes"][alias]) is dict
+
+
+@pytest.mark.parametrize("directory", [False, True])
+async def test_watch_external_changes(tmp_path, monkeypatch, directory):
+    kwargs = dict(dynamic_config_file=str(tmp_path / "rules.toml"))
+    if directory:
+        kwargs["dynamic_config_directory"] = str(tmp_path / "dynamic")
+        kwargs["dynamic_config_shards"] = 4
+    proxy = TraefikFileProviderProxy(dynamic_config_watch_interval=0.01, **kwargs)
+    other = TraefikFileProviderProxy(**kwargs)
+    await add_route(proxy, "/user/a/")
+    await add_route(proxy, "/user/b/")
+    proxy._start_watching()
+
+    loads = []
+    original_load = traefik_utils.TraefikConfigFileHandler.load
+
+    def load(self):
+        loads.append(self.file_path)
+        return original_load(self)
+
+    monkeypatch.setattr(traefik_utils.TraefikConfigFileHandler, "load", load)
+
+    async def wait_for_routes(expected):
+        for i in range(200):
+            if sorted(await proxy.get_all_routes()) == expected:
+                return
+            await asyncio.sleep(0.01)
+        assert sorted(await proxy.get_all_routes()) == expected
+
+    try:
+        # our own writes aren't reloaded
+        await add_route(proxy, "/user/c/")
+        await asyncio.sleep(0.1)
+        assert loads == []
+
+        # changes by another writer are merged
+        other.dynamic_config
+        loads.clear()
+        await add_route(other, "/user/d/")
+        await other.delete_routes(["/user/a/"])
+        await wait_for_routes(["/user/b/", "/user/c/", "/user/d/"])
+        assert loads
+        route = await proxy.get_route("/user/d/")
+        assert route["target"] == "http://127.0.0.1:9000"
+        if directory:
+            # only the changed files are reloaded
+            changed = {
+                proxy._shard_file(
+                    proxy._route_shard(
+                        traefik_utils.generate_alias(routespec, "router").partition(
+                            "_"
+                        )[2]
+                    )
+                )
+                for routespec in ("/user/a/", "/user/d/")
+            }
+            assert set(loads) <= changed
+
+        # and kept when we write again
+        await add_route(proxy, "/user/e/")
+        reloaded = TraefikFileProviderProxy(**kwargs)
+        assert sorted(await reloaded.get_all_routes()) == [
+            "/user/b/",
+            "/user/c/",
+            "/user/d/",
+            "/user/e/",
+        ]
+    finally:
+        proxy._watch_task.cancel()
+
+
+@pytest.mark.parametrize("directory", [False, True])
+async def test_replicas(tmp_path, directory):
+    kwargs = {}
+    if directory:
+        kwargs["dynamic_config_directory"] = str(tmp_path / "dynamic")
+        replicas = [str(tmp_path / f"replica{i}") for i in range(2)]
+    else:
+        replicas = [str(tmp_path / f"replica{i}.toml") for i in range(2)]
+    proxy = TraefikFileProviderProxy(
+        dynamic_config_file=str(tmp_path / "rules.toml"),
+        dynamic_config_replicas=replicas,
+        **kwargs,
+    )
+    for i in range(5):
+        await add_route(proxy, f"/user/user{i}/")
+    await proxy.delete_routes(["/user/user3/"])
+
+    def read_all(path):
+        if not directory:
+            with open(path) as f:
+                return f.read()
+        contents = {}
+        for fname in sorted(os.listdir(path)):
+            with open(os.path.join(path, fname)) as f:
+                contents[fname] = f.read()
+        return contents
+
+    primary = proxy.dynamic_config_directory or proxy.dynamic_config_file
+    expected = read_all(primary)
+    assert "user4" in str(expected)
+    assert "user3" not in str(expected)
+    for replica in replicas:
+        assert read_all(replica) == expected
+        reloaded = TraefikFileProviderProxy(
+            dynamic_config_file=replica if not directory else "rules.toml",
+            dynamic_config_directory=replica if directory else "",
+        )
+        assert sorted(await reloaded.get_all_routes()) == sorted(
+            await proxy.get_all_routes()
+        )
+
+    proxy._cleanup()
+    for replica in replicas:
+        if directory:
+            assert os.listdir(replica) == []
+        else:
+            assert not os.path.exists(replica)
@@ -1,6 +1,15 @@
+import asyncio
+import random
+from types import SimpleNamespace
+
 import pytest
 
+from jupyterhub_traefik_proxy import traefik_utils
+from jupyterhub_traefik_proxy.consul import TraefikConsulProxy
 from jupyterhub_traefik_proxy.kv_proxy import TKvProxy
+from jupyterhub_traefik_proxy.proxy import TraefikProxy
+
+from .utils import MemoryKvProxy
 
 
 @pytest.mark.parametrize(
@@ -35,6 +44,31 @@ def test_flatten_dict(orig, expected):
     assert flat == expected
 
 
+@pytest.mark.parametrize(
+    "data",
+    [
+        {},
+        {"user": "name", "server_name": ""},
+        {"nested": {"list": [1, {"x": True}], "empty": {}}, "flag": False},
+    ],
+)
+@pytest.mark.parametrize("routespec", ["/user/name/", "host.tld/path/"])
+def test_flat_config_for_route(routespec, data):
+    proxy = TKvProxy(traefik_entrypoint="websecure")
+    traefik_config, jupyterhub_config = TraefikProxy._dynamic_config_for_route(
+        proxy, routespec, "http://10.0.0.1:8888", data
+    )
+    flat_traefik, flat_jupyterhub = proxy._dynamic_config_for_route(
+        routespec, "http://10.0.0.1:8888", data
+    )
+    assert flat_traefik == proxy.flatten_dict_for_kv(
+        traefik_config, prefix=proxy.kv_traefik_prefix
+    )
+    assert flat_jupyterhub == proxy.flatten_dict_for_kv(
+        jupyterhub_config, prefix=proxy.kv_jupyterhub_prefix
+    )
+
+
 @pytest.mark.parametrize(
     "orig, expected",
     [
@@ -107,3 +141,464 @@ def test_unflatten_dict_error(flat, expected):
     proxy = TKvProxy()
     with pytest.raises(expected):
         proxy.unflatten_dict_from_kv(flat)
+
+
+async def test_concurrent_reads_shared():
+    proxy = MemoryKvProxy(read_delay=0.1)
+    other = MemoryKvProxy(read_delay=0.1)
+    for i in range(3):
+        await proxy.add_route(f"/user/{i}/", f"http://127.0.0.1:{9000 + i}", {"i": i})
+
+    all_routes = await asyncio.gather(
+        *(proxy.get_all_routes() for i in range(5)), other.get_all_routes()
+    )
+    assert all(
+        sorted(routes) == ["/user/0/", "/user/1/", "/user/2/"]
+        for routes in all_routes[:5]
+    )
+    assert all_routes[5] == {}
+    # one read per proxy instance
+    assert proxy.reads == ["jupyterhub"]
+    assert other.reads == ["jupyterhub"]
+    assert proxy._single_flight.hits["get_all_routes"] == 4
+
+    proxy.reads = []
+    routes = await asyncio.gather(
+        *(proxy.get_route(f"/user/{i % 2}/") for i in range(6))
+    )
+    assert [route["routespec"] for route in routes] == [
+        f"/user/{i % 2}/" for i in range(6)
+    ]
+    assert len(proxy.reads) == 2
+    assert proxy._single_flight.calls["get_route"] == 2
+    assert proxy._single_flight.hits["get_route"] == 4
+
+
+async def test_reads_after_write_not_shared():
+    class SnapshotReadProxy(MemoryKvProxy):
+        """Reads see the store as it was when they started"""
+
+        async def _kv_get_tree(self, prefix):
+            self.reads.append(prefix)
+            snapshot = dict(self.kv)
+            await asyncio.sleep(self.read_delay)
+            if not prefix.endswith(self.kv_separator):
+                prefix = prefix + self.kv_separator
+            kv_list = [(k, v) for k, v in snapshot.items() if k.startswith(prefix)]
+            return self.unflatten_dict_from_kv(kv_list, root_key=prefix)
+
+    proxy = SnapshotReadProxy(read_delay=0.1)
+    await proxy.add_route("/user/a/", "http://127.0.0.1:9000", {"user": "a"})
+    stale = asyncio.ensure_future(proxy.get_route("/user/a/"))
+    await asyncio.sleep(0.01)
+    await proxy.add_route("/user/a/", "http://127.0.0.1:9001", {"user": "a"})
+    # a read started before our write is not shared with us
+    route = await proxy.get_route("/user/a/")
+    assert route["target"] == "http://127.0.0.1:9001"
+    assert (await stale)["target"] == "http://127.0.0.1:9000"
+    assert proxy._single_flight.hits["get_route"] == 0
+
+
+async def test_add_routes_flat():
+    proxy = MemoryKvProxy()
+    routes = [
+        (f"/user/{i}/", f"http://127.0.0.1:{9000 + i}", {"i": i, "tags": ["a", "b"]})
+        for i in range(10)
+    ]
+    await proxy.add_routes(routes)
+    all_routes = await proxy.get_all_routes()
+    assert sorted(all_routes) == sorted(routespec for routespec, _, _ in routes)
+    assert all_routes["/user/3/"] == {
+        "routespec": "/user/3/",
+        "target": "http://127.0.0.1:9003",
+        "data": {"i": "3", "tags": ["a", "b"]},
+    }
+    assert (
+        proxy.kv["traefik/http/routers/router__2Fuser_2F3_2F/entryPoints/0"] == "http"
+    )
+
+
+def legacy_unflatten(proxy, kv_list, root_key=""):
+    """unflatten_dict_from_kv before the single-pass version, for comparison"""
+    sep = proxy.kv_separator
+    tree = {}
+    for key, value in sorted(kv_list, key=lambda item: len(item[0].split(sep))):
+        key_path = key.split(sep)
+        d = tree
+        for parent_key, key in zip(key_path[:-1], key_path[1:]):
+            if parent_key.isdigit():
+                parent_key = int(parent_key)
+            if isinstance(d, dict) and parent_key not in d:
+                d[parent_key] = [] if key.isdigit() else {}
+            elif isinstance(d, list):
+                d.append([] if key.isdigit() else {})
+            d = d[parent_key]
+        if isinstance(d, list):
+            if len(d) != int(key):
+                raise IndexError(f"Got invalid list key {key_path}")
+            d.append(value)
+        else:
+            d[key] = value
+    if root_key:
+        for key in root_key.strip(sep).split(sep):
+            if key not in tree:
+                return {}
+            tree = tree[key]
+    return tree
+
+
+def random_tree(rng, depth=0, nested_lists=True):
+    """A random tree of non-empty dicts and lists with string leaves
+
+    With nested_lists=False, lists only hold leaves,
+    which is all the legacy unflatten supported.
+    """
+    n = rng.randint(1, 4)
+    if depth >= 4 or rng.random() < 0.3:
+        return f"v{rng.randint(0, 100)}"
+    if rng.random() < 0.3:
+        if not nested_lists:
+            return [f"v{rng.randint(0, 100)}" for i in range(n)]
+        return [random_tree(rng, depth + 1) for i in range(n)]
+    return {
+        f"k{rng.randint(0, 20)}": random_tree(rng, depth + 1, nested_lists)
+        for i in range(n)
+    }
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_unflatten_matches_legacy(seed):
+    rng = random.Random(seed)
+    proxy = TKvProxy()
+    tree = {"root": random_tree(rng)}
+    if not isinstance(tree["root"], (dict, list)):
+        tree["root"] = {"leaf": tree["root"]}
+    flat = list(proxy.flatten_dict_for_kv(tree).items())
+    for kv_list in (flat, sorted(flat), sorted(flat, reverse=True)):
+        assert proxy.unflatten_dict_from_kv(kv_list) == tree
+        assert proxy.unflatten_dict_from_kv(kv_list, root_key="root") == tree["root"]
+    rng.shuffle(flat)
+    assert proxy.unflatten_dict_from_kv(flat) == tree
+
+    # the legacy function needed list items in order
+    # and failed on lists of containers
+    tree = {"root": {"leaf": random_tree(rng, nested_lists=False)}}
+    flat = list(proxy.flatten_dict_for_kv(tree).items())
+    for kv_list in (flat, sorted(flat)):
+        legacy = legacy_unflatten(proxy, kv_list)
+        assert tree == legacy
+        assert proxy.unflatten_dict_from_kv(kv_list) == legacy
+
+
+def test_unflatten_max_depth():
+    proxy = TKvProxy()
+    kv_list = [("a/b/c/d", "x"), ("a/b/e", "y"), ("a/f", "z")]
+    assert proxy.unflatten_dict_from_kv(kv_list, max_depth=2) == {
+        "a": {"b/c/d": "x", "b/e": "y", "f": "z"}
+    }
+    assert proxy.unflatten_dict_from_kv(kv_list, root_key="a/", max_depth=2) == {
+        "b": {"c/d": "x", "e": "y"},
+        "f": "z",
+    }
+    assert proxy.unflatten_dict_from_kv([("a/1", "y"), ("a/0", "x")]) == {
+        "a": ["x", "y"]
+    }
+
+
+async def test_json_route_format():
+    proxy = MemoryKvProxy(kv_route_format="json")
+    data = {"user": "name", "last_activity": 5, "tags": ["a", "b"], "flag": True}
+    await proxy.add_route("/user/name/", "http://127.0.0.1:9000", data)
+    route_keys = [key for key in proxy.kv if key.startswith("jupyterhub")]
+    assert route_keys == ["jupyterhub/routes/router__2Fuser_2Fname_2F"]
+
+    expected = {
+        "routespec": "/user/name/",
+        "target": "http://127.0.0.1:9000",
+        "data": data,
+    }
+    # data keeps its types
+    assert await proxy.get_route("/user/name/") == expected
+    assert await proxy.get_all_routes() == {"/user/name/": expected}
+
+    await proxy.delete_route("/user/name/")
+    assert proxy.kv == {}
+    assert await proxy.get_route("/user/name/") is None
+
+
+@pytest.mark.parametrize("from_format, to_format", [("keys", "json"), ("json", "keys")])
+async def test_migrate_route_format(from_format, to_format):
+    proxy = MemoryKvProxy(kv_route_format=from_format)
+    # records the format on startup
+    await proxy._migrate_route_format()
+    for i in range(3):
+        await proxy.add_route(f"/user/{i}/", f"http://127.0.0.1:{9000 + i}", {"i": "x"})
+    before = await proxy.get_all_routes()
+
+    migrated = MemoryKvProxy(kv_route_format=to_format)
+    migrated.kv = proxy.kv
+    # routes in the other format can be read before migrating
+    assert await migrated.get_all_routes() == before
+    assert await migrated.get_route("/user/1/") == before["/user/1/"]
+
+    await migrated._migrate_route_format()
+    route_keys = [key for key in proxy.kv if key.startswith("jupyterhub/routes/")]
+    if to_format == "json":
+        assert len(route_keys) == 3
+    else:
+        assert len(route_keys) == 3 * 5
+    assert proxy.kv["jupyterhub/route_format"] == to_format
+    assert await migrated.get_all_routes() == before
+    assert await migrated.get_route("/user/1/") == before["/user/1/"]
+
+    # nothing to do until the format changes again
+    migrated.reads.clear()
+    await migrated._migrate_route_format()
+    assert migrated.reads == ["jupyterhub/route_format"]
+
+    # routes in either format can be deleted
+    await migrated.delete_route("/user/0/")
+    await proxy.delete_route("/user/1/")
+    assert sorted(await migrated.get_all_routes()) == ["/user/2/"]
+
+
+async def test_migrate_route_format_default():
+    proxy = MemoryKvProxy()
+    await proxy.add_route("/user/a/", "http://127.0.0.1:9000", {})
+    # routes stored without a recorded format are in the default format,
+    # so starting with it doesn't scan the routes
+    await proxy._migrate_route_format()
+    assert proxy.reads == ["jupyterhub/route_format"]
+    assert "jupyterhub/route_format" not in proxy.kv
+
+
+@pytest.mark.parametrize("kv_route_format", ["keys", "json"])
+async def test_route_cache(kv_route_format):
+    uncached = MemoryKvProxy(kv_route_format=kv_route_format)
+    for i in range(3):
+        await uncached.add_route(
+            f"/user/{i}/", f"http://127.0.0.1:{9000 + i}", {"i": i}
+        )
+
+    proxy = MemoryKvProxy(
+        kv_route_format=kv_route_format, kv_route_cache=True, kv_route_cache_ttl=0
+    )
+    proxy.kv = uncached.kv
+    await proxy._load_route_cache()
+    assert proxy.reads == ["jupyterhub"]
+
+    # reads are answered from memory
+    assert await proxy.get_all_routes() == await uncached.get_all_routes()
+    assert await proxy.get_route("/user/1/") == await uncached.get_route("/user/1/")
+    assert await proxy.get_route("/user/nosuch/") is None
+    assert proxy.reads == ["jupyterhub"]
+    assert proxy._route_cache_stats == {"hits": 3}
+
+    # and kept up to date by our own changes
+    await proxy.add_route("/user/new/", "http://127.0.0.1:9999", {"i": 9})
+    await proxy.delete_route("/user/0/")
+    await proxy.add_routes(
+        [(f"/user/batch{i}/", "http://127.0.0.1:9998", {}) for i in range(2)]
+    )
+    await proxy.delete_routes(["/user/batch1/"])
+    assert await proxy.get_all_routes() == await uncached.get_all_routes()
+    assert await proxy.get_route("/user/new/") == await uncached.get_route("/user/new/")
+    assert proxy.reads == ["jupyterhub"]
+
+
+async def test_route_cache_refresh():
+    other = MemoryKvProxy()
+    proxy = MemoryKvProxy(kv_route_cache=True, kv_route_cache_ttl=0.2, read_delay=0.05)
+    proxy.kv = other.kv
+    await proxy.add_route("/user/a/", "http://127.0.0.1:9000", {"user": "a"})
+    # loaded on the first read
+    assert sorted(await proxy.get_all_routes()) == ["/user/a/"]
+    assert proxy._route_cache_stats == {"misses": 1}
+
+    # changes by others are seen after the ttl
+    await other.add_route("/user/b/", "http://127.0.0.1:9001", {"user": "b"})
+    assert sorted(await proxy.get_all_routes()) == ["/user/a/"]
+    await asyncio.sleep(0.2)
+
+    # changes made while reloading aren't lost
+    routes, _ = await asyncio.gather(
+        proxy.get_all_routes(),
+        proxy.add_route("/user/c/", "http://127.0.0.1:9002", {"user": "c"}),
+    )
+    assert {"/user/a/", "/user/b/"} <= set(routes)
+    assert sorted(await proxy.get_all_routes()) == ["/user/a/", "/user/b/", "/user/c/"]
+    assert proxy._route_cache_stats == {"hits": 2, "misses": 2}
+    assert len(proxy.reads) == 2
+
+
+async def wait_for(condition, timeout=2):
+    for i in range(int(timeout / 0.01)):
+        if await condition():
+            return
+        await asyncio.sleep(0.01)
+    assert await condition()
+
+
+@pytest.mark.parametrize("kv_route_format", ["keys", "json"])
+async def test_route_watch(kv_route_format):
+    other = MemoryKvProxy(kv_route_format=kv_route_format)
+    await other.add_route("/user/a/", "http://127.0.0.1:9000", {"user": "a"})
+    proxy = MemoryKvProxy(
+        kv_route_format=kv_route_format,
+        kv_route_cache=True,
+        kv_route_cache_ttl=0.01,
+        kv_route_watch=True,
+    )
+    proxy.kv = other.kv
+    await proxy._start_route_cache()
+    assert proxy.reads == ["jupyterhub"]
+
+    async def routes_match():
+        return await proxy.get_all_routes() == await other.get_all_routes()
+
+    try:
+        # changes by others are applied as they happen
+        await other.add_route("/user/b/", "http://127.0.0.1:9001", {"user": "b"})
+        await other.add_route("/user/a/", "http://127.0.0.1:9002", {"user": "a"})
+        await other.delete_route("/user/b/")
+        await wait_for(routes_match)
+        assert (await proxy.get_route("/user/a/"))["target"] == "http://127.0.0.1:9002"
+        # without reloading the whole table, despite the ttl
+        assert proxy.reads.count("jupyterhub") == 1
+        if kv_route_format == "json":
+            # values come with the changes
+            assert proxy.reads == ["jupyterhub"]
+
+        # after a failed watch, the table is reloaded
+        proxy._route_watch_retry_delay = 0.01
+        other.kv.fail_watchers()
+        await other.add_route("/user/c/", "http://127.0.0.1:9003", {"user": "c"})
+        await wait_for(routes_match)
+
+        async def watching():
+            return proxy._route_watching
+
+        await wait_for(watching)
+        assert proxy.kv.watchers
+        assert proxy.reads.count("jupyterhub") >= 2
+        await other.delete_route("/user/c/")
+        await wait_for(routes_match)
+    finally:
+        proxy._route_watch_task.cancel()
+    await asyncio.sleep(0)
+    assert not proxy.kv.watchers
+
+
+async def test_consul_watch_index():
+    # consul returns the index as a string (the X-Consul-Index header)
+    responses = [
+        ("999", [{"Key": "p/a", "ModifyIndex": 999, "Value": b"1"}]),
+        ("1000", [{"Key": "p/a", "ModifyIndex": 1000, "Value": b"2"}]),
+        (
+            "1001",
+            [
+                {"Key": "p/a", "ModifyIndex": 1000, "Value": b"2"},
+                {"Key": "p/b", "ModifyIndex": 1001, "Value": b"3"},
+            ],
+        ),
+    ]
+    indexes = []
+
+    class ConsulKV:
+        async def get(self, key, recurse=False, index=None):
+            indexes.append(index)
+            return responses.pop(0)
+
+    proxy = TraefikConsulProxy(consul=SimpleNamespace(kv=ConsulKV()))
+    watch = proxy._kv_watch_tree("p/")
+    assert await watch.__anext__() == []
+    assert await watch.__anext__() == [("p/a", "2")]
+    assert await watch.__anext__() == [("p/b", "3")]
+    await watch.aclose()
+    assert indexes == [None, "999", 1000]
+
+
+async def test_route_watch_merges_changes():
+    other = MemoryKvProxy()
+    proxy = MemoryKvProxy(kv_route_cache=True, kv_route_watch=True)
+    proxy.kv = other.kv
+    await proxy._start_route_cache()
+
+    # a route written one key at a time, with a change for each key
+    # (e.g. redis keyspace notifications)
+    traefik_config, jupyterhub_config = other._dynamic_config_for_route(
+        "/user/a/", "http://127.0.0.1:9000", {"user": "a"}
+    )
+    for key, value in {**traefik_config, **jupyterhub_config}.items():
+        other.kv[key] = value
+        other.kv.notify([(key, value)])
+        await asyncio.sleep(0)
+
+    async def route_added():
+        return await proxy.get_route("/user/a/") is not None
+
+    await wait_for(route_added)
+    # read once, not once per key
+    route_prefix = "jupyterhub/routes/" + traefik_utils.generate_alias(
+        "/user/a/", "router"
+    )
+    assert proxy.reads.count(route_prefix) == 1
+
+    # stopping stops the watch, without a traefik process to stop
+    await proxy.stop()
+    await asyncio.sleep(0)
+    assert proxy._route_watch_task.done()
+    assert not proxy.kv.watchers
+
+
+async def test_transaction_chunks():
+    proxy = MemoryKvProxy()
+    to_set = {}
+    for i in range(10):
+        for config in proxy._dynamic_config_for_route(
+            f"/user/{i}/", "http://127.0.0.1:9000", {"user": f"{i}"}
+        ):
+            to_set.update(config)
+    to_set["traefik/http/middlewares/auth/basicAuth/users/0"] = "x"
+    routes_per_key = {key: proxy._transaction_group(key) for key in to_set}
+    assert len(set(routes_per_key.values())) == 11
+
+    chunks = list(proxy._transaction_chunks(to_set, 16))
+    assert sorted(key for chunk in chunks for key in chunk) == sorted(to_set)
+    assert all(len(chunk) <= 16 for chunk in chunks)
+    # each route is in a single chunk
+    chunk_of_route = {}
+    for i, chunk in enumerate(chunks):
+        for key in chunk:
+            assert chunk_of_route.setdefault(routes_per_key[key], i) == i
+
+    # the keys deleting a route are grouped the same way
+    traefik_keys, jupyterhub_keys = proxy._keys_for_route("/user/3/")
+    to_delete = [
+        "/".join(["traefik"] + key_path + [""]) for key_path in traefik_keys
+    ] + ["/".join(["jupyterhub"] + key_path) for key_path in jupyterhub_keys]
+    assert len(list(proxy._transaction_chunks(to_delete, 4))) == 1
+
+
+async def test_consul_txn_errors():
+    payloads = []
+
+    class ConsulTxn:
+        async def put(self, payload):
+            payloads.append(payload)
+            if len(payloads) == 2:
+                raise RuntimeError("txn failed")
+
+    proxy = TraefikConsulProxy(
+        consul=SimpleNamespace(txn=ConsulTxn()), consul_max_txn_ops=8
+    )
+    to_set = {}
+    for i in range(4):
+        traefik_config, _ = proxy._dynamic_config_for_route(
+            f"/user/{i}/", "http://127.0.0.1:9000", {}
+        )
+        to_set.update(traefik_config)
+    with pytest.raises(RuntimeError):
+        await proxy._kv_atomic_set(to_set)
+    # one route (5 keys) per transaction, stopping at the failed one
+    assert [len(payload) for payload in payloads] == [5, 5]
@@ -13,14 +13,16 @@ from random import randint
 from unittest.mock import Mock
 from urllib.parse import quote, urlparse
 
+import bcrypt
 import pytest
 import websockets
 from jupyterhub.objects import Hub, Server
 from jupyterhub.user import User
 from jupyterhub.utils import exponential_backoff, url_path_join
 from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
 
-from jupyterhub_traefik_proxy.proxy import TraefikProxy
+from jupyterhub_traefik_proxy.proxy import TraefikProxy, _is_loopback
 
 from . import utils
 
@@ -157,6 +159,48 @@ def test_default_port():
         TraefikProxy(public_url="ftp://127.0.0.1:23/")
 
 
+@pytest.mark.parametrize("rounds", [4, 5])
+def test_bcrypt_rounds(rounds):
+    proxy = TraefikProxy(
+        traefik_api_password="secret", traefik_api_bcrypt_rounds=rounds
+    )
+    hashed = proxy.traefik_api_hashed_password
+    assert hashed.startswith(f"$2b${rounds:02}$")
+    assert bcrypt.checkpw(b"secret", hashed.encode("ascii"))
+
+
+def test_sha1_hash():
+    proxy = TraefikProxy(traefik_api_password="secret", traefik_api_auth="sha1")
+    # matches `htpasswd -nbs user secret`
+    assert proxy.traefik_api_hashed_password == "{SHA}5en6G6MezRroT3XKqkdPOmY/BfQ="
+
+
+@pytest.mark.parametrize(
+    "hostname, loopback",
+    [
+        ("localhost", True),
+        ("127.0.0.1", True),
+        ("127.1.2.3", True),
+        ("::1", True),
+        ("0.0.0.0", False),
+        ("10.0.0.1", False),
+        ("traefik.example.org", False),
+    ],
+)
+def test_is_loopback(hostname, loopback):
+    assert _is_loopback(hostname) == loopback
+
+
+def test_traefik_api_client():
+    p = TraefikProxy()
+    # the client is created on first use, not to be closed
+    p._cleanup()
+    assert not p.trait_has_value("traefik_api_client")
+    # keep-alive needs pycurl, so it's opt-in
+    assert not p.traefik_api_keep_alive
+    assert isinstance(p.traefik_api_client, SimpleAsyncHTTPClient)
+
+
 @pytest.mark.parametrize(
     "routespec, existing_routes",
     [
@@ -409,6 +453,27 @@ async def test_get_all_routes(proxy, launch_backends):
     assert routes == {}
 
 
+async def test_add_delete_routes(proxy, launch_backends):
+    proxy_url = proxy.public_url.rstrip("/")
+    backends = await launch_backends(2)
+    routes = [(f"/bulk/{i}/", backends[i % 2], {"user": f"user{i}"}) for i in range(20)]
+
+    await proxy.add_routes(routes)
+    all_routes = await proxy.get_all_routes()
+    for routespec, target, data in routes:
+        assert_equal(
+            all_routes[routespec],
+            {"routespec": routespec, "target": target, "data": data},
+        )
+    for routespec, target, data in routes[:2]:
+        port = await utils.get_responding_backend_port(proxy_url, routespec)
+        assert port == urlparse(target).port
+
+    await proxy.delete_routes([routespec for routespec, _, _ in routes])
+    all_routes = await proxy.get_all_routes()
+    assert not any(routespec.startswith("/bulk/") for routespec in all_routes)
+
+
 async def test_host_origin_headers(proxy, launch_backends):
     routespec = "/user/username/"
     target = "http://127.0.0.1:9000"
@@ -527,3 +592,51 @@ async def test_websockets(proxy, launch_backends):
         port = await websocket.recv()
 
     assert port == str(default_backend_port)
+
+
+@pytest.fixture(params=["no_auth_etcd_proxy", "redis_proxy", "no_auth_consul_proxy"])
+def kv_proxy(request):
+    """The key-value store proxies, which support kv_route_watch"""
+    return request.getfixturevalue(request.param)
+
+
+async def test_kv_route_watch(kv_proxy):
+    # another proxy instance on the same store, e.g. a standby hub
+    config = {
+        name: getattr(kv_proxy, name)
+        for name in kv_proxy.trait_names(config=True)
+        if name.startswith(f"{kv_proxy.provider_name}_")
+        and not kv_proxy.trait_metadata(name, "deprecated_in")
+    }
+    watcher = kv_proxy.__class__(
+        should_start=False,
+        kv_traefik_prefix=kv_proxy.kv_traefik_prefix,
+        kv_jupyterhub_prefix=kv_proxy.kv_jupyterhub_prefix,
+        kv_route_cache=True,
+        kv_route_watch=True,
+        **config,
+    )
+    await watcher._start_route_cache()
+
+    async def watched_route(routespec):
+        for i in range(100):
+            route = await watcher.get_route(routespec)
+            if route == await kv_proxy.get_route(routespec):
+                return route
+            await asyncio.sleep(0.1)
+        assert route == await kv_proxy.get_route(routespec)
+
+    try:
+        routespec = "/watched/"
+        await kv_proxy.add_route(routespec, "http://127.0.0.1:9000", {"user": "x"})
+        route = await watched_route(routespec)
+        assert route["target"] == "http://127.0.0.1:9000"
+        await kv_proxy.add_route(routespec, "http://127.0.0.1:9001", {"user": "x"})
+        route = await watched_route(routespec)
+        assert route["target"] == "http://127.0.0.1:9001"
+        await kv_proxy.delete_route(routespec)
+        assert await watched_route(routespec) is None
+    finally:
+        f = watcher._cleanup()
+        if f is not None:
+            await f
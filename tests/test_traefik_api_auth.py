@@ -4,6 +4,8 @@ import pytest
 from jupyterhub.utils import exponential_backoff
 from tornado.httpclient import AsyncHTTPClient
 
+from jupyterhub_traefik_proxy.fileprovider import TraefikFileProviderProxy
+
 # Mark all tests in this file as asyncio
 pytestmark = pytest.mark.asyncio
 
@@ -46,3 +48,74 @@ async def test_traefik_api_auth(proxy, username, password, expected_rc):
     rc = await api_login()
     assert rc == expected_rc
     return
+
+
+@pytest.mark.parametrize(
+    "api_url, allowed",
+    [
+        ("http://localhost:8099", True),
+        ("http://127.0.0.1:8099", True),
+        ("http://[::1]:8099", True),
+        ("http://0.0.0.0:8099", False),
+        ("http://10.0.0.1:8099", False),
+        ("https://traefik.example.org", False),
+    ],
+)
+async def test_no_auth_requires_loopback(tmp_path, caplog, api_url, allowed):
+    kwargs = dict(
+        dynamic_config_file=str(tmp_path / "rules.toml"),
+        static_config_file=str(tmp_path / "traefik.toml"),
+        traefik_api_url=api_url,
+    )
+    # start with authentication
+    proxy = TraefikFileProviderProxy(**kwargs)
+    await proxy._setup_traefik_static_config()
+    await proxy._setup_traefik_dynamic_config()
+    assert "auth_api" in proxy.dynamic_config["http"]["middlewares"]
+
+    proxy = TraefikFileProviderProxy(traefik_api_auth="none", **kwargs)
+    await proxy._setup_traefik_static_config()
+    if not allowed:
+        with pytest.raises(ValueError):
+            await proxy._setup_traefik_dynamic_config()
+        return
+    await proxy._setup_traefik_dynamic_config()
+    # previous authentication is removed
+    assert "middlewares" not in proxy.dynamic_config["http"]["routers"]["route_api"]
+    assert "auth_api" not in proxy.dynamic_config["http"].get("middlewares", {})
+
+    # nothing to remove the next time
+    caplog.clear()
+    proxy = TraefikFileProviderProxy(traefik_api_auth="none", **kwargs)
+    await proxy._setup_traefik_static_config()
+    await proxy._setup_traefik_dynamic_config()
+    assert "Missing dynamic config" not in caplog.text
+
+
+@pytest.mark.parametrize("address", [":8099", "0.0.0.0:8099", "10.0.0.1:8099"])
+async def test_no_auth_requires_loopback_entrypoint(tmp_path, address):
+    proxy = TraefikFileProviderProxy(
+        dynamic_config_file=str(tmp_path / "rules.toml"),
+        static_config_file=str(tmp_path / "traefik.toml"),
+        traefik_api_url="http://localhost:8099",
+        traefik_api_auth="none",
+        extra_static_config={
+            "entryPoints": {"auth_api": {"address": address}},
+        },
+    )
+    await proxy._setup_traefik_static_config()
+    # any client sending Host: localhost would match the api router
+    with pytest.raises(ValueError, match="entrypoint"):
+        await proxy._setup_traefik_dynamic_config()
+
+
+async def test_no_auth_requires_should_start(tmp_path):
+    proxy = TraefikFileProviderProxy(
+        dynamic_config_file=str(tmp_path / "rules.toml"),
+        traefik_api_url="http://localhost:8099",
+        traefik_api_auth="none",
+    )
+    # traefik's static config is not ours, so we can't check the entrypoint
+    proxy.should_start = False
+    with pytest.raises(ValueError, match="should_start"):
+        await proxy._setup_traefik_dynamic_config()
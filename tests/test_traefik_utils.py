@@ -1,3 +1,4 @@
+import asyncio
 import json
 import os
 
@@ -57,6 +58,33 @@ def test_atomic_writing(tmpdir):
     assert tmpdir.listdir() == [testfile]
 
 
+def test_atomic_writing_fsync(tmpdir, monkeypatch):
+    synced = []
+    fsync = os.fsync
+
+    def record_fsync(fd):
+        synced.append(os.path.basename(os.readlink(f"/proc/self/fd/{fd}")))
+        fsync(fd)
+
+    if not os.path.exists("/proc/self/fd"):
+        pytest.skip("needs /proc to identify synced files")
+    monkeypatch.setattr(os, "fsync", record_fsync)
+    testfile = tmpdir.join("testfile")
+    with traefik_utils.atomic_writing(str(testfile)) as f:
+        f.write("before")
+    assert synced == []
+    with traefik_utils.atomic_writing(str(testfile), fsync=True) as f:
+        f.write("after")
+    # the temp file is synced before it replaces testfile
+    assert len(synced) == 1
+    assert synced[0].startswith("testfile-tmp-")
+    traefik_utils.fsync_directory(str(tmpdir))
+    assert synced[1] == tmpdir.basename
+    with testfile.open("r") as f:
+        assert f.read() == "after"
+    assert tmpdir.listdir() == [testfile]
+
+
 def test_atomic_writing_recovery(tmpdir):
     testfile = tmpdir.join("testfile")
     with testfile.open("w") as f:
@@ -93,3 +121,158 @@ def test_atomic_writing_recovery(tmpdir):
 def test_generate_rule(routespec, expected_rule):
     rule = traefik_utils.generate_rule(routespec)
     assert rule == expected_rule
+
+
+def _route_config(routespec, target, data):
+    from jupyterhub_traefik_proxy.proxy import TraefikProxy
+
+    traefik_config, jupyterhub_config = TraefikProxy()._dynamic_config_for_route(
+        routespec, target, data
+    )
+    return traefik_utils.deep_merge(traefik_config, {"jupyterhub": jupyterhub_config})
+
+
+def _make_handler(path, encoder):
+    ext = traefik_utils.encoders[encoder][0]
+    package = traefik_utils.encoders[encoder][1]
+    if package not in {"json", "toml"}:
+        pytest.importorskip(package.replace("-", "_"))
+    return traefik_utils.TraefikConfigFileHandler(
+        str(path.join(f"rules.{ext}")), encoder=encoder
+    )
+
+
+@pytest.mark.parametrize("encoder", list(traefik_utils.encoders))
+def test_encoders(tmpdir, encoder):
+    handler = _make_handler(tmpdir, encoder)
+    config = _route_config("/user/x/", "http://127.0.0.1:9000", {"user": "x"})
+    handler.atomic_dump(config)
+    assert handler.load() == config
+
+
+def test_encoder_errors():
+    with pytest.raises(ValueError):
+        traefik_utils.TraefikConfigFileHandler("rules.toml", encoder="json")
+    with pytest.raises(ValueError):
+        traefik_utils.TraefikConfigFileHandler("rules.toml", encoder="nosuchthing")
+    handler = traefik_utils.TraefikConfigFileHandler("rules.yaml", encoder="auto")
+    assert handler.encoder == "json"
+    handler = traefik_utils.TraefikConfigFileHandler("rules.toml", encoder="auto")
+    assert handler.encoder in traefik_utils.auto_encoders["toml"]
+
+
+@pytest.mark.parametrize("encoder", list(traefik_utils.encoders))
+def test_fragment_cache(tmpdir, encoder):
+    handler = _make_handler(tmpdir, encoder)
+    sections = {("http", "routers"), ("http", "services"), ("jupyterhub", "routes")}
+    cache = traefik_utils.ConfigFragmentCache(handler, sections)
+    config = {
+        "tls": {"options": {"default": {"minVersion": "VersionTLS12"}}},
+        "http": {
+            "middlewares": {"auth_api": {"basicAuth": {"users": ["a:b"]}}},
+            "routers": {"route_api": {"rule": "Host(`x`)", "service": "api@internal"}},
+        },
+    }
+    for i in range(5):
+        traefik_utils.deep_merge(
+            config,
+            _route_config(
+                f"/user/user{i}/", f"http://127.0.0.1:{9000 + i}", {"user": f"user{i}"}
+            ),
+        )
+
+    def roundtrip():
+        handler.atomic_write_text(cache.render(config))
+        return handler.load()
+
+    assert roundtrip() == config
+    # one per route entry, plus the api router
+    assert len(cache) == 16
+
+    # changed entries are re-rendered after invalidation
+    routes = config["jupyterhub"]["routes"]
+    alias = traefik_utils.generate_alias("/user/user1/", "router")
+    routes[alias]["target"] = "http://10.0.0.1:8888"
+    cache.invalidate([["jupyterhub", "routes", alias]])
+    assert len(cache) == 15
+    assert roundtrip() == config
+
+    # deleted entries
+    routes.pop(alias)
+    cache.invalidate([["jupyterhub", "routes", alias]])
+    assert roundtrip() == config
+
+    # empty route sections are omitted, as traefik doesn't handle empty dicts
+    config["http"]["services"].clear()
+    config["jupyterhub"]["routes"].clear()
+    cache.clear()
+    loaded = roundtrip()
+    assert "services" not in loaded["http"]
+    assert "jupyterhub" not in loaded
+
+
+def test_route_records():
+    config = _route_config("/user/x/", "http://127.0.0.1:9000", {"user": "x"})
+    for (top, section), cls in traefik_utils._record_classes.items():
+        for alias, entry in config[top][section].items():
+            record = traefik_utils.compact_route_entry((top, section), entry)
+            assert isinstance(record, cls)
+            assert not hasattr(record, "__dict__")
+            assert record == entry
+            assert record.to_dict() == entry
+            assert dict(record) == entry
+            assert traefik_utils.plain_route_entry(record) == entry
+            for key in entry:
+                assert record[key] == entry[key]
+            assert "missing" not in record
+            with pytest.raises(KeyError):
+                record["missing"]
+
+    # non-standard entries are left alone
+    api_router = {"rule": "PathPrefix(`/api`)", "service": "api@internal"}
+    assert (
+        traefik_utils.compact_route_entry(("http", "routers"), api_router) is api_router
+    )
+    service = {"loadBalancer": {"servers": [{"url": "a"}, {"url": "b"}]}}
+    assert traefik_utils.compact_route_entry(("http", "services"), service) is service
+
+
+async def test_single_flight():
+    single_flight = traefik_utils.SingleFlight()
+    calls = []
+
+    async def read(key, delay=0.1):
+        calls.append(key)
+        await asyncio.sleep(delay)
+        if key == "bad":
+            raise ValueError(key)
+        return {"key": key}
+
+    results = await asyncio.gather(
+        *(single_flight.run("read", read, key) for key in ["a", "a", "b", "a"])
+    )
+    assert results == [{"key": "a"}, {"key": "a"}, {"key": "b"}, {"key": "a"}]
+    assert calls == ["a", "b"]
+    assert single_flight.calls == {"read": 2}
+    assert single_flight.hits == {"read": 2}
+    # finished calls aren't shared
+    await single_flight.run("read", read, "a")
+    assert calls == ["a", "b", "a"]
+
+    # errors are raised to every caller
+    results = await asyncio.gather(
+        single_flight.run("read", read, "bad"),
+        single_flight.run("read", read, "bad"),
+        return_exceptions=True,
+    )
+    assert [type(r) for r in results] == [ValueError, ValueError]
+    assert single_flight._in_flight == {}
+
+    # cancelling one caller doesn't cancel the others
+    first = asyncio.ensure_future(single_flight.run("read", read, "c"))
+    second = asyncio.ensure_future(single_flight.run("read", read, "c"))
+    await asyncio.sleep(0.01)
+    first.cancel()
+    assert await second == {"key": "c"}
+    assert first.cancelled()
+    assert calls.count("c") == 1
@@ -0,0 +1,188 @@
+"""Tests for waiting on routes to be registered in the traefik api"""
+
+import asyncio
+import json
+import re
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.web import Application, HTTPError, RequestHandler
+
+from jupyterhub_traefik_proxy import traefik_utils
+from jupyterhub_traefik_proxy.proxy import TraefikProxy
+
+from .utils import MemoryProxy
+
+
+def alias_names(routespec, provider_name):
+    """The router and service names traefik lists for a routespec"""
+    return {
+        kind: f"{traefik_utils.generate_alias(routespec, kind)}@{provider_name}"
+        for kind in ("router", "service")
+    }
+
+
+def list_names(names, query):
+    """A page of names matching a traefik api query, and the next page"""
+    names = [name for name in names if query["search"] in name]
+    per_page = int(query.get("per_page", 100))
+    page = int(query.get("page", 1))
+    items = names[(page - 1) * per_page : page * per_page]
+    next_page = page + 1 if page * per_page < len(names) else 1
+    return json.dumps([{"name": name} for name in items]), str(next_page)
+
+
+class MockApiProxy(TraefikProxy):
+    """TraefikProxy with an in-memory stand-in for the traefik api"""
+
+    provider_name = "file"
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.api_requests = []
+        self.api_names = {"router": [], "service": []}
+
+    def register(self, routespec):
+        for kind, name in alias_names(routespec, self.provider_name).items():
+            self.api_names[kind].append(name)
+
+    async def _traefik_api_request(self, path, api_url=None):
+        self.api_requests.append(path)
+        url = urlparse(path)
+        kind = url.path.rsplit("/", 1)[-1][:-1]
+        query = {key: value[0] for key, value in parse_qs(url.query).items()}
+        body, next_page = list_names(self.api_names[kind], query)
+        return SimpleNamespace(body=body, headers={"X-Next-Page": next_page})
+
+
+class ReplicaApiHandler(RequestHandler):
+    """Serve the traefik api of the replica named in the Host header
+
+    Only requests matching the proxy's api router rule reach the api,
+    like in traefik.
+    """
+
+    def initialize(self, proxy, replicas):
+        self.proxy = proxy
+        self.replicas = replicas
+
+    def get(self, kind):
+        rule = self.proxy.dynamic_config["http"]["routers"]["route_api"]["rule"]
+        hostname = self.request.host_name
+        if hostname not in re.findall(r"Host\(`([^`]+)`\)", rule):
+            raise HTTPError(404)
+        query = {key: value[0] for key, value in parse_qs(self.request.query).items()}
+        body, next_page = list_names(self.replicas[hostname][kind], query)
+        self.set_header("X-Next-Page", next_page)
+        self.finish(body)
+
+
+class ApiWaitProxy(MemoryProxy):
+    """MemoryProxy waiting for routes in the traefik api"""
+
+    _wait_for_route = TraefikProxy._wait_for_route
+
+
+@pytest.fixture
+def api_proxy():
+    return MockApiProxy(traefik_api_page_size=2, check_route_timeout=2)
+
+
+async def test_wait_for_route_shared_poller(api_proxy):
+    routespecs = [f"/user/{i}/" for i in range(10)]
+    futures = [
+        asyncio.ensure_future(api_proxy._wait_for_route(spec)) for spec in routespecs
+    ]
+    await asyncio.sleep(0.5)
+    assert not any(f.done() for f in futures)
+    polls = len(api_proxy.api_requests)
+    for spec in routespecs:
+        api_proxy.register(spec)
+    await asyncio.wait_for(asyncio.gather(*futures), 5)
+    # one poll covers all waiting routes,
+    # paginated over 10 routers and 10 services
+    requests = len(api_proxy.api_requests) - polls
+    assert requests == 2 * 5
+    assert api_proxy._route_waiters == {}
+
+
+async def test_wait_for_route_searches_pending(api_proxy):
+    for i in range(20):
+        api_proxy.register(f"/user/{i}/")
+    wait = asyncio.ensure_future(api_proxy._wait_for_route("/user/new/"))
+    await asyncio.sleep(0.3)
+    assert not wait.done()
+    # the first poll lists 10 pages of routers and services,
+    # later polls only search for the pending route
+    listed = 2 * 10
+    polls = len(api_proxy.api_requests) - listed
+    assert polls > 0
+    assert polls % 2 == 0
+    assert all("per_page" not in path for path in api_proxy.api_requests[listed:])
+    api_proxy.register("/user/new/")
+    await asyncio.wait_for(wait, 2)
+    assert (len(api_proxy.api_requests) - listed) % 2 == 0
+    assert api_proxy._route_waiters == {}
+
+
+async def test_wait_for_route_timeout(api_proxy):
+    api_proxy.check_route_timeout = 1
+    with pytest.raises(asyncio.TimeoutError):
+        await api_proxy._wait_for_route("/missing/")
+    assert api_proxy._route_waiters == {}
+    # poller stops when nobody is waiting
+    await asyncio.sleep(0.5)
+    assert api_proxy._route_poller is None
+
+
+@pytest.mark.parametrize("quorum", [0, 1])
+async def test_wait_for_route_replicas(quorum):
+    # the same api, reached with a different hostname for each replica
+    sockets = bind_sockets(0, "127.0.0.1")
+    port = sockets[0].getsockname()[1]
+    hostnames = ["localhost", "127.0.0.1"]
+    api_urls = [f"http://{hostname}:{port}" for hostname in hostnames]
+    proxy = ApiWaitProxy(
+        traefik_api_url=api_urls[0],
+        traefik_api_urls=api_urls,
+        traefik_api_quorum=quorum,
+        traefik_api_page_size=2,
+        check_route_timeout=2,
+    )
+    await proxy._setup_traefik_dynamic_config()
+    replicas = {hostname: {"router": [], "service": []} for hostname in hostnames}
+    app = Application(
+        [
+            (
+                r"/api/http/(router|service)s",
+                ReplicaApiHandler,
+                {"proxy": proxy, "replicas": replicas},
+            )
+        ]
+    )
+    server = HTTPServer(app)
+    server.add_sockets(sockets)
+
+    def register(routespec, hostname):
+        for kind, name in alias_names(routespec, proxy.provider_name).items():
+            replicas[hostname][kind].append(name)
+
+    try:
+        wait = asyncio.ensure_future(proxy._wait_for_route("/user/a/"))
+        await asyncio.sleep(0.3)
+        assert not wait.done()
+        register("/user/a/", hostnames[1])
+        if quorum == 0:
+            # all replicas must have the route
+            await asyncio.sleep(0.3)
+            assert not wait.done()
+            register("/user/a/", hostnames[0])
+        await asyncio.wait_for(wait, 2)
+        assert proxy._route_waiters == {}
+        assert proxy._route_confirmations == {}
+    finally:
+        server.stop()
+        proxy.traefik_api_client.close()
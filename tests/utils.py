@@ -1,3 +1,4 @@
+import asyncio
 import json
 import socket
 import ssl
@@ -6,6 +7,10 @@ from urllib.parse import urlparse
 
 from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
 
+from jupyterhub_traefik_proxy.kv_proxy import TKvProxy
+from jupyterhub_traefik_proxy.proxy import TraefikProxy
+from jupyterhub_traefik_proxy.traefik_utils import deep_merge
+
 _ports = {
     "default_backend": 9000,
     "first_backend": 9090,
@@ -96,3 +101,128 @@ async def check_services_ready(urls):
         ready = ready and status
 
     return ready
+
+
+class MemoryProxy(TraefikProxy):
+    """TraefikProxy storing dynamic config in memory, without running traefik
+
+    Records each call that writes to the dynamic config,
+    so tests can check how many writes were made.
+    """
+
+    provider_name = "memory"
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.jupyterhub_config = {"routes": {}}
+        self.writes = []
+
+    async def _apply_dynamic_config(self, traefik_config, jupyterhub_config=None):
+        self.writes.append(("apply", traefik_config, jupyterhub_config))
+        await asyncio.sleep(0)
+        deep_merge(self.dynamic_config, traefik_config)
+        if jupyterhub_config:
+            deep_merge(self.jupyterhub_config, jupyterhub_config)
+
+    async def _delete_dynamic_config(self, traefik_keys, jupyterhub_keys):
+        self.writes.append(("delete", traefik_keys, jupyterhub_keys))
+        await asyncio.sleep(0)
+        for config, keys in (
+            (self.dynamic_config, traefik_keys),
+            (self.jupyterhub_config, jupyterhub_keys),
+        ):
+            for key_path in keys:
+                parent = config
+                for key in key_path[:-1]:
+                    parent = parent.get(key, {})
+                parent.pop(key_path[-1], None)
+
+    async def _get_jupyterhub_dynamic_config(self):
+        return self.jupyterhub_config
+
+    async def _wait_for_route(self, routespec):
+        pass
+
+
+class MemoryKvStore(dict):
+    """An in-memory key-value store, shared by MemoryKvProxy instances
+
+    Changes are sent to the queues in `watchers`, like a watch on a real store.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.watchers = []
+
+    def notify(self, changes):
+        for queue in self.watchers:
+            queue.put_nowait(changes)
+
+    def fail_watchers(self):
+        """Make all watches fail, like a lost connection"""
+        self.notify(ConnectionError("lost connection"))
+
+
+class MemoryKvProxy(TKvProxy):
+    """TKvProxy with an in-memory key-value store, without running traefik
+
+    Records the prefix of each `_kv_get_tree` call,
+    which waits `read_delay` seconds, like a round trip to the store.
+    Share `kv` between instances to simulate several writers.
+    """
+
+    provider_name = "memory"
+
+    def __init__(self, read_delay=0, **kwargs):
+        super().__init__(**kwargs)
+        self.kv = MemoryKvStore()
+        self.reads = []
+        self.read_delay = read_delay
+
+    async def _kv_atomic_set(self, to_set):
+        await asyncio.sleep(0)
+        self.kv.update(to_set)
+        self.kv.notify(list(to_set.items()))
+
+    async def _kv_atomic_delete(self, *keys):
+        await asyncio.sleep(0)
+        deleted = []
+        for key in keys:
+            if key.endswith(self.kv_separator):
+                deleted.extend(k for k in self.kv if k.startswith(key))
+            elif key in self.kv:
+                deleted.append(key)
+        for key in deleted:
+            self.kv.pop(key)
+        self.kv.notify([(key, None) for key in deleted])
+
+    async def _kv_watch_tree(self, prefix):
+        queue = asyncio.Queue()
+        self.kv.watchers.append(queue)
+        try:
+            yield []
+            while True:
+                changes = await queue.get()
+                if isinstance(changes, Exception):
+                    raise changes
+                changes = [(k, v) for k, v in changes if k.startswith(prefix)]
+                if changes:
+                    yield changes
+        finally:
+            self.kv.watchers.remove(queue)
+
+    async def _kv_get(self, key):
+        self.reads.append(key)
+        await asyncio.sleep(self.read_delay)
+        return self.kv.get(key)
+
+    async def _kv_get_tree(self, prefix):
+        self.reads.append(prefix)
+        await asyncio.sleep(self.read_delay)
+        if not prefix.endswith(self.kv_separator):
+            prefix = prefix + self.kv_separator
+        kv_list = [(k, v) for k, v in self.kv.items() if k.startswith(prefix)]
+        return self.unflatten_dict_from_kv(kv_list, root_key=prefix)
+
+    async def _wait_for_route(self, routespec):
+        pass